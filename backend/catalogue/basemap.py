@@ -0,0 +1,250 @@
+# Seamap: view and interact with Australian coastal habitat data
+# Copyright (c) 2017, Institute of Marine & Antarctic Studies.  Written by Condense Pty Ltd.
+# Released under the Affero General Public Licence (AGPL) v3.  See LICENSE file for details.
+"""
+The basemap that layer and pressure previews are drawn over.
+
+The source basemap is one large global raster in EPSG:4326. For each
+CRS previews are drawn in, build_basemap_pyramid reprojects it into a
+"pyramid": a tiled, compressed GeoTIFF with internal overviews
+(COG-style), so a preview only reads the tiles, at the zoom level,
+that it needs. Without a pyramid for a CRS, or for bounds outside its
+pyramid, previews fall back to reading the source basemap.
+"""
+import math
+import os
+
+import numpy
+import rasterio
+from affine import Affine
+from django.core.files.storage import default_storage
+from PIL import Image
+from pyproj import CRS
+from rasterio import transform, warp, windows
+from rasterio.errors import WindowError
+from rasterio.vrt import WarpedVRT
+
+# We not able to simply *add* the basemap image file to our GitHub tracking, as it's too large.
+# For now, the image will be added to deployments manually.
+BASEMAP_SOURCE = 'land_shallow_topo_21600.tif'
+BASEMAP_CRS = 'EPSG:4326'
+BASEMAP_BOUNDS = (-180, -90, 180, 90)
+
+# The CRSes previews are drawn in, which have pyramids built by default
+PYRAMID_CRSES = ['EPSG:4326', 'EPSG:3031', 'EPSG:3112']
+# Pyramids cover their CRS's area of use, plus this margin (in degrees)
+PYRAMID_MARGIN = 20
+PYRAMID_BLOCK_SIZE = 512
+# Overviews are added until the smallest is under this size (in pixels)
+PYRAMID_MIN_OVERVIEW_SIZE = 256
+
+Image.MAX_IMAGE_PIXELS = None
+
+# Datasets opened by this process, by CRS (or None for the source
+# basemap); see basemap_dataset
+_datasets = {}
+
+
+def source_path() -> str:
+    return default_storage.path(BASEMAP_SOURCE)
+
+
+def pyramid_path(crs: str) -> str:
+    "Path of the basemap pyramid of a CRS (e.g. 'EPSG:3031')"
+    return default_storage.path(f"basemap_pyramid/{crs.replace(':', '_')}.tif")
+
+
+def source_georeferencing(src) -> tuple:
+    "The (crs, transform) of the source basemap, which may not be georeferenced itself"
+    if src.crs:
+        return (src.crs, src.transform)
+    return (rasterio.crs.CRS.from_string(BASEMAP_CRS), transform.from_bounds(*BASEMAP_BOUNDS, width=src.width, height=src.height))
+
+
+def pyramid_source_bounds(crs: str) -> tuple:
+    "The bounds (in the source basemap's CRS) of the pyramid of a CRS"
+    ( west, south, east, north ) = CRS.from_string(crs).area_of_use.bounds
+    return (
+        max(BASEMAP_BOUNDS[0], west - PYRAMID_MARGIN),
+        max(BASEMAP_BOUNDS[1], south - PYRAMID_MARGIN),
+        min(BASEMAP_BOUNDS[2], east + PYRAMID_MARGIN),
+        min(BASEMAP_BOUNDS[3], north + PYRAMID_MARGIN),
+    )
+
+
+def build_pyramid(crs: str) -> str:
+    """
+    Build the basemap pyramid of a CRS from the source basemap: reprojected
+    block by block (so the basemap is never held in memory), with internal
+    overviews. The pyramid is written to a temporary file and then moved
+    into place, so previews being generated meanwhile aren't affected.
+
+    Args:
+        crs (str): The CRS of the pyramid (e.g. 'EPSG:3031').
+
+    Returns:
+        str: The path of the pyramid.
+    """
+    path = pyramid_path(crs)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.tmp'
+
+    with rasterio.open(source_path()) as src:
+        ( src_crs, src_transform ) = source_georeferencing(src)
+        bounds = pyramid_source_bounds(crs)
+        window = windows.from_bounds(*bounds, transform=src_transform)
+        ( dst_transform, width, height ) = warp.calculate_default_transform(
+            src_crs, crs, round(window.width), round(window.height), *bounds
+        )
+
+        overview_factors = []
+        while max(width, height) / 2 ** (len(overview_factors) + 1) >= PYRAMID_MIN_OVERVIEW_SIZE:
+            overview_factors.append(2 ** (len(overview_factors) + 1))
+
+        profile = {
+            'driver': 'GTiff',
+            'width': width,
+            'height': height,
+            'count': src.count,
+            'dtype': src.dtypes[0],
+            'crs': crs,
+            'transform': dst_transform,
+            'tiled': True,
+            'blockxsize': PYRAMID_BLOCK_SIZE,
+            'blockysize': PYRAMID_BLOCK_SIZE,
+            'compress': 'deflate',
+            'predictor': 2,
+            'interleave': 'pixel',
+            'BIGTIFF': 'IF_SAFER',
+        }
+        vrt_options = {
+            'src_crs': src_crs,
+            'src_transform': src_transform,
+            'crs': crs,
+            'transform': dst_transform,
+            'width': width,
+            'height': height,
+            'resampling': warp.Resampling.bilinear,
+        }
+        with WarpedVRT(src, **vrt_options) as vrt, rasterio.open(temp_path, 'w', **profile) as dst:
+            for _, block_window in dst.block_windows(1):
+                dst.write(vrt.read(window=block_window), window=block_window)
+            dst.build_overviews(overview_factors, warp.Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+
+    os.replace(temp_path, path)
+    return path
+
+
+def basemap_dataset(crs: str):
+    """
+    The basemap dataset to draw previews in a CRS from: the CRS's pyramid if
+    it has been built, or else (or with crs None) the source basemap.
+    Datasets are opened on first use and reused for the rest of the
+    process.
+    """
+    if crs not in _datasets:
+        path = pyramid_path(crs) if crs else None
+        _datasets[crs] = rasterio.open(path if path and os.path.exists(path) else source_path())
+    return _datasets[crs]
+
+
+def basemap_window(basemap_src, min_x: float, min_y: float, max_x: float, max_y: float, crs: str):
+    "The (unclipped) window of a basemap dataset covering bounds in crs"
+    ( src_crs, src_transform ) = source_georeferencing(basemap_src)
+
+    # If the bounds wrap around the antimeridian, the basemap's full width
+    # is used
+    ( src_min_x, src_min_y, src_max_x, src_max_y ) = warp.transform_bounds(crs, src_crs, min_x, min_y, max_x, max_y, densify_pts=21)
+    if src_min_x >= src_max_x:
+        ( src_min_x, src_max_x ) = ( basemap_src.bounds.left, basemap_src.bounds.right ) if basemap_src.crs else ( BASEMAP_BOUNDS[0], BASEMAP_BOUNDS[2] )
+    return windows.from_bounds(src_min_x, src_min_y, src_max_x, src_max_y, transform=src_transform)
+
+
+def is_within(window, basemap_src) -> bool:
+    "Whether a window lies entirely within a basemap dataset"
+    return (
+        window.col_off >= 0 and window.row_off >= 0
+        and window.col_off + window.width <= basemap_src.width
+        and window.row_off + window.height <= basemap_src.height
+    )
+
+
+def cropped_basemap_image(min_x: float, min_y: float, max_x: float, max_y: float, crs: str, width: int, height: int) -> Image:
+    """
+    Generate a cropped basemap image.
+
+    Only the window of the basemap covering the bounds (plus a margin for
+    resampling) is read, decimated to roughly the target resolution (using
+    the basemap's overviews, where it has them), so the cost scales with
+    the output rather than the size of the basemap. All bands are
+    reprojected at once. Bounds that aren't entirely within the CRS's
+    pyramid are drawn from the source basemap, and any part of them
+    outside the source basemap is left black.
+
+    Args:
+        min_x (float): Minimum x coordinate (in crs)
+        min_y (float): Minimum y coordinate (in crs)
+        max_x (float): Maximum x coordinate (in crs)
+        max_y (float): Maximum y coordinate (in crs)
+        crs (str): Coordinate reference system of the image (e.g. "EPSG:3031")
+        width (int): Width of the image
+        height (int): Height of the image
+
+    Returns:
+        Image: Cropped basemap image.
+    """
+    dst_transform = transform.from_bounds(min_x, min_y, max_x, max_y, width, height)
+    basemap_src = basemap_dataset(crs)
+    window = basemap_window(basemap_src, min_x, min_y, max_x, max_y, crs)
+    if not is_within(window, basemap_src) and basemap_src.name != source_path():
+        basemap_src = basemap_dataset(None)
+        window = basemap_window(basemap_src, min_x, min_y, max_x, max_y, crs)
+    ( src_crs, src_transform ) = source_georeferencing(basemap_src)
+    full_window = windows.Window(0, 0, basemap_src.width, basemap_src.height)
+
+    # Decimate the read to (no coarser than) the target resolution
+    decimation = max(1, int(min(window.width / width, window.height / max(height, 1))))
+    margin = 2 * decimation
+    col_off = math.floor(window.col_off) - margin
+    row_off = math.floor(window.row_off) - margin
+    window = windows.Window(
+        col_off,
+        row_off,
+        math.ceil(window.col_off + window.width) + margin - col_off,
+        math.ceil(window.row_off + window.height) + margin - row_off
+    )
+    mode_map = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+    mode = mode_map.get(basemap_src.count, 'L')
+    try:
+        window = window.intersection(full_window)
+    except WindowError:
+        # Entirely outside the basemap
+        return Image.new(mode, (width, height))
+    out_width = max(1, window.width // decimation)
+    out_height = max(1, window.height // decimation)
+
+    src_array = basemap_src.read(
+        window=window,
+        out_shape=(basemap_src.count, out_height, out_width),
+        resampling=warp.Resampling.average
+    )
+    window_transform = windows.transform(window, src_transform) * Affine.scale(window.width / out_width, window.height / out_height)
+
+    dst_array = numpy.zeros((basemap_src.count, height, width), dtype=src_array.dtype)
+    warp.reproject(
+        src_array,
+        dst_array,
+        src_transform=window_transform,
+        src_crs=src_crs,
+        dst_transform=dst_transform,
+        dst_crs=crs,
+        resampling=warp.Resampling.bilinear,
+    )
+
+    # Create PIL Image from the reprojected data
+    if basemap_src.count == 1:
+        bands_array = dst_array[0].astype('uint8')
+    else:
+        bands_array = numpy.moveaxis(dst_array, 0, -1).astype('uint8')
+    return Image.fromarray(bands_array, mode=mode)
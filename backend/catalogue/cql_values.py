@@ -0,0 +1,172 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from catalogue.models import RichLayerCqlValues
+
+# Background refreshes of stale values, and the ids of the rich layers
+# being refreshed (so a rich layer is only refreshed once at a time):
+_refresh_executor = ThreadPoolExecutor(max_workers=settings.RICH_LAYER_CQL_VALUES_REFRESH_WORKERS)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# Refreshes that requests are waiting on, by rich layer id, so concurrent
+# requests for a rich layer without stored values share one retrieval:
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def cql_properties(rich_layer) -> list:
+    "The CQL properties of a rich layer's controls"
+    return list(rich_layer.controls.values_list('cql_property', flat=True))
+
+
+def refresh_cql_values(rich_layer) -> RichLayerCqlValues:
+    """
+    Retrieves the values of a rich layer's CQL properties, and their
+    combinations, from upstream (Layer.cql_property_values) and stores
+    them. If the retrieval fails, any previously stored values are kept,
+    with the error recorded against them.
+
+    Args:
+        rich_layer (RichLayer): The rich layer to refresh the values of.
+
+    Returns:
+        RichLayerCqlValues: The rich layer's stored values.
+
+    Raises:
+        Exception: If the retrieval fails and the rich layer has no stored
+            values (of its current CQL properties).
+    """
+    now = timezone.now()
+    properties = cql_properties(rich_layer)
+    try:
+        values = json.dumps(rich_layer.layer.cql_property_values(properties))
+    except Exception as e:
+        stored = RichLayerCqlValues.objects.filter(rich_layer=rich_layer).first()
+        if stored is None or json.loads(stored.cql_properties) != properties:
+            # Stored values of other properties are no use; the failure is
+            # recorded so it isn't retried until it's stale (after
+            # RICH_LAYER_CQL_VALUES_ERROR_RETRY)
+            RichLayerCqlValues.objects.update_or_create(
+                rich_layer=rich_layer,
+                defaults={
+                    'cql_properties': json.dumps(properties),
+                    'values': None,
+                    'error': str(e),
+                    'last_refreshed': None,
+                    'last_attempted': now,
+                }
+            )
+            raise
+        stored.error, stored.last_attempted = str(e), now
+        stored.save(update_fields=['error', 'last_attempted'])
+        if stored.values is None:
+            raise
+        logging.warning(f"Could not refresh CQL filter values of rich layer {rich_layer.id}; keeping its stored values", exc_info=e)
+        return stored
+
+    stored, _ = RichLayerCqlValues.objects.update_or_create(
+        rich_layer=rich_layer,
+        defaults={
+            'cql_properties': json.dumps(properties),
+            'values': values,
+            'error': None,
+            'last_refreshed': now,
+            'last_attempted': now,
+        }
+    )
+    return stored
+
+
+def refresh_cql_values_once(rich_layer) -> RichLayerCqlValues:
+    """
+    As refresh_cql_values, but concurrent calls for the same rich layer
+    make one retrieval, and share its result (or exception).
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(rich_layer.id)
+        is_leader = future is None
+        if is_leader:
+            future = _in_flight[rich_layer.id] = Future()
+    if not is_leader:
+        return future.result()
+
+    try:
+        stored = refresh_cql_values(rich_layer)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(stored)
+        return stored
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(rich_layer.id, None)
+
+
+def _background_refresh(rich_layer):
+    try:
+        refresh_cql_values(rich_layer)
+    except Exception as e:
+        logging.error(f"Error refreshing CQL filter values of rich layer {rich_layer.id}", exc_info=e)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(rich_layer.id)
+        # Connections are per-thread; close this worker's
+        connections.close_all()
+
+
+def refresh_cql_values_in_background(rich_layer):
+    "Schedules a refresh of a rich layer's values, unless one is already underway"
+    with _refreshing_lock:
+        if rich_layer.id in _refreshing:
+            return
+        _refreshing.add(rich_layer.id)
+    _refresh_executor.submit(_background_refresh, rich_layer)
+
+
+def is_stale(stored: RichLayerCqlValues) -> bool:
+    "Whether stored values are due a refresh; sooner if their last refresh failed"
+    max_age = settings.RICH_LAYER_CQL_VALUES_ERROR_RETRY if stored.error else settings.RICH_LAYER_CQL_VALUES_MAX_AGE
+    return timezone.now() - stored.last_attempted > timedelta(seconds=max_age)
+
+
+def get_cql_filter_values(rich_layer) -> dict:
+    """
+    The values of a rich layer's CQL properties and their combinations,
+    stale-while-revalidate: stored values are returned straight away, and
+    if they're older than RICH_LAYER_CQL_VALUES_MAX_AGE they're refreshed
+    in the background for subsequent requests. Only a rich layer without
+    stored values for its current controls waits on upstream (with
+    concurrent requests sharing one retrieval); a failure to retrieve
+    them is remembered, and only retried after
+    RICH_LAYER_CQL_VALUES_ERROR_RETRY.
+
+    Args:
+        rich_layer (RichLayer): The rich layer to get the values of.
+
+    Returns:
+        dict: 'values' and 'value_combinations' (see Layer.cql_property_values).
+
+    Raises:
+        Exception: If the values couldn't be retrieved.
+    """
+    stored = RichLayerCqlValues.objects.filter(rich_layer=rich_layer).first()
+    if (
+        stored is None
+        or json.loads(stored.cql_properties) != cql_properties(rich_layer)
+        or (stored.values is None and is_stale(stored))
+    ):
+        stored = refresh_cql_values_once(rich_layer)
+    elif is_stale(stored):
+        refresh_cql_values_in_background(rich_layer)
+    if stored.values is None:
+        raise ValueError(f"CQL filter values of rich layer {rich_layer.id} could not be retrieved: {stored.error}")
+    return json.loads(stored.values)
@@ -0,0 +1,220 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from catalogue.models import LayerLegend, LegendNotSupported
+
+# Background refreshes of stale legends, and the ids of the layers
+# being refreshed (so a layer is only refreshed once at a time):
+_refresh_executor = ThreadPoolExecutor(max_workers=settings.LAYER_LEGEND_REFRESH_WORKERS)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# Retrievals that requests are waiting on, by layer id, so concurrent
+# requests for a layer without a stored legend share one retrieval:
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def refresh_legend(layer) -> LayerLegend:
+    """
+    Retrieves a layer's legend from upstream (Layer.get_legend) and stores
+    it. If the retrieval fails, any previously stored legend is kept, with
+    the error recorded against it; a layer without one has the failure
+    recorded (with no legend, and no last_refreshed), so it isn't retried
+    until it's stale.
+
+    Args:
+        layer (Layer): The layer to refresh the legend of.
+
+    Returns:
+        LayerLegend: The layer's stored legend.
+
+    Raises:
+        Exception: If the retrieval fails and the layer has no previously
+            retrieved legend.
+    """
+    now = timezone.now()
+    try:
+        legend = json.dumps(layer.get_legend())
+    except LegendNotSupported:
+        legend = None
+    except Exception as e:
+        stored, _ = LayerLegend.objects.update_or_create(
+            layer=layer,
+            defaults={
+                'error': str(e),
+                'last_attempted': now,
+            }
+        )
+        if stored.last_refreshed is None:
+            raise
+        logging.warning(f"Could not refresh legend of layer {layer.id}; keeping its stored legend", exc_info=e)
+        return stored
+
+    stored, _ = LayerLegend.objects.update_or_create(
+        layer=layer,
+        defaults={
+            'legend': legend,
+            'error': None,
+            'last_refreshed': now,
+            'last_attempted': now,
+        }
+    )
+    return stored
+
+
+def refresh_legend_once(layer) -> LayerLegend:
+    """
+    As refresh_legend, but concurrent calls for the same layer make one
+    retrieval, and share its result (or exception).
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(layer.id)
+        is_leader = future is None
+        if is_leader:
+            future = _in_flight[layer.id] = Future()
+    if not is_leader:
+        return future.result()
+
+    try:
+        stored = refresh_legend(layer)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(stored)
+        return stored
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(layer.id, None)
+
+
+def _background_refresh(layer):
+    try:
+        refresh_legend(layer)
+    except Exception as e:
+        logging.error(f"Error refreshing legend of layer {layer.id}", exc_info=e)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(layer.id)
+        # Connections are per-thread; close this worker's
+        connections.close_all()
+
+
+def refresh_legend_in_background(layer):
+    "Schedules a refresh of a layer's legend, unless one is already underway"
+    with _refreshing_lock:
+        if layer.id in _refreshing:
+            return
+        _refreshing.add(layer.id)
+    _refresh_executor.submit(_background_refresh, layer)
+
+
+def is_stale(stored: LayerLegend) -> bool:
+    "Whether a stored legend is due a refresh; sooner if its last refresh failed"
+    max_age = settings.LAYER_LEGEND_ERROR_RETRY if stored.error else settings.LAYER_LEGEND_MAX_AGE
+    return timezone.now() - stored.last_attempted > timedelta(seconds=max_age)
+
+
+def is_retrieved(stored: LayerLegend) -> bool:
+    "Whether a LayerLegend has a retrieved legend, rather than only a failure to retrieve one"
+    return stored.last_refreshed is not None
+
+
+def stored_legend(stored: LayerLegend):
+    """
+    The legend of a LayerLegend; raises LegendNotSupported if the layer has
+    no legend, or an exception if it couldn't be retrieved
+    """
+    if not is_retrieved(stored):
+        raise Exception(f"Legend of layer {stored.layer_id} could not be retrieved: {stored.error}")
+    if stored.legend is None:
+        raise LegendNotSupported("No legend available for this layer")
+    return json.loads(stored.legend)
+
+
+def get_layer_legend(layer):
+    """
+    A layer's legend, stale-while-revalidate: the stored legend is
+    returned straight away, and if it's older than LAYER_LEGEND_MAX_AGE
+    it's refreshed in the background for subsequent requests. Only a layer
+    without a stored legend waits on upstream (with concurrent requests
+    sharing one retrieval); a failure to retrieve it is remembered, and
+    only retried after LAYER_LEGEND_ERROR_RETRY.
+
+    Args:
+        layer (Layer): The layer to get the legend of.
+
+    Returns:
+        Union[str, list[dict]]: The legend (see Layer.get_legend).
+
+    Raises:
+        LegendNotSupported: If the layer has no legend.
+    """
+    stored = LayerLegend.objects.filter(layer=layer).first()
+    if stored is None or (not is_retrieved(stored) and is_stale(stored)):
+        stored = refresh_legend_once(layer)
+    elif is_stale(stored):
+        refresh_legend_in_background(layer)
+    return stored_legend(stored)
+
+
+def _fetch_legend(layer):
+    try:
+        return refresh_legend_once(layer)
+    except Exception as e:
+        logging.error(f"Error retrieving legend of layer {layer.id}", exc_info=e)
+        return None
+    finally:
+        # Connections are per-thread; close this worker's
+        connections.close_all()
+
+
+def get_layer_legends(layers) -> dict:
+    """
+    The legends of many layers, as get_layer_legend: stored legends are
+    returned straight away (stale ones being refreshed in the background),
+    and the legends of layers without one are retrieved concurrently.
+    Concurrent identical upstream requests (eg, the legend of a MapServer
+    shared by several of the layers) are only made once; see
+    webapp.upstream.
+
+    Args:
+        layers (list[Layer]): The layers to get the legends of.
+
+    Returns:
+        dict: Legend (see Layer.get_legend) by layer id; None for layers
+            with no legend, or whose legend couldn't be retrieved.
+    """
+    stored = {stored.layer_id: stored for stored in LayerLegend.objects.filter(layer__in=layers)}
+
+    missing = []
+    for layer in layers:
+        if layer.id not in stored or (not is_retrieved(stored[layer.id]) and is_stale(stored[layer.id])):
+            missing.append(layer)
+        elif is_stale(stored[layer.id]):
+            refresh_legend_in_background(layer)
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=settings.LAYER_LEGEND_FETCH_WORKERS) as executor:
+            for layer, fetched in zip(missing, executor.map(_fetch_legend, missing)):
+                if fetched:
+                    stored[layer.id] = fetched
+
+    legends = {}
+    for layer in layers:
+        if layer.id in stored and is_retrieved(stored[layer.id]):
+            try:
+                legends[layer.id] = stored_legend(stored[layer.id])
+            except LegendNotSupported:
+                legends[layer.id] = None
+        else:
+            legends[layer.id] = None
+    return legends
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+import statistics
+import time
+
+from catalogue.management.commands.warm_boundary_statistics_cache import boundary_combinations, SQL_GET_BOUNDARIES
+from habitat.viewsets import boundary_area, boundary_version, SQL_GET_BOUNDARY_AREA
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+def summarise(label, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return f'{label:<24} n={len(timings):<6} mean={statistics.mean(timings):9.3f}ms  p50={statistics.median(timings):9.3f}ms  p95={p95:9.3f}ms  max={timings[-1]:9.3f}ms'
+
+
+# Compares the per-request cost of a boundary's area: unioning the
+# boundary geometry with the *_BOUNDARY_geom functions (as statistics
+# requests used to), against the precalculated BOUNDARY_*_AREA lookup
+# now used by boundary_area (including fetching the boundary type's
+# version, which every statistics request also does).
+class Command(BaseCommand):
+    help = 'Benchmarks boundary area lookups against unioning the boundary geometry'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--boundary-type',
+            action='append',
+            choices=list(SQL_GET_BOUNDARIES),
+            help='Boundary type to benchmark (may be repeated; defaults to all)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Maximum number of boundaries to benchmark per boundary type'
+        )
+
+    def handle(self, *args, **options):
+        boundary_types = options['boundary_type'] or list(SQL_GET_BOUNDARIES)
+
+        for boundary_type in boundary_types:
+            with connections['transects'].cursor() as cursor:
+                cursor.execute(SQL_GET_BOUNDARIES[boundary_type])
+                size = len(cursor.description)
+                rows = cursor.fetchall()
+            combinations = boundary_combinations(rows, size)[:options['limit']]
+
+            def union_area(boundary):
+                with connections['transects'].cursor() as cursor:
+                    cursor.execute(SQL_GET_BOUNDARY_AREA[boundary_type], list(boundary))
+                    return float(cursor.fetchone()[0])
+
+            def lookup_area(boundary):
+                return boundary_area(boundary_type, boundary, boundary_version(boundary_type))
+
+            # First lookup loads the precalculated areas; timed separately
+            load = timed(lambda: lookup_area(combinations[0]))
+
+            before, after, mismatches = [], [], []
+            for boundary in combinations:
+                before.append(timed(lambda: union_area(boundary)))
+                after.append(timed(lambda: lookup_area(boundary)))
+                expected, actual = union_area(boundary), lookup_area(boundary)
+                if abs(expected - actual) > max(1e-6 * expected, 1e-6):
+                    mismatches.append((boundary, expected, actual))
+
+            self.stdout.write(f'{boundary_type} ({len(combinations)} boundaries, initial load {load:.3f}ms)')
+            self.stdout.write('  ' + summarise('geometry union (before)', before))
+            self.stdout.write('  ' + summarise('precalculated (after)', after))
+            self.stdout.write(f'  speedup (p50): {statistics.median(before) / statistics.median(after):.1f}x')
+            for boundary, expected, actual in mismatches:
+                self.stdout.write(self.style.WARNING(f'  area mismatch for {boundary}: {expected} (union) != {actual} (precalculated)'))
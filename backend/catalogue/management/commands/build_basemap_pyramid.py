@@ -0,0 +1,27 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from catalogue import basemap
+
+
+# Builds the basemap pyramid (a tiled, overviewed, compressed GeoTIFF) of
+# each CRS previews are drawn in, from the source basemap (see
+# catalogue.basemap).  Run once per deployment, and again whenever the
+# source basemap changes.
+class Command(BaseCommand):
+    help = 'Builds the basemap pyramids that layer and pressure previews are drawn from'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--crs',
+            action='append',
+            choices=basemap.PYRAMID_CRSES,
+            help="Build only this CRS's pyramid (may be repeated)"
+        )
+
+    def handle(self, *args, **options):
+        for crs in options['crs'] or basemap.PYRAMID_CRSES:
+            logging.info(f"Building basemap pyramid for {crs}...")
+            path = basemap.build_pyramid(crs)
+            logging.info(f"Built basemap pyramid for {crs} at {path}")
@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from catalogue.cql_values import refresh_cql_values
+from catalogue.models import RichLayer
+
+
+def build_cql_values(rich_layer):
+    try:
+        refresh_cql_values(rich_layer)
+    except Exception as e:
+        logging.error(f"Error retrieving CQL filter values of rich layer {rich_layer.id}", exc_info=e)
+        return False
+    else:
+        return True
+    finally:
+        # Connections are per-thread; close this worker's
+        connections.close_all()
+
+
+# Retrieves and stores the distinct values (and value combinations) of
+# the CQL properties of every rich layer's controls (see
+# catalogue.cql_values), so no cql_filter_values request has to wait on
+# a full WFS GetFeature of the layer.  Run periodically to keep the
+# stored values fresh.
+class Command(BaseCommand):
+    help = "Retrieves and stores the CQL filter values of every rich layer's controls"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rich_layer_id',
+            action='append',
+            type=int,
+            help="Retrieve only this rich layer's values (may be repeated)"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help="Number of rich layers to retrieve the values of concurrently"
+        )
+
+    def handle(self, *args, **options):
+        # We can only request CQL filter values for WMS layers
+        rich_layers = RichLayer.objects \
+            .select_related('layer') \
+            .filter(layer__layer_type__in=['wms', 'wms-non-tiled'], controls__isnull=False) \
+            .distinct()
+        if options['rich_layer_id']:
+            rich_layers = rich_layers.filter(id__in=options['rich_layer_id'])
+        rich_layers = list(rich_layers)
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            results = list(executor.map(build_cql_values, rich_layers))
+
+        failed = [rich_layer for rich_layer, succeeded in zip(rich_layers, results) if not succeeded]
+        logging.info(f"Retrieved the values of {len(rich_layers) - len(failed)} of {len(rich_layers)} rich layers")
+        for rich_layer in failed:
+            self.stdout.write(self.style.WARNING(f"Could not retrieve CQL filter values of rich layer {rich_layer.id} ({rich_layer})"))
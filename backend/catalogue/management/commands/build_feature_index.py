@@ -0,0 +1,275 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import re
+import traceback
+import uuid
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from catalogue.models import Layer
+from webapp import upstream
+from catalogue.management.commands.build_feature_index_layer import get_features, insert_features, mapserver_layer_query_url
+from catalogue.management.commands.build_feature_index_start import SQL_TRUNCATE_LAYER_FEATURE_TEMP, SQL_TRUNCATE_LAYER_FEATURE_FINGERPRINT_TEMP
+
+# Starts the checkpoint log row of a layer for this build
+SQL_START_LAYER_FEATURE_LOG = """
+INSERT INTO layer_feature_log ( layer_id, build_id, result_offset, finished )
+OUTPUT INSERTED.id
+VALUES ( %s, %s, 0, 0 );
+"""
+
+# Records that a layer's features have been indexed up to result_offset
+SQL_CHECKPOINT_LAYER_FEATURE_LOG = "UPDATE layer_feature_log SET result_offset = %s, geometry_hash = %s, timestamp = GETDATE() WHERE id = %s;"
+
+SQL_FINISH_LAYER_FEATURE_LOG = "UPDATE layer_feature_log SET finished = 1, error = NULL, traceback = NULL, timestamp = GETDATE() WHERE id = %s;"
+
+SQL_ERROR_LAYER_FEATURE_LOG = "UPDATE layer_feature_log SET error = %s, traceback = %s, timestamp = GETDATE() WHERE id = %s;"
+
+SQL_GET_LATEST_BUILD_ID = """
+SELECT TOP 1 build_id
+FROM layer_feature_log
+WHERE build_id IS NOT NULL
+ORDER BY id DESC;
+"""
+
+# The checkpoint of each layer in a build
+SQL_GET_BUILD_CHECKPOINTS = """
+SELECT layer_id, id, result_offset, geometry_hash, finished
+FROM layer_feature_log
+WHERE
+  id IN (
+    SELECT MAX(id)
+    FROM layer_feature_log
+    WHERE build_id = %s
+    GROUP BY layer_id
+  );
+"""
+
+SQL_GET_LAYER_FEATURE_FINGERPRINTS = "SELECT layer_id, feature_count, geometry_hash, etag, last_modified FROM layer_feature_fingerprint;"
+
+SQL_INSERT_LAYER_FEATURE_FINGERPRINT_TEMP = """
+INSERT INTO layer_feature_fingerprint_temp ( layer_id, feature_count, geometry_hash, etag, last_modified, changed )
+VALUES ( %s, %s, %s, %s, %s, %s );
+"""
+
+EMPTY_GEOMETRY_HASH = '0' * 64
+
+
+def geometry_hash(features, running_hash=EMPTY_GEOMETRY_HASH):
+    """
+    Adds features to a running geometry hash: the sum (mod 2^256) of the
+    SHA-256 hashes of each feature's geometry.  Being a sum, it doesn't
+    depend on the order features are served in, and can be checkpointed
+    and continued.
+    """
+    total = int(running_hash, 16)
+    for feature in features:
+        geom = feature.geom.encode('utf-8') if isinstance(feature.geom, str) else feature.geom
+        total += int.from_bytes(hashlib.sha256(geom).digest(), 'big')
+    return format(total % 2**256, '064x')
+
+
+def get_layer_version(layer, server_url):
+    """
+    Cheaply retrieves a layer's upstream feature count and change markers
+    without retrieving its features: for ArcGIS layers the count from
+    returnCountOnly and the layer's editingInfo lastEditDate, and for
+    geoserver layers the numberMatched of a resultType=hits GetFeature
+    (along with any ETag/Last-Modified headers).
+
+    Returns:
+        tuple: (feature_count, etag, last_modified), any of which may be
+        None if the server doesn't provide it
+    """
+    if re.search(r'^(.+?)/services/(.+?)/(MapServer|FeatureServer)/.+$', server_url):
+        layer_url = server_url[:-len('/query')] if server_url.endswith('/query') else server_url
+        r = upstream.get(url=f"{layer_url}/query", params={'where': '1=1', 'returnCountOnly': 'true', 'f': 'json'})
+        feature_count = r.json().get('count')
+        r = upstream.get(url=layer_url, params={'f': 'json'})
+        last_edit_date = (r.json().get('editingInfo') or {}).get('lastEditDate')
+        return feature_count, r.headers.get('ETag'), last_edit_date and str(last_edit_date)
+    else:
+        params = {
+            'request':    'GetFeature',
+            'service':    'WFS',
+            'version':    '2.0.0',
+            'typeNames':  layer.layer_name,
+            'resultType': 'hits',
+        }
+        r = upstream.get(url=server_url, params=params)
+        match = re.search(r'numberMatched="(\d+)"', r.text)
+        return match and int(match.group(1)), r.headers.get('ETag'), r.headers.get('Last-Modified')
+
+
+def is_unchanged(fingerprint, feature_count, etag, last_modified):
+    "Whether a layer's count and change markers show it's unchanged since its fingerprint; without markers, we can't tell"
+    if not fingerprint or feature_count is None or feature_count != fingerprint['feature_count']:
+        return False
+    if not (etag or last_modified):
+        return False
+    return (etag, last_modified) == (fingerprint['etag'], fingerprint['last_modified'])
+
+
+def index_layer(layer, server_url, log_id, result_offset, running_hash):
+    """
+    Indexes a layer's features from result_offset onwards.  Each page's
+    features are inserted in the same transaction as the checkpoint of
+    the layer's offset (and geometry hash), while the next page is being
+    fetched.
+
+    Returns:
+        tuple: (feature_count, geometry_hash) of all the layer's features
+    """
+    connection = connections['transects']
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        page = prefetcher.submit(get_features, layer, server_url, result_offset)
+        while page:
+            features, exceeded_transfer_limit, feature_count = page.result()
+            page = (
+                prefetcher.submit(get_features, layer, server_url, result_offset + feature_count)
+                if exceeded_transfer_limit else
+                None
+            )
+
+            logging.info(f"Adding {len(features)} features of {layer} ({layer.id}) at offset {result_offset} to spatial index...")
+            result_offset += feature_count
+            running_hash = geometry_hash(features, running_hash)
+            with transaction.atomic(using='transects'):
+                insert_features(features, connection.connection)
+                with connection.cursor() as cursor:
+                    cursor.execute(SQL_CHECKPOINT_LAYER_FEATURE_LOG, [result_offset, running_hash, log_id])
+    return result_offset, running_hash
+
+
+def process_layer(layer, build_id, checkpoint, fingerprint, incremental):
+    """
+    Indexes a layer (resuming from its checkpoint, if any) and logs the
+    outcome, along with the layer's new fingerprint.  In incremental
+    mode, a layer whose change markers match its fingerprint isn't
+    retrieved at all, and a layer whose retrieved features match its
+    fingerprint isn't marked as changed.
+    """
+    try:
+        with connections['transects'].cursor() as cursor:
+            if checkpoint:
+                log_id, result_offset, running_hash = checkpoint
+            else:
+                cursor.execute(SQL_START_LAYER_FEATURE_LOG, [layer.id, build_id])
+                log_id, result_offset, running_hash = cursor.fetchone()[0], 0, EMPTY_GEOMETRY_HASH
+
+        try:
+            server_url = layer.server_url
+            if re.search(r'^(.+?)/services/(.+?)/MapServer/.+$', server_url):
+                server_url = mapserver_layer_query_url(layer)
+
+            # Change markers are only needed (and recorded) by incremental
+            # builds; a full build's layers are rechecked feature by
+            # feature by the next incremental build
+            upstream_count, etag, last_modified = None, None, None
+            if incremental:
+                try:
+                    upstream_count, etag, last_modified = get_layer_version(layer, server_url)
+                except Exception as e:
+                    logging.warning(f"Could not retrieve version of layer {layer.id}", exc_info=e)
+
+            if incremental and not checkpoint and is_unchanged(fingerprint, upstream_count, etag, last_modified):
+                logging.info(f"Layer {layer.id} is unchanged")
+                feature_count, layer_hash, changed = fingerprint['feature_count'], fingerprint['geometry_hash'], False
+            else:
+                feature_count, layer_hash = index_layer(layer, server_url, log_id, result_offset, running_hash)
+                changed = not (
+                    incremental and fingerprint and
+                    (feature_count, layer_hash) == (fingerprint['feature_count'], fingerprint['geometry_hash'])
+                )
+        except Exception as e:
+            logging.error(f"Error processing layer {layer.id}", exc_info=e)
+            exception_traceback = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+            with connections['transects'].cursor() as cursor:
+                cursor.execute(SQL_ERROR_LAYER_FEATURE_LOG, [str(e), exception_traceback, log_id])
+        else:
+            logging.info(f"Successfully processed layer {layer.id}" + ("" if changed else " (unchanged)"))
+            with transaction.atomic(using='transects'), connections['transects'].cursor() as cursor:
+                cursor.execute(SQL_INSERT_LAYER_FEATURE_FINGERPRINT_TEMP, [layer.id, feature_count, layer_hash, etag, last_modified, changed])
+                cursor.execute(SQL_FINISH_LAYER_FEATURE_LOG, [log_id])
+    except Exception as e:
+        logging.error(f"Error logging layer {layer.id}", exc_info=e)
+    finally:
+        # Connections are per-thread; return this worker's to the pool
+        connections['transects'].close()
+
+
+# Builds the feature index in one process, replacing
+# build_feature_index_start, build_feature_index_layer (per layer) and
+# build_feature_index_end.  Layers are processed concurrently, and
+# progress is checkpointed in layer_feature_log so an interrupted build
+# can be continued with --resume.  With --incremental, only layers whose
+# features have changed since the last build are replaced.
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--layer_id',
+            action='append',
+            type=int,
+            help="Index only this layer (may be repeated)"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help="Number of layers to index concurrently"
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help="Continue the most recent build from its checkpoints, instead of starting a new one"
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help="Only replace the features of layers that have changed, without rebuilding the spatial index"
+        )
+
+    def handle(self, *args, **options):
+        layers = Layer.objects.all()
+        if options['layer_id']:
+            layers = layers.filter(id__in=options['layer_id'])
+
+        checkpoints = {}
+        with connections['transects'].cursor() as cursor:
+            build_id = None
+            if options['resume']:
+                cursor.execute(SQL_GET_LATEST_BUILD_ID)
+                row = cursor.fetchone()
+                build_id = row and str(row[0])
+                if build_id is None:
+                    logging.warning("No build to resume; starting a new build")
+
+            if build_id:
+                cursor.execute(SQL_GET_BUILD_CHECKPOINTS, [build_id])
+                for layer_id, log_id, result_offset, running_hash, finished in cursor.fetchall():
+                    checkpoints[layer_id] = None if finished else (log_id, result_offset or 0, running_hash or EMPTY_GEOMETRY_HASH)
+                logging.info(f"Resuming build {build_id}")
+            else:
+                build_id = str(uuid.uuid4())
+                cursor.execute(SQL_TRUNCATE_LAYER_FEATURE_TEMP)
+                cursor.execute(SQL_TRUNCATE_LAYER_FEATURE_FINGERPRINT_TEMP)
+                logging.info(f"Starting build {build_id}")
+
+            cursor.execute(SQL_GET_LAYER_FEATURE_FINGERPRINTS)
+            fingerprints = {
+                row[0]: dict(zip(['feature_count', 'geometry_hash', 'etag', 'last_modified'], row[1:]))
+                for row in cursor.fetchall()
+            }
+
+        # Layers that finished in the build being resumed are skipped
+        layers = [layer for layer in layers if layer.id not in checkpoints or checkpoints[layer.id]]
+        logging.info(f"Indexing {len(layers)} layers with {options['workers']} workers")
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for layer in layers:
+                executor.submit(process_layer, layer, build_id, checkpoints.get(layer.id), fingerprints.get(layer.id), options['incremental'])
+
+        call_command('build_feature_index_end', incremental=options['incremental'])
@@ -1,20 +1,18 @@
 import logging
+import uuid
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.db import connections
 
 from catalogue.emails import email_build_feature_index_summary, LayerFeatureIndexError
+from habitat.viewsets import LAYER_FEATURE_VERSION_CACHE_KEY
 
-# Ends insertion of features by updating the geoms for each row of
-# layer_feature_temp, since they are inserted without a SRID due to
-# fast_executemany limitations
-# (https://github.com/mkleehammer/pyodbc/issues/490#issuecomment-445918375).
-# Copies layer_feature_temp into layer_feature, overriding the layers present in
-# layer_feature_temp.
+# Ends insertion of features by copying layer_feature_temp into
+# layer_feature, overriding the layers present in layer_feature_temp
+# (features are inserted with their SRID set, and made valid).
 # Rebuilds spatial index.
 SQL_REENABLE_SPATIAL_INDEX = """
-UPDATE layer_feature_temp SET geom.STSrid = 4326;
-UPDATE layer_feature_temp SET geom = geom.MakeValid();
 ALTER INDEX layer_geom ON layer_feature DISABLE;
 
 DELETE FROM layer_feature
@@ -29,6 +27,82 @@ SELECT layer_id, geom FROM layer_feature_temp;
 ALTER INDEX layer_geom ON layer_feature REBUILD;
 """
 
+# Incremental alternative to SQL_REENABLE_SPATIAL_INDEX: only replaces
+# the layers that a build found to have changed, and leaves the spatial
+# index enabled (so it is maintained row-by-row rather than rebuilt).
+SQL_REPLACE_CHANGED_LAYERS = """
+DECLARE @changed TABLE (layer_id INT PRIMARY KEY);
+INSERT INTO @changed
+SELECT layer_id
+FROM layer_feature_fingerprint_temp
+WHERE changed = 1;
+
+BEGIN TRANSACTION;
+
+DELETE FROM layer_feature
+WHERE layer_id IN (SELECT layer_id FROM @changed);
+
+INSERT INTO layer_feature (layer_id, geom)
+SELECT layer_id, geom
+FROM layer_feature_temp
+WHERE layer_id IN (SELECT layer_id FROM @changed);
+
+COMMIT;
+"""
+
+# Rebuilds the footprints (see layer_feature_footprint) of the layers in
+# the {layers} subquery, and of any layer in layer_feature without
+# footprints; {tolerances} is a VALUES list of the footprint tolerances.
+SQL_BUILD_LAYER_FEATURE_FOOTPRINTS = """
+DECLARE @layers TABLE (layer_id INT PRIMARY KEY);
+INSERT INTO @layers
+SELECT layer_id FROM ({layers}) AS rebuilt
+UNION
+SELECT DISTINCT layer_id
+FROM layer_feature
+WHERE layer_id NOT IN (SELECT layer_id FROM layer_feature_footprint);
+
+DELETE FROM layer_feature_footprint
+WHERE layer_id IN (SELECT layer_id FROM @layers);
+
+INSERT INTO layer_feature_footprint (layer_id, tolerance, geom)
+SELECT layer_id, tolerance, geom
+FROM (
+  SELECT
+    layer_feature.layer_id,
+    tolerances.tolerance,
+    geometry::UnionAggregate(layer_feature.geom.Reduce(tolerances.tolerance).MakeValid().STBuffer(tolerances.tolerance)) AS geom
+  FROM layer_feature
+  CROSS JOIN (VALUES {tolerances}) AS tolerances(tolerance)
+  WHERE layer_feature.layer_id IN (SELECT layer_id FROM @layers)
+  GROUP BY layer_feature.layer_id, tolerances.tolerance
+) AS footprints
+WHERE geom IS NOT NULL;
+"""
+
+# The layers replaced by SQL_REENABLE_SPATIAL_INDEX and
+# SQL_REPLACE_CHANGED_LAYERS respectively
+SQL_REBUILT_LAYERS = "SELECT DISTINCT layer_id FROM layer_feature_temp"
+SQL_CHANGED_LAYERS = "SELECT layer_id FROM layer_feature_fingerprint_temp WHERE changed = 1"
+
+# Records the fingerprints of the layers retrieved by the build, for
+# the next incremental build to compare against.
+SQL_MERGE_LAYER_FEATURE_FINGERPRINTS = """
+MERGE layer_feature_fingerprint AS target
+USING layer_feature_fingerprint_temp AS source
+ON target.layer_id = source.layer_id
+WHEN MATCHED THEN
+  UPDATE SET
+    feature_count = source.feature_count,
+    geometry_hash = source.geometry_hash,
+    etag = source.etag,
+    last_modified = source.last_modified,
+    timestamp = GETDATE()
+WHEN NOT MATCHED THEN
+  INSERT (layer_id, feature_count, geometry_hash, etag, last_modified)
+  VALUES (source.layer_id, source.feature_count, source.geometry_hash, source.etag, source.last_modified);
+"""
+
 # Pulls the latest error for each layer from layer_feature_log.
 SQL_GET_FEATURE_INDEX_LOG_LATEST = """
 SELECT
@@ -48,10 +122,27 @@ WHERE
 """
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help="Only replace the layers that build_feature_index found to have changed, without rebuilding the spatial index"
+        )
+
     def handle(self, *args, **options):
         try:
             with connections['transects'].cursor() as cursor:
-                cursor.execute(SQL_REENABLE_SPATIAL_INDEX)
+                cursor.execute(SQL_REPLACE_CHANGED_LAYERS if options['incremental'] else SQL_REENABLE_SPATIAL_INDEX)
+                cursor.execute(SQL_MERGE_LAYER_FEATURE_FINGERPRINTS)
+                cursor.execute(
+                    SQL_BUILD_LAYER_FEATURE_FOOTPRINTS.format(
+                        layers=SQL_CHANGED_LAYERS if options['incremental'] else SQL_REBUILT_LAYERS,
+                        tolerances=', '.join(f'({float(tolerance)})' for tolerance in settings.LAYER_FEATURE_FOOTPRINT_TOLERANCES)
+                    )
+                )
+            # Have data_in_region reload its layer footprints
+            cache.set(LAYER_FEATURE_VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+            with connections['transects'].cursor() as cursor:
                 if settings.IS_PRODUCTION:
                     cursor.execute(SQL_GET_FEATURE_INDEX_LOG_LATEST)
                     errors = [LayerFeatureIndexError(*row) for row in cursor.fetchall()]
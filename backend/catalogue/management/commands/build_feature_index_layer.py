@@ -2,40 +2,27 @@ from collections import namedtuple
 import logging
 import re
 
-from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import connections
-from requests.adapters import HTTPAdapter, Retry
-from shapely.geometry import shape, Polygon, LineString, MultiPolygon, MultiLineString
-from shapely.geometry.base import BaseGeometry
+from django.db import connections, transaction
+from shapely import wkb
+from shapely.geometry import shape
 import pyodbc
-import requests
 import traceback
 
 from catalogue.models import Layer
+from webapp import upstream
 
 
 LayerFeature = namedtuple('LayerFeature', 'layer_id geom')
 
-# Inserts a layer feature row; geom is added in binary MS-SSCLRT format
-SQL_INSERT_LAYER_FEATURE = "INSERT INTO layer_feature_temp ( layer_id, geom ) VALUES ( ?, ? );"
+# Inserts a layer feature row from its WKB; the SRID is set and the
+# geometry made valid as part of the insert
+SQL_INSERT_LAYER_FEATURE = "INSERT INTO layer_feature_temp ( layer_id, geom ) VALUES ( ?, geometry::STGeomFromWKB(?, 4326).MakeValid() );"
 
 # Inserts a layer feature log into the layer feature log table
 SQL_LAYER_FEATURE_LOG = "INSERT INTO layer_feature_log ( layer_id, error, traceback ) VALUES ( %s, %s, %s );"
 
 
-def http_session():
-    retry_strategy = Retry(
-        total=3,
-        status_forcelist=[ 500, 502, 503, 504 ]
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.Session()
-    http.mount("https://", adapter)
-    http.mount("http://", adapter)
-    return http
-
-
 def mapserver_layer_match(mapserver_layer, layer):
     # "Fishing Block [DPIPWE]" will match with "Fishing_Block__DPIPWE_62889"
     return re.sub(
@@ -66,7 +53,7 @@ def mapserver_layer_query_url(layer):
         map_server_url = f'{match.group(1)}/rest/services/{match.group(2)}/MapServer'
 
     try:
-        r = requests.get(url=f"{map_server_url}/layers", params={'dynamicLayers': '1=1', 'f': 'json'})
+        r = upstream.get(url=f"{map_server_url}/layers", params={'dynamicLayers': '1=1', 'f': 'json'}, cache=True)
     except Exception as e:
         raise Exception(f"Cannot retrieve data from mapserver ({map_server_url})") from e
     
@@ -93,7 +80,19 @@ def mapserver_layer_query_url(layer):
     
     return f"{map_server_url}/{server_layer['id']}/query"
 
-def get_geoserver_geojson(layer: Layer, server_url: str, result_offset: int = 0):
+def layer_feature(layer, feature):
+    # WKB is serialised by GEOS, which also drops any Z values:
+    return LayerFeature(
+        layer.id,
+        wkb.dumps(shape(feature['geometry']), output_dimension=2)
+    )
+
+def get_geoserver_features(layer: Layer, server_url: str, result_offset: int = 0):
+    """
+    A page of the layer's features from a geoserver WFS GetFeature, as
+    (features, has_next, feature_count) (see get_features). The response
+    is streamed, and each feature converted to WKB as it's parsed.
+    """
     params = {
         'request':      'GetFeature',
         'service':      'WFS',
@@ -107,7 +106,7 @@ def get_geoserver_geojson(layer: Layer, server_url: str, result_offset: int = 0)
     }
 
     try:
-        r = http_session().get(url=server_url, params=params)
+        geojson_features = upstream.get_geojson(url=server_url, params=params)
     except Exception as e:
         try:
             get_feature_is_supported = layer.get_feature_is_supported()
@@ -118,18 +117,24 @@ def get_geoserver_geojson(layer: Layer, server_url: str, result_offset: int = 0)
         else:
             raise Exception(f"GetFeature operation is not supported for {layer.layer_name} on geoserver ({server_url})") from e
 
+    features = []
+    feature_count = 0
     try:
-        data = r.json()
+        with geojson_features:
+            for feature in geojson_features:
+                feature_count += 1
+                if feature['geometry']:
+                    features.append(layer_feature(layer, feature))
     except Exception as e:
         raise Exception(f"Could not decode geoserver response into JSON") from e
 
     try:
-        assert not data.get('error')
+        assert not geojson_features.members.get('error')
     except AssertionError as e:
         raise Exception(f"GeoJSON contains an error") from e
     
     try:
-        assert data.get('features')
+        assert feature_count
     except AssertionError as e:
         raise Exception(f"No features found in the GeoJSON") from e
 
@@ -138,9 +143,9 @@ def get_geoserver_geojson(layer: Layer, server_url: str, result_offset: int = 0)
     # more data to come or not. I think we may end up
     # making an extra call, for no data, but in the scheme
     # of things that's no great drama.
-    links = data.get('links', [])
+    links = geojson_features.members.get('links', [])
     has_next = any(link.get('rel') == 'next' for link in links)
-    return data, has_next
+    return features, has_next, feature_count
 
 
 def get_mapserver_geojson(server_url, result_offset=0):
@@ -151,7 +156,7 @@ def get_mapserver_geojson(server_url, result_offset=0):
     }
 
     try:
-        r = requests.get(url=server_url, params=params)
+        r = upstream.get(url=server_url, params=params)
     except Exception as e:
         raise Exception(f"Cannot retrieve GeoJSON from mapserver ({server_url})") from e
 
@@ -181,7 +186,7 @@ def get_featureserver_geojson(server_url, result_offset=0):
     }
 
     try:
-        r = requests.get(url=url, params=params)
+        r = upstream.get(url=url, params=params)
     except Exception as e:
         raise Exception(f"Cannot retrieve GeoJSON from featureserver ({url})") from e
 
@@ -202,58 +207,41 @@ def get_featureserver_geojson(server_url, result_offset=0):
 
     return data, data.get('exceededTransferLimit', False)
 
-def strip_z_values(geometry: BaseGeometry) -> BaseGeometry:
-    """
-    Remove Z values from any Shapely geometry type.
-
-    Args:
-        geometry (BaseGeometry): The Shapely geometry to process.
-
-    Returns:
-        BaseGeometry: A new Shapely geometry with Z values stripped.
-    """
-    if geometry.has_z:
-        if isinstance(geometry, Polygon):
-            coords_2d = [(x, y) for x, y, z in geometry.exterior.coords]
-            new_geom = Polygon(coords_2d)
-            return new_geom
-        elif isinstance(geometry, LineString):
-            coords_2d = [(x, y) for x, y, z in geometry.coords]
-            return LineString(coords_2d)
-        elif isinstance(geometry, MultiPolygon):
-            new_geoms = [Polygon([(x, y) for x, y, z in poly.exterior.coords]) for poly in geometry]
-            return MultiPolygon(new_geoms)
-        elif isinstance(geometry, MultiLineString):
-            new_geoms = [LineString([(x, y) for x, y, z in line.coords]) for line in geometry]
-            return MultiLineString(new_geoms)
-    return geometry
-
 def get_features(layer, server_url, result_offset=0):
     if re.search(r'^(.+?)/services/(.+?)/MapServer/.+$', server_url):
         geojson, exceeded_transfer_limit = get_mapserver_geojson(server_url, result_offset)
     elif re.search(r'^(.+?)/services/(.+?)/FeatureServer/.+$', server_url):
         geojson, exceeded_transfer_limit = get_featureserver_geojson(server_url, result_offset)
     else:
-        geojson, exceeded_transfer_limit = get_geoserver_geojson(layer, server_url, result_offset)
+        return get_geoserver_features(layer, server_url, result_offset)
 
     features = [
-        LayerFeature(
-            layer.id,
-            strip_z_values(shape(feature['geometry'])).wkt
-        )
+        layer_feature(layer, feature)
         for feature in geojson['features']
         if feature['geometry']
     ]
 
-    return features, exceeded_transfer_limit
+    # Features without geometry are skipped, but still count towards
+    # the offset of the next page:
+    return features, exceeded_transfer_limit, len(geojson['features'])
 
 
 def insert_features(features, conn):
+    # Uses the raw pyodbc connection for fast_executemany; callers
+    # manage the transaction (a pyodbc cursor's context manager would
+    # commit on exit)
+    if not features:
+        return
     try:
-        with conn.cursor() as cursor:
+        cursor = conn.cursor()
+        try:
             cursor.fast_executemany = True
-            cursor.setinputsizes([None, (pyodbc.SQL_WVARCHAR, 0, 0)])
+            # Explicit sizes, since the driver can't describe a parameter
+            # to a function call
+            cursor.setinputsizes([(pyodbc.SQL_INTEGER, 0, 0), (pyodbc.SQL_VARBINARY, 0, 0)])
             cursor.executemany(SQL_INSERT_LAYER_FEATURE, features)
+        finally:
+            cursor.close()
     except Exception as e:
         raise Exception("Unable to insert features") from e
 
@@ -264,18 +252,11 @@ def process_layer(layer):
         server_url = mapserver_layer_query_url(layer)
 
     result_offset = 0
-    conn = None
+    # Raw pyodbc connection (pooled, if the database is configured to
+    # be), for fast_executemany
+    connection = connections['default']
+    connection.ensure_connection()
     try:
-        conn = pyodbc.connect(
-            "Driver={" +
-            settings.DATABASES['default']['OPTIONS']['driver'] + "};"
-            "Server=" + settings.DATABASES['default']['HOST'] + ";"
-            "Database=" + settings.DATABASES['default']['NAME'] + ";"
-            "UID=" + settings.DATABASES['default']['USER'] + ";"
-            "PWD=" + settings.DATABASES['default']['PASSWORD'] + ";"
-            "Trusted_Connection=no;"
-        )
-
         exceeded_transfer_limit = True
         while exceeded_transfer_limit:
             logging.info(
@@ -283,18 +264,15 @@ def process_layer(layer):
                 if result_offset > 0 else
                 f"Retrieving {layer} ({layer.id}) features..."
             )
-            features, exceeded_transfer_limit = get_features(layer, server_url, result_offset)
+            features, exceeded_transfer_limit, feature_count = get_features(layer, server_url, result_offset)
 
             logging.info(f"Adding {len(features)} features to spatial index...")
-            insert_features(features, conn)
+            with transaction.atomic(using='default'):
+                insert_features(features, connection.connection)
 
-            result_offset += len(features)
-    except Exception as e:
-        raise e
+            result_offset += feature_count
     finally:
-        if conn:
-            conn.close()
-
+        connection.close()
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
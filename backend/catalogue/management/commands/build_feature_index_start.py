@@ -7,6 +7,9 @@ from catalogue.models import Layer
 # Clears the temp layer feature table
 SQL_TRUNCATE_LAYER_FEATURE_TEMP = "TRUNCATE TABLE layer_feature_temp;"
 
+# Clears the temp layer feature fingerprint table
+SQL_TRUNCATE_LAYER_FEATURE_FINGERPRINT_TEMP = "TRUNCATE TABLE layer_feature_fingerprint_temp;"
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -19,6 +22,7 @@ class Command(BaseCommand):
         try:
             with connections['transects'].cursor() as cursor:
                 cursor.execute(SQL_TRUNCATE_LAYER_FEATURE_TEMP)
+                cursor.execute(SQL_TRUNCATE_LAYER_FEATURE_FINGERPRINT_TEMP)
         except Exception as e:
             logging.error('Error at %s', 'division', exc_info=e)
         else:
@@ -6,13 +6,13 @@
 Management command to generate layer previews.
 """
 import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import functools
 import logging
 import re
+import time
 from io import BytesIO
-from urllib.error import HTTPError
 from urllib.parse import urlencode
-import urllib.request
 
 import geopandas
 import geoplot
@@ -21,11 +21,14 @@ import matplotlib.pyplot as plt
 import numpy
 import rasterio
 import requests
+from catalogue import basemap
 from catalogue.emails import email_generate_layer_preview_summary
 from catalogue.models import Layer
+from django.conf import settings
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
+from django.db import connections
 from matplotlib.image import BboxImage
 from matplotlib.transforms import Bbox, TransformedBbox
 from PIL import Image, UnidentifiedImageError
@@ -33,6 +36,8 @@ from pyproj import CRS, Transformer
 from rasterio import transform, warp
 from shapely.geometry import (LineString, MultiLineString, MultiPolygon,
                               Polygon, shape)
+from webapp import upstream
+from webapp.mssql_pool.base import get_pool
 
 # pylint: disable=line-too-long
 # pylint: disable=missing-function-docstring
@@ -41,13 +46,9 @@ from shapely.geometry import (LineString, MultiLineString, MultiPolygon,
 
 Image.MAX_IMAGE_PIXELS = None
 
-# We not able to simply *add* the basemap image file to our GitHub tracking, as it's too large.
-# For now, the image will be added to deployments manually.
-BASEMAP_FILEPATH = default_storage.path('land_shallow_topo_21600.tif')
-BASEMAP_CRS = 'EPSG:4326'
-BASEMAP_BOUNDS = (-180, -90, 180, 90)
 DST_WIDTH = 386
 
+
 def get_deltas_from_projected_bounds(min_x: float, min_y: float, max_x: float, max_y: float, crs: str) -> tuple:
     """
     Get the x and y deltas from the projected bounds.
@@ -109,7 +110,9 @@ def get_projected_layer_bounds(layer: Layer, target_crs: str) -> tuple:
 
 def get_basemap_cropped_basemap_image(min_x: float, min_y: float, max_x: float, max_y: float, target_crs: str) -> Image:
     """
-    Generate a cropped basemap image in the target CRS.
+    Generate a cropped basemap image in the target CRS, read from the
+    target CRS's basemap pyramid (see build_basemap_pyramid) if it has been
+    built.
 
     Args:
         min_x (float): Minimum x coordinate (in target CRS)
@@ -123,42 +126,7 @@ def get_basemap_cropped_basemap_image(min_x: float, min_y: float, max_x: float,
     """
     dst_resolution = (max_x - min_x) / DST_WIDTH
     dst_height = int((max_y - min_y) / dst_resolution)
-    dst_transform = transform.from_bounds(min_x, min_y, max_x, max_y, DST_WIDTH, dst_height)
-    with rasterio.open(BASEMAP_FILEPATH) as basemap_src:
-        src_crs = rasterio.crs.CRS.from_string(BASEMAP_CRS)
-        src_transform = transform.from_bounds(*BASEMAP_BOUNDS, width=basemap_src.width, height=basemap_src.height)
-        profile = basemap_src.profile.copy()
-        profile.update({
-            "crs": target_crs,
-            "transform": dst_transform,
-            "width": DST_WIDTH,
-            "height": dst_height,
-        })
-        dst_arrays = []
-        for i in range(1, basemap_src.count + 1): # Iterate over each band (e.g. R, G, B, A)
-            src_array = basemap_src.read(i)
-            dst_array = numpy.empty((dst_height, DST_WIDTH), dtype=src_array.dtype)
-
-            warp.reproject(
-                src_array,
-                dst_array,
-                src_transform=src_transform,
-                src_crs=src_crs,
-                dst_transform=dst_transform,
-                dst_crs=target_crs,
-                resampling=warp.Resampling.bilinear,
-            )
-
-            dst_arrays.append(dst_array)
-
-        # Create PIL Image from the reprojected data
-        mode_map = {1: 'L', 3: 'RGB', 4: 'RGBA'}
-        mode = mode_map.get(basemap_src.count, 'L')
-        if basemap_src.count == 1:
-            bands_array = dst_arrays[0].astype('uint8')
-        else:
-            bands_array = numpy.dstack(dst_arrays).astype('uint8')
-        return Image.fromarray(bands_array, mode=mode)
+    return basemap.cropped_basemap_image(min_x, min_y, max_x, max_y, target_crs, DST_WIDTH, dst_height)
 
 
 def reproject_image(min_x: float, min_y: float, max_x: float, max_y: float, image: Image, target_crs: str) -> Image:
@@ -290,10 +258,39 @@ def subdivide_requests(layer: Layer, target_crs: str, horizontal_subdivisions: i
 
     return urls
 
+def retrieve_tile_image(url: str) -> Image:
+    """
+    Retrieve a WMS GetMap image. Timeouts and 5xx responses are already
+    retried by webapp.upstream, and 4xx responses won't succeed on retry,
+    so only a response that isn't an image (e.g. a transient WMS service
+    exception) is retried here, with backoff, up to
+    LAYER_PREVIEW_TILE_ATTEMPTS times.
+
+    Args:
+        url (str): The GetMap URL.
+
+    Returns:
+        Image: The retrieved image, as RGBA.
+    """
+    for attempt in range(1, settings.LAYER_PREVIEW_TILE_ATTEMPTS + 1):
+        try:
+            response = upstream.get(url, timeout=settings.LAYER_PREVIEW_TILE_TIMEOUT) # Sent with the user agent Squidle geoserver requires (ISA-694, ISA-598)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise RuntimeError(f"URL {url} returned an error response") from e
+        try:
+            return Image.open(BytesIO(response.content)).convert('RGBA')
+        except UnidentifiedImageError as e:
+            if attempt == settings.LAYER_PREVIEW_TILE_ATTEMPTS:
+                raise RuntimeError(f"Response from URL {url} could not be converted to an image") from e
+            logging.warning("Retrying tile %s (attempt %s failed)", url, attempt, exc_info=e)
+            time.sleep(2 ** (attempt - 1))
+
 def geoserver_retrieve_image(layer: Layer, target_crs: str, horizontal_subdivisions: int=1, vertical_subdivisions: int=1) -> Image:
     """
     Retrieve a WMS layer image from GeoServer.
     If horizontal_subdivisions and vertical_subdivisions are provided, the image is retrieved in multiple requests and stitched together.
+    The requests are made concurrently (LAYER_PREVIEW_TILE_WORKERS at a time), and each sub-image is pasted as it arrives.
 
     Args:
         layer (Layer): The layer to retrieve the image for.
@@ -311,29 +308,28 @@ def geoserver_retrieve_image(layer: Layer, target_crs: str, horizontal_subdivisi
 
     urls = subdivide_requests(layer, target_crs, horizontal_subdivisions, vertical_subdivisions)
 
-    for i, h_urls in enumerate(urls):
-        for j, url in enumerate(h_urls):
-            try:
-                request = urllib.request.Request(url, headers={'User-Agent': 'SeamapBackend/1.0'}) # Squidle geoserver requires a user agent (ISA-694, ISA-598)
-                response = urllib.request.urlopen(request)
-            except HTTPError as e:
-                raise RuntimeError(f"URL {url} returned an error response") from e
-
-            try:
-                sub_image = Image.open(response)
-            except UnidentifiedImageError as e:
-                raise RuntimeError(f"Response from URL {url} could not be converted to an image") from e
-
-            sub_image = sub_image.convert('RGBA')
-
-            image.paste(
-                sub_image,
-                (
-                    (width // horizontal_subdivisions) * i,
-                    height - (height // vertical_subdivisions) * j - sub_image.height
-                ),
-                sub_image
-            )
+    with ThreadPoolExecutor(max_workers=settings.LAYER_PREVIEW_TILE_WORKERS) as executor:
+        tiles = {
+            executor.submit(retrieve_tile_image, url): (i, j)
+            for i, h_urls in enumerate(urls)
+            for j, url in enumerate(h_urls)
+        }
+        try:
+            for tile in as_completed(tiles):
+                ( i, j ) = tiles[tile]
+                sub_image = tile.result()
+
+                image.paste(
+                    sub_image,
+                    (
+                        (width // horizontal_subdivisions) * i,
+                        height - (height // vertical_subdivisions) * j - sub_image.height
+                    ),
+                    sub_image
+                )
+        finally:
+            for tile in tiles:
+                tile.cancel()
     return image
 
 def wms_layer_image(layer: Layer, target_crs: str, horizontal_subdivisions: int, vertical_subdivisions: int) -> Image:
@@ -490,16 +486,17 @@ def mapserver_feature_layer_image(layer: Layer, target_crs: str) -> Image:
     aspect_ratio = x_delta / y_delta
 
     if renderer_type == 'simple':
-        geojson = layer.geojson()
+        features = layer.iter_geojson_features()
     elif renderer_type == 'uniqueValue':
-        geojson = layer.geojson(out_fields='*')
+        features = layer.iter_geojson_features(out_fields='*')
     else:
         raise ValueError(f"renderer_type '{renderer_type}' not handled")
 
-    for feature in geojson['features']:
-        feature['properties'] = feature['properties'] or {}
-
-    gdf = geopandas.GeoDataFrame.from_features(geojson['features'])
+    # Features are streamed into the GeoDataFrame as they're retrieved
+    gdf = geopandas.GeoDataFrame.from_features(
+        {**feature, 'properties': feature['properties'] or {}}
+        for feature in features
+    )
     gdf.columns = gdf.columns.str.lower()
     ax = None
 
@@ -638,11 +635,11 @@ def mapserver_raster_layer_image(layer: Layer, target_crs) -> Image:
         'layers': f'show:{map_server_layer_id}',
         'f': 'image'
     }
-    response = requests.get(f"{map_server_url}/export", params=image_url_params, verify=False, stream=True, timeout=30)
-    response.raise_for_status()
+    with upstream.get(f"{map_server_url}/export", params=image_url_params, verify=False, stream=True, timeout=30) as response:
+        response.raise_for_status()
 
-    image = Image.open(response.raw)
-    image = image.convert('RGBA')
+        image = Image.open(response.raw)
+        image = image.convert('RGBA')
     return image
 
 def mapserver_layer_image(layer: Layer, target_crs) -> Image:
@@ -685,6 +682,58 @@ def generate_layer_preview(layer: Layer, target_crs: str, horizontal_subdivision
         bytes_io.seek(0)
         default_storage.save(filepath, File(bytes_io))
 
+def init_worker(target_crs: str) -> None:
+    "Initialises a preview worker process: opens the basemap for its previews to share"
+    basemap.basemap_dataset(target_crs)
+
+
+def close_database_connections() -> None:
+    """
+    Closes the database connections of this process, including those idle
+    in the connection pools, so forked worker processes don't inherit (and
+    share) them.
+    """
+    connections.close_all()
+    for alias in connections:
+        pool = get_pool(alias)
+        if pool:
+            pool.close_idle()
+
+
+def generate_layer_previews(layers: list[Layer], target_crs: str, horizontal_subdivisions: int, vertical_subdivisions: int, workers: int) -> list[dict]:
+    """
+    Generate the layer preview of each of the given layers, with up to
+    `workers` processes, each of which opens the basemap once.
+
+    Returns:
+        list[dict]: The layers that failed, as dicts of 'layer' and exception 'e'.
+    """
+    errors = []
+
+    if workers <= 1:
+        for layer in layers:
+            try:
+                generate_layer_preview(layer, target_crs, horizontal_subdivisions, vertical_subdivisions)
+            except Exception as e: # pylint: disable=broad-except
+                logging.error("Error processing layer %s", layer.id, exc_info=e)
+                errors.append({'layer': layer, 'e': e})
+        return errors
+
+    close_database_connections()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(target_crs,)) as executor:
+        futures = {
+            executor.submit(generate_layer_preview, layer, target_crs, horizontal_subdivisions, vertical_subdivisions): layer
+            for layer in layers
+        }
+        for future in as_completed(futures):
+            layer = futures[future]
+            try:
+                future.result()
+            except Exception as e: # pylint: disable=broad-except
+                logging.error("Error processing layer %s", layer.id, exc_info=e)
+                errors.append({'layer': layer, 'e': e})
+    return errors
+
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
@@ -714,6 +763,12 @@ class Command(BaseCommand):
             type=str,
             default='EPSG:4326',
         )
+        parser.add_argument(
+            '--workers',
+            help='Number of processes to generate layer previews with concurrently',
+            type=int,
+            default=1,
+        )
 
     def handle(self, *args, **options):
         layer_id = options['layer_id']
@@ -721,20 +776,16 @@ class Command(BaseCommand):
         horizontal_subdivisions = options['horizontal_subdivisions']
         vertical_subdivisions = options['vertical_subdivisions']
         target_crs = options['target_crs']
-        errors = []
+        layers = []
 
         if layer_id is not None:
             layer = Layer.objects.get(id=layer_id)
             filepath = f'layer_previews/{layer.id}.png'
 
             if not skip_existing or not default_storage.exists(filepath):
-                try:
-                    generate_layer_preview(layer, target_crs, horizontal_subdivisions, vertical_subdivisions)
-                except Exception as e: # pylint: disable=broad-except
-                    logging.error("Error processing layer %s", layer.id, exc_info=e)
-                    errors.append({'layer': layer, 'e': e})
+                layers.append(layer)
         else:
-            for layer in Layer.objects.all():
+            for layer in Layer.objects.select_related('server_type').all():
                 filepath = f'layer_previews/{layer.id}.png'
                 exists = default_storage.exists(filepath)
 
@@ -742,11 +793,9 @@ class Command(BaseCommand):
                 # If a preview does exist, only generate it if the layer has regenerate_preview
                 # set to True and we're not skipping existing previews.
                 if not exists or (layer.regenerate_preview and not skip_existing):
-                    try:
-                        generate_layer_preview(layer, target_crs, horizontal_subdivisions, vertical_subdivisions)
-                    except Exception as e: # pylint: disable=broad-except
-                        logging.error("Error processing layer %s", layer.id, exc_info=e)
-                        errors.append({'layer': layer, 'e': e})
+                    layers.append(layer)
+
+        errors = generate_layer_previews(layers, target_crs, horizontal_subdivisions, vertical_subdivisions, options['workers'])
 
         if errors:
             logging.warning(
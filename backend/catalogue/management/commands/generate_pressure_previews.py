@@ -2,44 +2,49 @@ from django.core.management.base import BaseCommand
 from django.core.files.storage import default_storage
 from django.core.files import File
 from django.conf import settings
-from urllib.request import urlopen
 from urllib.parse import urlencode
 from PIL import Image
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import math
 
+from catalogue import basemap
 from catalogue.models import KeyedLayer, RegionReport, Pressure
+from webapp import upstream
 
-Image.MAX_IMAGE_PIXELS = None
+# The largest image (in pixels, either way) retrieved to share between a
+# network's regions with --shared_fetch
+SHARED_IMAGE_MAX_SIZE = 4096
 
-# We not able to simply *add* the basemap image file to our GitHub tracking, as it's too large.
-# For now, the image will be added to deployments manually.
-basemap = Image.open(default_storage.open('land_shallow_topo_21600.tif'))
 
+def basemap_bbox(north, south, east, west, size):
+    """
+    The basemap cropped to a bbox (in EPSG:4326), at the given size.  The
+    basemap is opened on first use and reused for every region report,
+    and only the window of it covering the bbox is read (see
+    catalogue.basemap).
 
-def basemap_latitude_to_pixel(latitude):
-    t = 0.5 + (latitude / 360)
-    return round(basemap.width * t)
+    A bbox can cross the antimeridian (west > east), and get_bbox's
+    padding can take it past ±180°, so it's drawn in pieces, one for each
+    360° of longitude it covers.
+    """
+    if east <= west:
+        east += 360
+    image = Image.new('RGB', (size['width'], size['height']))
+    x_scale = size['width'] / (east - west)
 
-
-def basemap_longitude_to_pixel(longitude):
-    t = 0.5 - (longitude / 180)
-    return round(basemap.height * t)
-
-
-def basemap_bbox(north, south, east, west):
-    left = basemap_latitude_to_pixel(west)
-    right = basemap_latitude_to_pixel(east)
-    upper = basemap_longitude_to_pixel(north)
-    lower = basemap_longitude_to_pixel(south)
-
-    if (left > right):
-        left_img = basemap.crop((left, upper, basemap.width + right, lower))
-        right_img = basemap.crop((0, upper, right, lower))
-        left_img.paste(right_img, (left_img.width - right, 0))
-        return left_img
-    else:
-        return basemap.crop((left, upper, right, lower))
+    start = west
+    while start < east:
+        shift = math.floor((start + 180) / 360) * 360
+        end = min(east, shift + 180)
+        left = round((start - west) * x_scale)
+        right = round((end - west) * x_scale)
+        if right > left:
+            piece = basemap.cropped_basemap_image(start - shift, south, end - shift, north, 'EPSG:4326', right - left, size['height'])
+            image.paste(piece, (left, 0))
+        start = end
+    return image
 
 def get_layer_image(layer, bbox, size):
     sub_params = {
@@ -58,7 +63,9 @@ def get_layer_image(layer, bbox, size):
 
     url = f'{layer.server_url}?{urlencode(sub_params)}'
     logging.info(f'Retrieving layer image from: {url}')
-    image = Image.open(urlopen(url)).convert('RGBA')
+    r = upstream.get(url)
+    r.raise_for_status()
+    image = Image.open(BytesIO(r.content)).convert('RGBA')
     logging.info('Layer image retrieval complete')
     return image
 
@@ -80,12 +87,22 @@ def get_boundary_layer_image(layer, bbox, size, network, park):
 
     url = f'{layer.server_url}?{urlencode(sub_params)}'
     logging.info(f'Retrieving boundary layer image from: {url}')
-    image = Image.open(urlopen(url)).convert('RGBA')
+    r = upstream.get(url)
+    r.raise_for_status()
+    image = Image.open(BytesIO(r.content)).convert('RGBA')
     logging.info('Boundary layer image retrieval complete')
     return image
 
-def generate_pressure_preview(cropped_basemap, boundary_layer_image, pressure, bbox, size):
+def save_pressure_preview(cropped_basemap, boundary_layer_image, pressure, layer_image):
     filepath = f'pressure_previews/{pressure.id}.png'
+    cropped_basemap.paste(layer_image, None, layer_image)
+    cropped_basemap.paste(boundary_layer_image, None, boundary_layer_image)
+    with BytesIO() as bytes_io:
+        cropped_basemap.save(bytes_io, 'PNG')
+        default_storage.delete(filepath)
+        default_storage.save(filepath, File(bytes_io, ''))
+
+def generate_pressure_preview(cropped_basemap, boundary_layer_image, pressure, bbox, size):
     logging.info(f'Generating pressure: {pressure}')
     layer_image = None
     try:
@@ -94,12 +111,7 @@ def generate_pressure_preview(cropped_basemap, boundary_layer_image, pressure, b
         logging.error('Error at %s', 'division', exc_info=e)
         logging.warn(f'Failed to retrieve image for {pressure.layer}')
     else:
-        cropped_basemap.paste(layer_image, None, layer_image)
-        cropped_basemap.paste(boundary_layer_image, None, boundary_layer_image)
-        with BytesIO() as bytes_io:
-            cropped_basemap.save(bytes_io, 'PNG')
-            default_storage.delete(filepath)
-            default_storage.save(filepath, File(bytes_io, ''))
+        save_pressure_preview(cropped_basemap, boundary_layer_image, pressure, layer_image)
 
 def get_bbox(region_report, target_ratio):
     region_bbox = bbox = {
@@ -131,9 +143,90 @@ def get_bbox(region_report, target_ratio):
             'west':  region_report.minx
         }
 
-def generate_region_pressure_previews(region_report, boundary_layer):
+def unwrapped_longitudes(bbox, reference):
+    "A bbox's (west, east), with east > west, shifted by a multiple of 360° to be nearest reference"
+    ( west, east ) = ( bbox['west'], bbox['east'] )
+    if east <= west:
+        east += 360
+    shift = round((reference - west) / 360) * 360
+    return ( west + shift, east + shift )
+
+def get_network_bbox(regions):
+    "The bbox covering the bboxes of all the regions (of a network)"
+    reference = regions[0]['bbox']['west']
+    longitudes = [unwrapped_longitudes(region['bbox'], reference) for region in regions]
+    return {
+        'north': max(region['bbox']['north'] for region in regions),
+        'south': min(region['bbox']['south'] for region in regions),
+        'east':  max(east for _, east in longitudes),
+        'west':  min(west for west, _ in longitudes)
+    }
+
+def get_network_size(network_bbox, regions):
+    "The size of an image of network_bbox at the resolution of the most detailed of the regions"
+    x_resolution = max(
+        region['size']['width'] / (east - west)
+        for region in regions
+        for west, east in [unwrapped_longitudes(region['bbox'], 0)]
+    )
+    y_resolution = max(region['size']['height'] / (region['bbox']['north'] - region['bbox']['south']) for region in regions)
+    return {
+        'width': math.ceil((network_bbox['east'] - network_bbox['west']) * x_resolution),
+        'height': math.ceil((network_bbox['north'] - network_bbox['south']) * y_resolution)
+    }
+
+def generate_network_pressure_previews(layer, region_pressures, network_bbox, network_size):
+    """
+    Generates the previews of pressures of a layer in several regions of a
+    network from one image of the layer covering all of them, cropping
+    each region's view out of it.
+    """
+    logging.info(f'Generating pressures for {layer} across {len(region_pressures)} regions')
+    try:
+        network_image = get_layer_image(layer, network_bbox, network_size)
+    except Exception as e:
+        logging.error('Error at %s', 'division', exc_info=e)
+        logging.warn(f'Failed to retrieve image for {layer}')
+        return
+
+    x_scale = network_image.width / (network_bbox['east'] - network_bbox['west'])
+    y_scale = network_image.height / (network_bbox['north'] - network_bbox['south'])
+    for region, pressure in region_pressures:
+        ( west, east ) = unwrapped_longitudes(region['bbox'], network_bbox['west'])
+        box = (
+            round((west - network_bbox['west']) * x_scale),
+            round((network_bbox['north'] - region['bbox']['north']) * y_scale),
+            round((east - network_bbox['west']) * x_scale),
+            round((network_bbox['north'] - region['bbox']['south']) * y_scale)
+        )
+        try:
+            layer_image = network_image.crop(box).resize((region['size']['width'], region['size']['height']))
+            save_pressure_preview(region['basemap'].copy(), region['boundary'], pressure, layer_image)
+        except Exception as e:
+            logging.error("Error generating pressure preview %s", pressure.id, exc_info=e)
+
+def get_region_boundary(region, boundary_layer):
+    region_report = region['region_report']
+    try:
+        region['boundary'] = get_boundary_layer_image(boundary_layer, region['bbox'], region['size'], region_report.network, region_report.park)
+    except Exception as e:
+        logging.error('Error at %s', 'division', exc_info=e)
+        logging.warn(f'Failed to retrieve boundary image for {boundary_layer}')
+    return region
+
+def generate_pressure_previews(region_reports, pressures, boundary_layer, executor, shared_fetch):
+    """
+    Generates the pressure previews of the region reports, retrieving
+    images from upstream concurrently on executor.
+
+    With shared_fetch, a layer with pressures in several regions of a
+    network is retrieved once, covering all of them, and each region's
+    view is cropped from it; this takes the number of GetMap requests from
+    roughly one per pressure to one per layer per network.  Layers whose
+    network image would cross the antimeridian or exceed
+    SHARED_IMAGE_MAX_SIZE are still retrieved per region.
+    """
     aspect_ratio = 5 / 4
-    bbox = get_bbox(region_report, aspect_ratio)
     width = 386
     height = round(width / aspect_ratio)
     size = {
@@ -141,23 +234,73 @@ def generate_region_pressure_previews(region_report, boundary_layer):
         'height': height
     }
 
-    cropped_basemap = basemap_bbox(**bbox).resize((width, height))
+    # The basemap is cropped here rather than on the executor, as its
+    # dataset is shared and mustn't be read by several threads at once
+    regions = [
+        {
+            'region_report': region_report,
+            'bbox': bbox,
+            'size': size,
+            'basemap': basemap_bbox(**bbox, size=size),
+            'boundary': None,
+        }
+        for region_report, bbox in ((region_report, get_bbox(region_report, aspect_ratio)) for region_report in region_reports)
+    ]
+    regions = [region for region in executor.map(lambda region: get_region_boundary(region, boundary_layer), regions) if region['boundary']]
 
-    boundary_layer_image = None
+    # (region, pressure) of each pressure to generate, by network and layer
+    network_layer_pressures = {}
+    for region in regions:
+        logging.info(f"Generating pressures for: {region['region_report']}")
+        for pressure in pressures.get(region['region_report'].id, []):
+            network_layer_pressures.setdefault((region['region_report'].network, pressure.layer.id), []).append((region, pressure))
 
-    try:
-        boundary_layer_image = get_boundary_layer_image(boundary_layer, bbox, size, region_report.network, region_report.park)
-    except Exception as e:
-        logging.error('Error at %s', 'division', exc_info=e)
-        logging.warn(f'Failed to retrieve boundary image for {boundary_layer}')
-    else:
-        logging.info(f'Generating pressures for: {region_report}')
-        for pressure in Pressure.objects.filter(region_report=region_report.id):
-            generate_pressure_preview(cropped_basemap.copy(), boundary_layer_image, pressure, bbox, size)
+    # Futures, and the pressures whose previews they generate
+    futures = {}
+    for region_pressures in network_layer_pressures.values():
+        if shared_fetch and len(region_pressures) > 1:
+            network_regions = [region for region, _ in region_pressures]
+            network_bbox = get_network_bbox(network_regions)
+            network_size = get_network_size(network_bbox, network_regions)
+            if (
+                network_bbox['west'] >= -180 and network_bbox['east'] <= 180
+                and max(network_size.values()) <= SHARED_IMAGE_MAX_SIZE
+            ):
+                layer = region_pressures[0][1].layer
+                future = executor.submit(generate_network_pressure_previews, layer, region_pressures, network_bbox, network_size)
+                futures[future] = [pressure for _, pressure in region_pressures]
+                continue
+        for region, pressure in region_pressures:
+            future = executor.submit(generate_pressure_preview, region['basemap'].copy(), region['boundary'], pressure, region['bbox'], region['size'])
+            futures[future] = [pressure]
+
+    # A preview that fails is logged, and the rest still generated
+    for future, future_pressures in futures.items():
+        try:
+            future.result()
+        except Exception as e: # pylint: disable=broad-except
+            logging.error("Error generating pressure previews %s", [pressure.id for pressure in future_pressures], exc_info=e)
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            help='Number of images to retrieve concurrently',
+            type=int,
+            default=8,
+        )
+        parser.add_argument(
+            '--shared_fetch',
+            help="Retrieve one image of each layer per network and crop each park's preview from it, rather than one image per pressure",
+            action='store_true',
+        )
+
     def handle(self, *args, **options):
         boundary_layer = KeyedLayer.objects.get(keyword='data-report-minimap-panel1-boundary').layer
-        for region_report in RegionReport.objects.all():
-            generate_region_pressure_previews(region_report, boundary_layer)
+        region_reports = list(RegionReport.objects.all())
+        pressures = {}
+        for pressure in Pressure.objects.select_related('region_report', 'layer').all():
+            pressures.setdefault(pressure.region_report_id, []).append(pressure)
 
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            generate_pressure_previews(region_reports, pressures, boundary_layer, executor, options['shared_fetch'])
@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from catalogue.legends import refresh_legend
+from catalogue.models import Layer
+
+
+def prefetch_legend(layer):
+    try:
+        refresh_legend(layer)
+    except Exception as e:
+        logging.error(f"Error retrieving legend of layer {layer.id}", exc_info=e)
+        return False
+    else:
+        return True
+    finally:
+        # Connections are per-thread; close this worker's
+        connections.close_all()
+
+
+# Retrieves and stores the legend of every layer (see
+# catalogue.legends), so no layer_legend request has to wait on an
+# upstream server.  Run periodically to keep the stored legends fresh.
+class Command(BaseCommand):
+    help = 'Retrieves and stores the legend of every layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--layer_id',
+            action='append',
+            type=int,
+            help="Retrieve only this layer's legend (may be repeated)"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help="Number of legends to retrieve concurrently"
+        )
+
+    def handle(self, *args, **options):
+        layers = Layer.objects.all()
+        if options['layer_id']:
+            layers = layers.filter(id__in=options['layer_id'])
+        layers = list(layers)
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            results = list(executor.map(prefetch_legend, layers))
+
+        failed = [layer for layer, succeeded in zip(layers, results) if not succeeded]
+        logging.info(f"Retrieved {len(layers) - len(failed)} of {len(layers)} legends")
+        for layer in failed:
+            self.stdout.write(self.style.WARNING(f"Could not retrieve legend of layer {layer.id} ({layer})"))
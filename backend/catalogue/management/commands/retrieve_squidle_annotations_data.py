@@ -1,5 +1,3 @@
-import requests
-from requests.adapters import HTTPAdapter, Retry
 from urllib.parse import parse_qs
 from django.conf import settings
 from django.core.management.base import BaseCommand
@@ -9,29 +7,18 @@ from pyquery import PyQuery
 from sqapi.api import SQAPI, query_filter as qf, SQAPIException
 
 from catalogue.models import AmpDepthZones, KeyedLayer, Layer, SquidleAnnotationsData
+from webapp import upstream
 
 class Command(BaseCommand):
     skip_existing: bool
     network_boundary_layer: Layer
     park_boundary_layer: Layer
-    http_session: requests.Session
     api: SQAPI
     additional_filters: list
     qsparams: dict
     template: str
     results_per_page: int
 
-    def start_http_session(self) -> None:
-        retry_strategy = Retry(
-            total=3,
-            status_forcelist=[ 500, 502, 503, 504 ]
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        http_session = requests.Session()
-        http_session.mount("https://", adapter)
-        http_session.mount("http://", adapter)
-        self.http_session = http_session
-
 
     def geojson_boundary(self, network: str, park: str = None) -> list:
         boundary_layer = self.park_boundary_layer if park else self.network_boundary_layer
@@ -42,15 +29,16 @@ class Command(BaseCommand):
             'version':      '2.0.0',
             'typeNames':    boundary_layer.layer_name,
             'outputFormat': 'application/json',
-            'cql_filter': (f"RESNAME='{park}'" if park else f"NETNAME='{network}'")
+            'cql_filter': (f"RESNAME='{park}'" if park else f"NETNAME='{network}'"),
+            'count':      1
         }
-        r = self.http_session.get(url, params=params)
-        data = r.json()
-        boundary_type = data['features'][0]['geometry']['type']
+        with upstream.get_geojson(url, params=params) as features:
+            geometry = next(iter(features))['geometry']
+        boundary_type = geometry['type']
         if boundary_type == 'Polygon':
-            return [data['features'][0]['geometry']['coordinates']]
+            return [geometry['coordinates']]
         elif boundary_type == 'MultiPolygon':
-            return data['features'][0]['geometry']['coordinates']
+            return geometry['coordinates']
         else:
             raise Exception(f"Unexpected boundary type: {boundary_type}")
 
@@ -224,12 +212,11 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         self.skip_existing = options['skip_existing'].lower() in ['t', 'true'] if options['skip_existing'] != None else False
 
-        self.start_http_session()
         self.network_boundary_layer = KeyedLayer.objects.get(keyword='data-report-boundary-network-simplified').layer
         self.park_boundary_layer = KeyedLayer.objects.get(keyword='data-report-boundary-simplified').layer
         self.api = SQAPI(host="https://squidle.org", api_key=settings.SQUIDLE_API_KEY)
 
-        wordpress_data = self.http_session.get(f"{settings.WORDPRESS_URL}wp-json/wp/v2/region_report?acf_format=standard").json()[0]
+        wordpress_data = upstream.get(f"{settings.WORDPRESS_URL}wp-json/wp/v2/region_report?acf_format=standard").json()[0]
         self.additional_filters = json.loads(wordpress_data['region_report_squidle_annotations_filters']) if wordpress_data.get('region_report_squidle_annotations_filters') else []
         self.qsparams = {k: v[0] for k, v in parse_qs(wordpress_data['region_report_squidle_query_string_parameters']).items()} if wordpress_data.get('region_report_squidle_query_string_parameters') else {}
         self.template = self.qsparams.pop('template', 'models/annotation/tally_chart_translated.html')
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+import logging
+
+from habitat.viewsets import boundary_statistics, SQL_GET_AMP_BOUNDARIES, SQL_GET_IMCRA_BOUNDARIES, SQL_GET_MEOW_BOUNDARIES
+
+SQL_GET_BOUNDARIES = {
+    'amp':   SQL_GET_AMP_BOUNDARIES,
+    'imcra': SQL_GET_IMCRA_BOUNDARIES,
+    'meow':  SQL_GET_MEOW_BOUNDARIES,
+}
+
+
+# Every boundary tuple reachable by drilling down through the boundary
+# hierarchy (eg, network, then park, then zone...), including the
+# all-None tuple for the boundary type as a whole.
+def boundary_combinations(rows, size):
+    combinations = {(None,) * size}
+    for row in rows:
+        for i in range(1, size + 1):
+            combinations.add(tuple(row[:i]) + (None,) * (size - i))
+    return sorted(combinations, key=lambda boundary: [(v is not None, v or '') for v in boundary])
+
+
+class Command(BaseCommand):
+    help = 'Precalculates the habitat and bathymetry statistics of every boundary into the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--boundary-type',
+            action='append',
+            choices=list(SQL_GET_BOUNDARIES),
+            help='Boundary type to warm (may be repeated; defaults to all)'
+        )
+
+    def handle(self, *args, **options):
+        boundary_types = options['boundary_type'] or list(SQL_GET_BOUNDARIES)
+
+        for boundary_type in boundary_types:
+            with connections['transects'].cursor() as cursor:
+                cursor.execute(SQL_GET_BOUNDARIES[boundary_type])
+                size = len(cursor.description)
+                rows = cursor.fetchall()
+
+            combinations = boundary_combinations(rows, size)
+            logging.info(f'Warming statistics for {len(combinations)} {boundary_type} boundaries')
+            for boundary in combinations:
+                for statistic in ['habitat', 'bathymetry']:
+                    try:
+                        boundary_statistics(statistic, boundary_type, boundary)
+                    except Exception as e:
+                        logging.error(f'Error warming {statistic} statistics for {boundary_type} boundary {boundary}', exc_info=e)
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.27 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0033_layer_download_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerLegend',
+            fields=[
+                ('layer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stored_legend', serialize=False, to='catalogue.layer')),
+                ('legend', models.TextField(blank=True, help_text='JSON of the legend; null if the layer has no legend', null=True)),
+                ('error', models.TextField(blank=True, help_text='Error of the last refresh, if it failed', null=True)),
+                ('last_refreshed', models.DateTimeField(help_text='When the legend was last successfully retrieved')),
+                ('last_attempted', models.DateTimeField(help_text='When the legend was last retrieved (successfully or not)')),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.27 on 2026-10-18 11:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0034_layerlegend'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RichLayerCqlValues',
+            fields=[
+                ('rich_layer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stored_cql_values', serialize=False, to='catalogue.richlayer')),
+                ('cql_properties', models.TextField(help_text='JSON of the CQL properties the values are of')),
+                ('values', models.TextField(blank=True, help_text='JSON of the values and value combinations (see Layer.cql_property_values)', null=True)),
+                ('error', models.TextField(blank=True, help_text='Error of the last refresh, if it failed', null=True)),
+                ('last_refreshed', models.DateTimeField(blank=True, help_text='When the values were last successfully retrieved', null=True)),
+                ('last_attempted', models.DateTimeField(help_text='When the values were last retrieved (successfully or not)')),
+            ],
+        ),
+    ]
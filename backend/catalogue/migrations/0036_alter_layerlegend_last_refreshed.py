@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0035_richlayercqlvalues'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='layerlegend',
+            name='last_refreshed',
+            field=models.DateTimeField(blank=True, help_text='When the legend was last successfully retrieved', null=True),
+        ),
+    ]
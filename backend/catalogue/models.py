@@ -2,18 +2,27 @@
 # Copyright (c) 2017, Institute of Marine & Antarctic Studies.  Written by Condense Pty Ltd.
 # Released under the Affero General Public Licence (AGPL) v3.  See LICENSE file for details.
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import re
 from typing import Union
+from django.conf import settings
 from django.core.validators import MinValueValidator, RegexValidator
 import django.utils.timezone
 from django.db import models
 from six import python_2_unicode_compatible
 from uuid import uuid4
-import requests
 import xml.etree.ElementTree as ET 
 
+from webapp import upstream
+
 # pylint: disable=line-too-long
 
+class LegendNotSupported(ValueError):
+    "Raised by Layer.get_legend for layers that have no legend"
+
+
 @python_2_unicode_compatible
 class Category(models.Model):
     "Category for semantic grouping in the UI; eg bathymetry or habitat"
@@ -201,7 +210,7 @@ class Layer(models.Model):
             'request': 'GetCapabilities',
             'service': 'WFS'
         }
-        r = requests.get(url=self.server_url, params=params, verify=False)
+        r = upstream.get(url=self.server_url, params=params, verify=False, cache=True)
         if r.status_code != 200:
             raise Exception(f"Cannot retrieve WFS capabilities from geoserver ({self.server_url})")
 
@@ -247,47 +256,95 @@ class Layer(models.Model):
                     return True
         return False
     
-    def geojson(self, out_fields: str=None):
-        url = f"{self.server_url}/query"
-
-        result_record_count = 50
-        result_offset = 0
-        
-        params = {
-            'where':             '1=1',
-            'outFields':         out_fields,
-            'f':                 'geojson',
-            'resultRecordCount': result_record_count,
-            'recordOffset':      result_offset
-        }
-
-        r = requests.get(url=url, params=params, verify=False)
-        geojson = r.json()
-
-        while r.json()['features']:
-            result_offset += result_record_count
+    def _geojson_page(self, url: str, out_fields: str, offset: int, limit: int) -> list:
+        "The GeoJSON features [offset, offset + limit) of an ArcGIS layer, in as many requests as the server needs"
+        features = []
+        while len(features) < limit:
             params = {
                 'where':             '1=1',
                 'outFields':         out_fields,
                 'f':                 'geojson',
-                'resultRecordCount': result_record_count,
-                'resultOffset':      result_offset
+                'resultOffset':      offset + len(features),
+                'resultRecordCount': limit - len(features),
             }
-            r = requests.get(url=url, params=params, verify=False)
-            print(r.url)
-            geojson['features'] += r.json()['features']
+            data = upstream.get(url=url, params=params, verify=False).json()
+            page = data.get('features') or []
+            features += page
+            exceeded_transfer_limit = data.get('exceededTransferLimit') or (data.get('properties') or {}).get('exceededTransferLimit')
+            if not page or not exceeded_transfer_limit:
+                break
+        return features
+
+    def iter_geojson_features(self, out_fields: str=None):
+        """
+        Yields the GeoJSON features of an ArcGIS (MapServer or FeatureServer)
+        layer.
+
+        The layer's maxRecordCount and feature count are retrieved first, so
+        pages of maxRecordCount features can be retrieved concurrently
+        (LAYER_GEOJSON_FETCH_WORKERS at a time); each page's features are
+        yielded, in order, while the following pages are being retrieved.
 
-        return geojson
+        Args:
+            out_fields (str): Optional. The outFields of the query (eg, '*').
+
+        Yields:
+            dict: GeoJSON features.
+        """
+        url = f"{self.server_url}/query"
+        page_size = self.server_info().get('maxRecordCount') or 1000
+        r = upstream.get(url=url, params={'where': '1=1', 'returnCountOnly': 'true', 'f': 'json'}, verify=False)
+        count = r.json().get('count')
+
+        # If the server can't count the features, page through them until
+        # there are none left
+        if count is None:
+            offset = 0
+            while page := self._geojson_page(url, out_fields, offset, page_size):
+                yield from page
+                offset += len(page)
+            return
+
+        workers = settings.LAYER_GEOJSON_FETCH_WORKERS
+        offsets = iter(range(0, count, page_size))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = deque(
+                executor.submit(self._geojson_page, url, out_fields, offset, page_size)
+                for offset in itertools.islice(offsets, workers)
+            )
+            try:
+                while pages:
+                    page = pages.popleft().result()
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        pages.append(executor.submit(self._geojson_page, url, out_fields, offset, page_size))
+                    yield from page
+            finally:
+                for page in pages:
+                    page.cancel()
+
+    def geojson(self, out_fields: str=None) -> dict:
+        "The GeoJSON FeatureCollection of an ArcGIS layer; see iter_geojson_features"
+        return {
+            'type': 'FeatureCollection',
+            'features': list(self.iter_geojson_features(out_fields))
+        }
 
     def server_info(self):
         url = self.server_url
         params = { 'f': 'json' }
 
-        r = requests.get(url=url, params=params, verify=False)
+        r = upstream.get(url=url, params=params, verify=False, cache=True)
 
         return r.json()
 
     def cql_property_values(self, cql_properties: list) -> dict:
+        """
+        The distinct values of each of the CQL properties across the
+        layer's features, and the distinct combinations of them. The
+        features are streamed from a WFS GetFeature and parsed as they
+        arrive, so only the distinct combinations are held in memory.
+        """
         params = {
             'service': 'WFS',
             'version': '2.0.0',
@@ -298,23 +355,13 @@ class Layer(models.Model):
         }
         if self.filter:
             params['cql_filter'] = self.filter
-        r = requests.get(url=self.server_url, params=params, verify=False, timeout=30)
-        data = r.json()
-
-        features_cql_properties = [
-            {
-                cql_property: feature["properties"][cql_property]
-                for cql_property in cql_properties
-            }
-            for feature in data["features"]
-        ]
-
-        value_combinations = [
-            dict(y) for y in set(
-                tuple(x.items())
-                for x in features_cql_properties
+        with upstream.get_geojson(url=self.server_url, params=params, verify=False, timeout=30) as features:
+            combinations = set(
+                tuple(feature['properties'][cql_property] for cql_property in cql_properties)
+                for feature in features
             )
-        ]
+
+        value_combinations = [dict(zip(cql_properties, combination)) for combination in combinations]
 
         values = [
             {
@@ -418,7 +465,7 @@ class Layer(models.Model):
         - The resulting legend keys are derived from either `uniqueValueInfos` or directly
             from the renderer if `uniqueValueInfos` is absent.
         """
-        r = requests.get(url=self.server_url, params={ 'f': 'json' }) # Request server data
+        r = upstream.get(url=self.server_url, params={ 'f': 'json' }, cache=True) # Request server data
         data = r.json()
         renderer = data['drawingInfo']['renderer'] # Get renderer data
         if 'uniqueValueInfos' in renderer: # If renderer has uniqueValueInfos, then...
@@ -435,7 +482,7 @@ class Layer(models.Model):
         Returns:
             dict: A dictionary of the MapServer layer data.
         """
-        r = requests.get(url=self.server_url, params={ 'f': 'json' })
+        r = upstream.get(url=self.server_url, params={ 'f': 'json' }, cache=True)
         return r.json()
 
     def _map_server_legend_item_to_legend_key(self, legend_item: dict, legend_layer: dict) -> dict:
@@ -498,7 +545,7 @@ class Layer(models.Model):
             match = re.match(r'^(?P<map_server_url>.+)/(?P<map_server_layer_id>\d+)$', self.server_url)
             legend_url = f"{match.group('map_server_url')}/legend"
             map_server_layer_id = int(match.group('map_server_layer_id'))
-            r = requests.get(url=legend_url, params={ 'f': 'json' })
+            r = upstream.get(url=legend_url, params={ 'f': 'json' }, cache=True)
             data = r.json()
             layer_data = self._map_server_layer_data()
 
@@ -529,7 +576,7 @@ class Layer(models.Model):
             }
             if self.style:
                 params['style'] = self.style
-            return requests.get(url=self.server_url, params=params).url
+            return upstream.prepared_url(self.server_url, params)
 
 
     def _get_esri_image_map_legend(self) -> Union[str, list[dict]]:
@@ -560,7 +607,7 @@ class Layer(models.Model):
         """
         # First, try to get legend data in JSON format
         legend_url = f"{self.server_url}/legend" # TODO
-        r = requests.get(url=legend_url, params={ 'f': 'json' }, timeout=10)
+        r = upstream.get(url=legend_url, params={ 'f': 'json' }, timeout=10, cache=True)
         data = r.json()
         legend_layer = data['layers'][0]
         return [self._map_server_legend_item_to_legend_key(legend_item, legend_layer) for legend_item in legend_layer['legend']]
@@ -690,7 +737,7 @@ class Layer(models.Model):
         }
         if self.style:
             params['style'] = self.style
-        r = requests.get(url=self.server_url, params=params)
+        r = upstream.get(url=self.server_url, params=params, cache=True)
         
         try:
             data = r.json()
@@ -709,7 +756,7 @@ class Layer(models.Model):
             }
             if self.style:
                 params['style'] = self.style
-            return requests.get(url=self.server_url, params=params).url
+            return upstream.prepared_url(self.server_url, params)
 
     def get_legend(self) -> Union[str, list[dict]]:
         """
@@ -764,7 +811,7 @@ class Layer(models.Model):
 
         # ...otherwise, layer type is not supported
         else:
-            raise ValueError("Unsupported layer type")
+            raise LegendNotSupported("Unsupported layer type")
 
     def bounds(self):
         return {
@@ -954,6 +1001,33 @@ class DynamicPillLayer(models.Model):
         db_table = 'catalogue_dynamicpill_layers'
 
 
+@python_2_unicode_compatible
+class LayerLegend(models.Model):
+    "Last retrieved legend of a layer (see catalogue.legends), served while it's refreshed in the background"
+    layer = models.OneToOneField(Layer, on_delete=models.CASCADE, primary_key=True, related_name='stored_legend')
+    legend = models.TextField(null=True, blank=True, help_text="JSON of the legend; null if the layer has no legend")
+    error = models.TextField(null=True, blank=True, help_text="Error of the last refresh, if it failed")
+    last_refreshed = models.DateTimeField(null=True, blank=True, help_text="When the legend was last successfully retrieved")
+    last_attempted = models.DateTimeField(help_text="When the legend was last retrieved (successfully or not)")
+
+    def __str__(self):
+        return f'{"⚠️ " if self.error else ""}{self.layer}'
+
+
+@python_2_unicode_compatible
+class RichLayerCqlValues(models.Model):
+    "Last retrieved CQL filter values of a rich layer's controls (see catalogue.cql_values)"
+    rich_layer = models.OneToOneField(RichLayer, on_delete=models.CASCADE, primary_key=True, related_name='stored_cql_values')
+    cql_properties = models.TextField(help_text="JSON of the CQL properties the values are of")
+    values = models.TextField(null=True, blank=True, help_text="JSON of the values and value combinations (see Layer.cql_property_values)")
+    error = models.TextField(null=True, blank=True, help_text="Error of the last refresh, if it failed")
+    last_refreshed = models.DateTimeField(null=True, blank=True, help_text="When the values were last successfully retrieved")
+    last_attempted = models.DateTimeField(help_text="When the values were last retrieved (successfully or not)")
+
+    def __str__(self):
+        return f'{"⚠️ " if self.error else ""}{self.rich_layer}'
+
+
 # Not really catalogue tables - are they better put somewhere else (e.g. sql app?)
 
 @python_2_unicode_compatible
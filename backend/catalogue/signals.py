@@ -1,8 +1,40 @@
+from datetime import datetime, timezone
+import uuid
 from django.core.cache import cache
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Layer
+from .models import Layer, LayerLegend, RichLayer, RichLayerCqlValues
+
+# Changed whenever a layer is saved or deleted, for results that include
+# layer details (eg, transects' layer names) to be cached against
+LAYER_VERSION_CACHE_KEY = 'layer_version'
 
 @receiver([post_save, post_delete], sender=Layer)
 def clear_layer_list_cache(**kwargs):
     cache.delete("layer_list")
+
+
+@receiver([post_save, post_delete], sender=Layer)
+def change_layer_version(**kwargs):
+    cache.set(LAYER_VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+
+
+@receiver(post_save, sender=Layer)
+def expire_layer_legend(instance, **kwargs):
+    # The layer's server, style or legend URL may have changed; its stored
+    # legend is served while being refreshed, rather than requests waiting
+    # on upstream
+    LayerLegend.objects.filter(layer=instance).update(last_attempted=datetime(1970, 1, 1, tzinfo=timezone.utc))
+
+
+@receiver(post_save, sender=Layer)
+def clear_layer_cql_values(instance, **kwargs):
+    # The layer's server, name or filter may have changed
+    RichLayerCqlValues.objects.filter(rich_layer__layer=instance).delete()
+
+
+@receiver(post_save, sender=RichLayer)
+def clear_rich_layer_cql_values(instance, **kwargs):
+    # The rich layer's layer may have changed (changes to its controls
+    # are noticed by comparing the stored values' CQL properties)
+    RichLayerCqlValues.objects.filter(rich_layer=instance).delete()
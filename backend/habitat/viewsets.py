@@ -1,29 +1,39 @@
 # Seamap: view and interact with Australian coastal habitat data
 # Copyright (c) 2017, Institute of Marine & Antarctic Studies.  Written by Condense Pty Ltd.
 # Released under the Affero General Public Licence (AGPL) v3.  See LICENSE file for details.
-from decimal import Decimal, getcontext
+import hashlib
 from io import BytesIO
+import json
 import numbers
 import os
 import shapefile
 import subprocess
 import tempfile
+import threading
+import time
 import zipfile
 import logging
-import requests
-from requests.adapters import HTTPAdapter, Retry
+import numpy
+from shapely import wkb
 from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 
 from catalogue import models, serializers
+from catalogue.cql_values import get_cql_filter_values
+from catalogue.legends import get_layer_legend, get_layer_legends
 from catalogue.models import Layer, RegionReport, KeyedLayer, Pressure, RichLayer
 from catalogue.serializers import KeyedLayerSerializer, RegionReportSerializer, LayerSerializer, PressureSerializer
-from collections import defaultdict, namedtuple
+from catalogue.signals import LAYER_VERSION_CACHE_KEY
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
+from django.core.cache import cache
 from django.db import connections, ProgrammingError
 from django.db.models.functions import Coalesce
-from django.http import FileResponse
+from django.http import FileResponse, StreamingHttpResponse
 from django.views.decorators.cache import cache_page
 from rest_framework.decorators import action, api_view, renderer_classes
 from rest_framework.renderers import BaseRenderer, TemplateHTMLRenderer, JSONRenderer
@@ -32,6 +42,7 @@ from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from rest_framework.request import Request
 from rest_framework.serializers import ValidationError
+from webapp import upstream
 
 
 # SQL Template to invoke the habitat transect intersection procedure.
@@ -66,6 +77,68 @@ FROM(
 """
 
 
+# A layer's part of the union-all statement of the transect templates'
+# habitat polygons (see transect_layers_placeholder); the first {} is
+# the layer's priority and the second the line variable:
+SQL_TRANSECT_LAYER = ('select layer_name, habitat, geom, {} as priority '
+                      'from SeamapAus_Regions_VIEW '
+                      'where lower(layer_name) = %s and geom.STIntersects({}) = 1')
+
+# Batch version of SQL_GET_TRANSECT, for several lines through the same
+# layers.  The habitat polygons intersecting any of the lines are loaded
+# once, and then each line is intersected with those of them that it
+# crosses.  The {lines} are "(%s, %s)" pairs of line index and WKT, and
+# {layers} is as {} in SQL_GET_TRANSECT.
+SQL_GET_TRANSECTS = """
+set nocount on;
+
+declare @lines table (line_index int primary key, line geometry);
+insert into @lines (line_index, line)
+    select line_index, geometry::STGeomFromText(wkt, 3112)
+    from (values {lines}) as lines (line_index, wkt);
+
+declare @all_lines geometry = (select geometry::CollectionAggregate(line) from @lines);
+declare @tmphabitat as HabitatTableType;
+declare @linehabitat as HabitatTableType;
+declare @segments table (line_index int, segment geometry, layer_name varchar(max), name varchar(max));
+declare @line_index int, @line geometry;
+
+insert into @tmphabitat
+    select layer_name, habitat as name, geom from (
+        {layers}
+    ) polys
+    order by priority asc;
+
+select @line_index = min(line_index) from @lines;
+while @line_index is not null
+begin
+    select @line = line from @lines where line_index = @line_index;
+
+    delete from @linehabitat;
+    insert into @linehabitat
+        select layer_name, name, geom from @tmphabitat
+        where geom.STIntersects(@line) = 1
+        order by id asc;
+
+    insert into @segments
+        select @line_index, segment, layer_name, name
+        from path_intersections(@line, @linehabitat);
+
+    select @line_index = min(line_index) from @lines where line_index > @line_index;
+end;
+
+SELECT line_index,
+       segment.STStartPoint().STX as 'start x',
+       segment.STStartPoint().STY as 'start y',
+       segment.STEndPoint().STX   as 'end x',
+       segment.STEndPoint().STY   as 'start y',
+       segment.STLength()         as 'length',
+       layer_name,
+       name
+FROM @segments
+ORDER BY line_index;
+"""
+
 # Note hack; we only include geoms in the result sometimes, so there's
 # a conditional fragement inclusion using {} before actual parameter
 # preparation (%s)
@@ -94,6 +167,9 @@ declare @bbox geometry = geometry::Point(%s, %s, 3112).STUnion(geometry::Point(%
 select {}.STIntersection(@bbox).STAsBinary() geom, {} from {} where {}.STIntersects(@bbox) = 1;
 """
 
+# Zipped shapefile parts are copied into the response in chunks of this size:
+SHAPEFILE_CHUNK_SIZE = 64 * 1024
+
 PRJ_3112 = """PROJCS["GDA94_Geoscience_Australia_Lambert",GEOGCS["GCS_GDA_1994",DATUM["D_GDA_1994",SPHEROID["GRS_1980",6378137,298.257222101]],PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]],PROJECTION["Lambert_Conformal_Conic"],PARAMETER["standard_parallel_1",-18],PARAMETER["standard_parallel_2",-36],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",134],PARAMETER["false_easting",0],PARAMETER["false_northing",0],UNIT["Meter",1]]"""
 
 SQL_GET_AMP_BOUNDARIES = """
@@ -125,6 +201,10 @@ SQL_GET_AMP_BOUNDARY_AREA = "SELECT dbo.AMP_BOUNDARY_geom(%s, %s, %s, %s, %s).ST
 SQL_GET_IMCRA_BOUNDARY_AREA = "SELECT dbo.IMCRA_BOUNDARY_geom(%s, %s).STArea() / 1000000"
 SQL_GET_MEOW_BOUNDARY_AREA = "SELECT dbo.MEOW_BOUNDARY_geom(%s, %s, %s).STArea() / 1000000"
 
+# Incremented by the Update_* procedures whenever the precalculated
+# BOUNDARY_* tables for a boundary type are refreshed:
+SQL_GET_BOUNDARY_VERSION = "SELECT version FROM BOUNDARY_PRECALCULATION_VERSION WHERE boundary_type = %s"
+
 SQL_GEOM_BINARY_COL = ", geometry::UnionAggregate(geom).STAsBinary() as geom" # Only include if we need to because faster queries without geometry aggregation
 
 SQL_GET_AMP_HABITAT_STATS = """
@@ -301,6 +381,37 @@ WHERE
 GROUP BY bathymetry_resolution, bathymetry_rank;
 """
 
+SQL_GET_BOUNDARY_AREA = {
+    'amp':   SQL_GET_AMP_BOUNDARY_AREA,
+    'imcra': SQL_GET_IMCRA_BOUNDARY_AREA,
+    'meow':  SQL_GET_MEOW_BOUNDARY_AREA,
+}
+
+SQL_GET_PRECALCULATED_BOUNDARY_AREAS = {
+    'amp':   "SELECT Network, Park, Zone_Category, IUCN_Category, Zone_ID, area FROM BOUNDARY_AMP_AREA",
+    'imcra': "SELECT Provincial_Bioregion, Mesoscale_Bioregion, area FROM BOUNDARY_IMCRA_AREA",
+    'meow':  "SELECT Realm, Province, Ecoregion, area FROM BOUNDARY_MEOW_AREA",
+}
+
+SQL_GET_BOUNDARY_STATS = {
+    'habitat': {
+        'amp':   SQL_GET_AMP_HABITAT_STATS,
+        'imcra': SQL_GET_IMCRA_HABITAT_STATS,
+        'meow':  SQL_GET_MEOW_HABITAT_STATS,
+    },
+    'bathymetry': {
+        'amp':   SQL_GET_AMP_BATHYMETRY_STATS,
+        'imcra': SQL_GET_IMCRA_BATHYMETRY_STATS,
+        'meow':  SQL_GET_MEOW_BATHYMETRY_STATS,
+    },
+}
+
+# Row appended to the JSON statistics for the total mapped area:
+BOUNDARY_STATS_TOTAL_ROW = {
+    'habitat':    {'habitat': None},
+    'bathymetry': {'resolution': None, 'rank': None},
+}
+
 SQL_GET_AMP_HABITAT_OBS_GLOBALARCHIVE = """
 SET NOCOUNT ON;
 
@@ -726,6 +837,36 @@ SELECT
 FROM @observations AS T1;
 """
 
+# Observation sources for habitat_observations; each is the SQL to
+# collect a boundary type's observations into @observations, and the
+# SQL to summarise them:
+SQL_GET_HABITAT_OBS = {
+    'global_archive': (
+        {
+            'amp':   SQL_GET_AMP_HABITAT_OBS_GLOBALARCHIVE,
+            'imcra': SQL_GET_IMCRA_HABITAT_OBS_GLOBALARCHIVE,
+            'meow':  SQL_GET_MEOW_HABITAT_OBS_GLOBALARCHIVE,
+        },
+        SQL_GET_GLOBALARCHIVE_STATS
+    ),
+    'sediment': (
+        {
+            'amp':   SQL_GET_AMP_HABITAT_OBS_SEDIMENT,
+            'imcra': SQL_GET_IMCRA_HABITAT_OBS_SEDIMENT,
+            'meow':  SQL_GET_MEOW_HABITAT_OBS_SEDIMENT,
+        },
+        SQL_GET_SEDIMENT_STATS
+    ),
+    'squidle': (
+        {
+            'amp':   SQL_GET_AMP_HABITAT_OBS_SQUIDLE,
+            'imcra': SQL_GET_IMCRA_HABITAT_OBS_SQUIDLE,
+            'meow':  SQL_GET_MEOW_HABITAT_OBS_SQUIDLE,
+        },
+        SQL_GET_SQUIDLE_STATS
+    ),
+}
+
 SQL_GET_DATA_IN_REGION = """
 DECLARE @region GEOMETRY = GEOMETRY::STGeomFromText(%s, 4326);
 SELECT DISTINCT layer_id FROM (
@@ -734,16 +875,56 @@ SELECT DISTINCT layer_id FROM (
 ) AS [T1];
 """
 
-def http_session():
-    retry_strategy = Retry(
-        total=3,
-        status_forcelist=[ 500, 502, 503, 504 ]
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.Session()
-    http.mount("https://", adapter)
-    http.mount("http://", adapter)
-    return http
+# As SQL_GET_DATA_IN_REGION, but only testing the features of the
+# candidate layers ({} is replaced with a "(%s)" per layer, for up to
+# DATA_IN_REGION_CANDIDATE_CHUNK_SIZE layers at a time):
+SQL_GET_CANDIDATE_DATA_IN_REGION = """
+DECLARE @region GEOMETRY = GEOMETRY::STGeomFromText(%s, 4326);
+SELECT candidate.layer_id
+FROM (VALUES {}) AS candidate(layer_id)
+WHERE EXISTS (
+  SELECT 1 FROM [dbo].[layer_feature]
+  WHERE
+    layer_feature.layer_id = candidate.layer_id AND
+    layer_feature.geom.STIntersects(@region) = 1
+);
+"""
+
+# Within SQL Server's limit of 2100 parameters per query
+DATA_IN_REGION_CANDIDATE_CHUNK_SIZE = 2000
+
+# The footprints of each layer in the feature index, coarsest first:
+SQL_GET_LAYER_FOOTPRINTS = """
+SELECT layer_id, geom.STAsBinary()
+FROM [dbo].[layer_feature_footprint]
+ORDER BY layer_id, tolerance DESC;
+"""
+
+# The layers in the feature index without footprints (whose footprints
+# haven't been built yet, or failed to build):
+SQL_GET_LAYERS_WITHOUT_FOOTPRINTS = """
+SELECT DISTINCT layer_id
+FROM [dbo].[layer_feature]
+WHERE layer_id NOT IN (SELECT layer_id FROM [dbo].[layer_feature_footprint]);
+"""
+
+# Changed by build_feature_index_end whenever the feature index is
+# rebuilt:
+LAYER_FEATURE_VERSION_CACHE_KEY = 'layer_feature_version'
+
+# Boundary areas by boundary type, as (version, {boundary: area}); see
+# boundary_area:
+_boundary_areas = {}
+_boundary_areas_lock = threading.Lock()
+
+# Lookups of the transect cache, for metrics (see transect_cache_stats):
+_transect_cache_counts = {'hits': 0, 'misses': 0}
+_transect_cache_lock = threading.Lock()
+
+# Shared by every habitat_observations request, so the number of
+# observation queries running at once is bounded
+_habitat_observations_executor = ThreadPoolExecutor(max_workers=settings.HABITAT_OBSERVATIONS_WORKERS)
+
 
 def parse_bounds(bounds_str):
     # Note, we want points in x,y order but a boundary string is in y,x order:
@@ -752,23 +933,293 @@ def parse_bounds(bounds_str):
     return [x0,y0,x1,y1]
 
 
-def D(number):
-    "Return the (probably) string, quantized to an acceptable number of decimal places"
-    return Decimal(number).quantize(Decimal('0.1'))
+# Points are projected onto a transect's line this many at a time (see line_stations)
+TRANSECT_PROJECTION_CHUNK_SIZE = 1024
 
 
-class ShapefileRenderer(BaseRenderer):
-    media_type = 'application/zip'
-    format = 'raw'
+def parse_line(line):
+    "Parse a line parameter ('x1 y1,x2 y2,...,xn yn') into an (n, 2) array of its vertices"
+    try:
+        vertices = numpy.array([point.split() for point in line.split(',')], dtype=float)
+    except ValueError:
+        raise ValidationError({"message": "Invalid line '{}'".format(line)})
+    if vertices.ndim != 2 or vertices.shape[1] != 2 or len(vertices) < 2:
+        raise ValidationError({"message": "Invalid line '{}'".format(line)})
+    return vertices
+
+
+def line_stations(vertices, points):
+    """
+    The station (distance along the polyline of vertices) of each of the
+    points, measured at its projection onto the nearest part of the line.
+    """
+    starts = vertices[:-1]
+    directions = vertices[1:] - starts
+    part_lengths = numpy.hypot(directions[:, 0], directions[:, 1])
+    part_stations = numpy.concatenate(([0.0], numpy.cumsum(part_lengths)))[:-1]
+    # Zero-length parts project everything onto their start:
+    lengths_squared = numpy.where(part_lengths > 0, part_lengths ** 2, 1)
+
+    stations = numpy.empty(len(points))
+    for i in range(0, len(points), TRANSECT_PROJECTION_CHUNK_SIZE):
+        chunk = points[i:i + TRANSECT_PROJECTION_CHUNK_SIZE, None, :]
+        t = numpy.clip(numpy.einsum('pij,ij->pi', chunk - starts, directions) / lengths_squared, 0, 1)
+        offsets = chunk - (starts + t[..., None] * directions)
+        nearest = numpy.argmin(numpy.einsum('pij,pij->pi', offsets, offsets), axis=1)
+        t_nearest = t[numpy.arange(len(nearest)), nearest]
+        stations[i:i + len(nearest)] = part_stations[nearest] + t_nearest * part_lengths[nearest]
+    return stations
+
+
+def order_transect_segments(vertices, rows):
+    """
+    Orders the segments of a transect (rows of start x, start y, end x,
+    end y, length, layer name and name, in any order and direction) along
+    its line, by the stations of their ends, and orients each one in the
+    line's direction.  Unlike following segments end to end, this doesn't
+    depend on segments meeting exactly, so isn't thrown by gaps.
+
+    Returns:
+        list: the segments as dicts, with their distances and percentages
+        along the transect.
+    """
+    if not rows:
+        return []
+    coordinates = numpy.array([row[:4] for row in rows], dtype=float)
+    lengths = numpy.array([row[4] for row in rows], dtype=float)
+
+    # Segments that are (to the precision we return) points are dropped:
+    rounded = numpy.round(coordinates, 1)
+    keep = numpy.any(rounded[:, 0:2] != rounded[:, 2:4], axis=1)
+    if not keep.any():
+        return []
+    ( rows, coordinates, rounded, lengths ) = ( [row for row, k in zip(rows, keep) if k], coordinates[keep], rounded[keep], lengths[keep] )
+
+    start_stations = line_stations(vertices, coordinates[:, 0:2])
+    end_stations = line_stations(vertices, coordinates[:, 2:4])
+    reversed_segments = end_stations < start_stations
+    rounded[reversed_segments] = rounded[reversed_segments][:, [2, 3, 0, 1]]
+    order = numpy.argsort(start_stations + end_stations, kind='stable')
+
+    end_distances = numpy.cumsum(lengths[order])
+    start_distances = end_distances - lengths[order]
+    total = float(end_distances[-1])
 
-    def render(self, data, media_type=None, renderer_context=None):
-        # Set up shapefile writer:
-        shp = BytesIO()
-        shx = BytesIO()
-        dbf = BytesIO()
+    ordered_segments = []
+    for i, start_distance, end_distance in zip(order.tolist(), start_distances.tolist(), end_distances.tolist()):
+        ( startx, starty, endx, endy ) = rounded[i].tolist()
+        ordered_segments.append({'layer_name': rows[i][5],
+                                 'name': rows[i][6],
+                                 'start_distance': start_distance,
+                                 'end_distance': end_distance,
+                                 'start_percentage': 100*start_distance/total,
+                                 'end_percentage': 100*end_distance/total,
+                                 'startx': startx,
+                                 'starty': starty,
+                                 'endx': endx,
+                                 'endy': endy})
+    return ordered_segments
+
+
+def transect_layers_placeholder(layers, line):
+    "The union-all statement of the habitat polygons of layers intersecting the line variable"
+    # To ensure polygons are inserted in the order of layer
+    # ordering, we add a priority to sort by -- which means
+    # generating a union-all statement by layer:
+    return '\nUNION ALL\n'.join( SQL_TRANSECT_LAYER.format(i, line) for i,_ in enumerate(layers) )
+
+
+def fetch_all_results(cursor):
+    "All rows of all the result sets of a cursor's statement"
+    rows = []
+    while True:
+        try:
+            rows.extend(cursor.fetchall())
+            if not cursor.nextset():
+                break
+        except ProgrammingError:
+            if not cursor.nextset():
+                break
+    return rows
 
-        with shapefile.Writer(shp=shp, shx=shx, dbf=dbf, shapeType=shapefile.POLYGON) as sw:
-            fields = data['fields']
+
+def transect_rows(linestring, layers):
+    "The (unordered) segments of a transect from path_intersections, as rows of SQL_GET_TRANSECT"
+    with connections['transects'].cursor() as cursor:
+        cursor.execute(SQL_GET_TRANSECT.format(transect_layers_placeholder(layers, '@line')),
+                       [linestring] + layers)
+        return fetch_all_results(cursor)
+
+
+def batch_transect_rows(linestrings, layers):
+    """
+    The (unordered) segments of each of several transects through the
+    same layers, from one SQL_GET_TRANSECTS batch.
+
+    Returns:
+        list: the rows (as for SQL_GET_TRANSECT) of each linestring
+    """
+    sql = SQL_GET_TRANSECTS.format(
+        lines=', '.join(['(%s, %s)'] * len(linestrings)),
+        layers=transect_layers_placeholder(layers, '@all_lines')
+    )
+    params = [param for line_index, linestring in enumerate(linestrings) for param in (line_index, linestring)]
+    with connections['transects'].cursor() as cursor:
+        cursor.execute(sql, params + layers)
+        results = fetch_all_results(cursor)
+
+    rows = [[] for _ in linestrings]
+    for row in results:
+        rows[row[0]].append(row[1:])
+    return rows
+
+
+def transect_key(vertices, layers):
+    "Cache key for a transect; the line and layers are hashed to keep the key short"
+    digest = hashlib.sha1(json.dumps([vertices.tolist(), layers]).encode('utf-8')).hexdigest()
+    return 'transect:' + digest
+
+
+def transect_line(vertices):
+    """
+    A transect's line, rounded to TRANSECT_CACHE_LINE_PRECISION decimal
+    places, as (vertices, WKT linestring).
+    """
+    vertices = numpy.round(vertices, settings.TRANSECT_CACHE_LINE_PRECISION)
+    linestring = 'LINESTRING({})'.format(','.join(
+        '{0:.{2}f} {1:.{2}f}'.format(x, y, settings.TRANSECT_CACHE_LINE_PRECISION) for x, y in vertices.tolist()
+    ))
+    return vertices, linestring
+
+
+def transect_version():
+    """
+    The version transects are cached against: that of the habitat data
+    ('regions' in BOUNDARY_PRECALCULATION_VERSION), and of the layers
+    (whose names transects include; see LAYER_VERSION_CACHE_KEY)
+    """
+    return f"{boundary_version('regions')}-{cache.get(LAYER_VERSION_CACHE_KEY)}"
+
+
+def cached_transect(key, version):
+    "A transect's cached segments, or None (counting the hit or miss)"
+    segments = cache.get(key, version=version)
+    with _transect_cache_lock:
+        _transect_cache_counts['hits' if segments is not None else 'misses'] += 1
+    return segments
+
+
+def transect_segments(vertices, layers):
+    """
+    The ordered segments of the transect along a line (an array of
+    vertices) through layers (lowercase, in priority order).
+
+    The line is first rounded to TRANSECT_CACHE_LINE_PRECISION decimal
+    places, and results are cached against the version of the habitat
+    data and layers (see transect_version), so repeated requests for a
+    transect skip both the query and the ordering.
+    """
+    vertices, linestring = transect_line(vertices)
+    version = transect_version()
+    key = transect_key(vertices, layers)
+    segments = cached_transect(key, version)
+    if segments is not None:
+        return segments
+
+    # Lines don't really have a direction, so segments are returned in
+    # any order; they're ordered by where they lie along the line:
+    segments = order_transect_segments(vertices, transect_rows(linestring, layers))
+    cache.set(key, segments, timeout=settings.TRANSECT_CACHE_TIMEOUT, version=version)
+    return segments
+
+
+def batch_transect_segments(lines, layers):
+    """
+    The ordered segments of the transects along each of several lines
+    (arrays of vertices) through the same layers, as for
+    transect_segments.  Cached transects are yielded first, and the rest
+    are then intersected TRANSECT_BATCH_SIZE lines per query.
+
+    Yields:
+        tuple: (index of the line, its segments)
+    """
+    version = transect_version()
+    uncached = []
+    for index, vertices in enumerate(lines):
+        vertices, linestring = transect_line(vertices)
+        key = transect_key(vertices, layers)
+        segments = cached_transect(key, version)
+        if segments is not None:
+            yield index, segments
+        else:
+            uncached.append((index, vertices, linestring, key))
+
+    for start in range(0, len(uncached), settings.TRANSECT_BATCH_SIZE):
+        batch = uncached[start:start + settings.TRANSECT_BATCH_SIZE]
+        batch_rows = batch_transect_rows([linestring for _, _, linestring, _ in batch], layers)
+        for ( index, vertices, _, key ), rows in zip(batch, batch_rows):
+            segments = order_transect_segments(vertices, rows)
+            cache.set(key, segments, timeout=settings.TRANSECT_CACHE_TIMEOUT, version=version)
+            yield index, segments
+
+
+def transect_cache_stats():
+    "Hits and misses of the transect cache (in this process)"
+    with _transect_cache_lock:
+        hits, misses = _transect_cache_counts['hits'], _transect_cache_counts['misses']
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+    }
+
+
+class _ZipStream:
+    """
+    Unseekable write-only file object for zipfile to write into; output
+    accumulates until drained, so a zip can be streamed as it is built.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def query_records(sql, params):
+    """
+    Generator yielding the column description of a query against the
+    transects database, followed by its rows.  Rows are fetched in
+    batches, so a large result is never held in memory all at once.
+    """
+    with connections['transects'].cursor() as cursor:
+        cursor.execute(sql, params)
+        yield cursor.description
+        while rows := cursor.fetchmany(settings.SHAPEFILE_BATCH_SIZE):
+            yield from rows
+
+
+def write_shapefile(records) -> dict:
+    """
+    Writes records (the field description followed by rows, as yielded
+    by query_records) to .shp, .shx and .dbf parts.  The parts are
+    spooled to disk once they grow beyond SHAPEFILE_SPOOL_MAX_SIZE, and
+    are returned rewound, keyed by extension.
+    """
+    parts = {ext: tempfile.SpooledTemporaryFile(max_size=settings.SHAPEFILE_SPOOL_MAX_SIZE)
+             for ext in ['.shp', '.shx', '.dbf']}
+    try:
+        with shapefile.Writer(shp=parts['.shp'], shx=parts['.shx'], dbf=parts['.dbf'], shapeType=shapefile.POLYGON) as sw:
+            fields = next(records)
             # Define shp-table column structure from field metadata:
             geom_idx = None
             for idx, field in enumerate(fields):
@@ -781,7 +1232,7 @@ class ShapefileRenderer(BaseRenderer):
                 else:
                     geom_idx = idx
 
-            for row in data['data']:
+            for row in records:
                 row = list(row)
                 geom = row.pop(geom_idx)
                 geom = GEOSGeometry(memoryview(geom))
@@ -801,15 +1252,269 @@ class ShapefileRenderer(BaseRenderer):
                 # if geom.num_geom > 1:
                 #     # coords = [parts for poly in coords for parts in poly]
                 #     coords = [part for g in geom for part in g.coords if g.geom_type == 'Polygon']
+    except Exception:
+        for part in parts.values():
+            part.close()
+        raise
+
+    for part in parts.values():
+        part.seek(0)
+    return parts
+
+
+def shapefile_zip_stream(file_name, records):
+    """
+    Generator yielding a zipped shapefile in chunks.  The .prj entry is
+    yielded before records is consumed, so the client starts receiving
+    the download while the query is still running.
+    """
+    zipstream = _ZipStream()
+    with zipfile.ZipFile(zipstream, 'w') as responsezip:
+        responsezip.writestr(file_name + '.prj', PRJ_3112)
+        yield zipstream.drain()
+
+        parts = write_shapefile(records)
+        try:
+            for ext, part in parts.items():
+                zinfo = zipfile.ZipInfo(file_name + ext, date_time=time.localtime()[:6])
+                # Setting the size up front lets zipfile decide whether the entry needs zip64:
+                zinfo.file_size = part.seek(0, os.SEEK_END)
+                part.seek(0)
+                with responsezip.open(zinfo, 'w') as entry:
+                    while chunk := part.read(SHAPEFILE_CHUNK_SIZE):
+                        entry.write(chunk)
+                        yield zipstream.drain()
+        finally:
+            for part in parts.values():
+                part.close()
+    yield zipstream.drain()
+
+
+def shapefile_response(file_name, records):
+    "Streams records as a zipped shapefile download"
+    return StreamingHttpResponse(shapefile_zip_stream(file_name, records),
+                                 content_type='application/zip',
+                                 headers={'Content-Disposition': 'attachment; filename="{}.zip"'.format(file_name)})
+
+
+def boundary_version(boundary_type):
+    "Current version of the precalculated BOUNDARY_* tables for a boundary type"
+    with connections['transects'].cursor() as cursor:
+        cursor.execute(SQL_GET_BOUNDARY_VERSION, [boundary_type])
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def boundary_statistics_key(*parts, boundary):
+    "Cache key for a boundary's statistics; the boundary tuple is hashed to keep the key short"
+    digest = hashlib.sha1(json.dumps(list(boundary)).encode('utf-8')).hexdigest()
+    return ':'.join(['boundary_statistics', *parts, digest])
+
+
+def boundary_area(boundary_type, boundary, version):
+    """
+    Area of a boundary in km².  Looked up from the BOUNDARY_*_AREA
+    tables, which are held in-process and reloaded whenever the boundary
+    type's version changes.  Boundaries that aren't precalculated (eg, a
+    zone category across all networks) fall back to unioning the
+    boundary's geometry, and are remembered until the next version.
+    """
+    loaded_version, areas = _boundary_areas.get(boundary_type, (None, None))
+    if loaded_version != version:
+        with _boundary_areas_lock:
+            loaded_version, areas = _boundary_areas.get(boundary_type, (None, None))
+            if loaded_version != version:
+                with connections['transects'].cursor() as cursor:
+                    cursor.execute(SQL_GET_PRECALCULATED_BOUNDARY_AREAS[boundary_type])
+                    areas = {tuple(row[:-1]): float(row[-1]) for row in cursor.fetchall()}
+                _boundary_areas[boundary_type] = (version, areas)
+
+    boundary = tuple(boundary)
+    area = areas.get(boundary)
+    if area is None:
+        with connections['transects'].cursor() as cursor:
+            cursor.execute(SQL_GET_BOUNDARY_AREA[boundary_type], list(boundary))
+            area = float(cursor.fetchone()[0])
+        areas[boundary] = area
+    return area
+
+
+def boundary_statistics(statistic, boundary_type, boundary, is_download=False):
+    """
+    Habitat or bathymetry ('statistic') statistics for a boundary.  If
+    is_download, returns shapefile records (the field description
+    followed by rows, including their geometry, streamed from the query
+    by query_records), otherwise a list of dicts with a trailing row for
+    the total mapped area.
+
+    The list of dicts is cached against the version of the boundary
+    type's precalculated tables, so it's only recalculated after an
+    Update_* procedure has refreshed them.  Download records aren't
+    cached, as their geometries would have to be held in memory (and
+    stored) to be.
+    """
+    if boundary_type not in SQL_GET_BOUNDARY_AREA:
+        raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
+
+    version = boundary_version(boundary_type)
+    if is_download:
+        area = boundary_area(boundary_type, boundary, version)
+        stats_sql = SQL_GET_BOUNDARY_STATS[statistic][boundary_type].format(SQL_GEOM_BINARY_COL)
+        return query_records(stats_sql, [*boundary, area])
+
+    key = boundary_statistics_key(statistic, 'json', boundary_type, boundary=boundary)
+    results = cache.get(key, version=version)
+    if results is not None:
+        return results
+
+    area = boundary_area(boundary_type, boundary, version)
+    stats_sql = SQL_GET_BOUNDARY_STATS[statistic][boundary_type].format('')
+    with connections['transects'].cursor() as cursor:
+        cursor.execute(stats_sql, [*boundary, area])
+        columns = [col[0] for col in cursor.description]
+        results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    mapped_area = float(sum(v['area'] for v in results))
+    mapped_percentage = 100 * mapped_area / area
+    results.append({**BOUNDARY_STATS_TOTAL_ROW[statistic], 'area': mapped_area, 'mapped_percentage': None, 'total_percentage': mapped_percentage})
+
+    cache.set(key, results, timeout=settings.BOUNDARY_STATISTICS_CACHE_TIMEOUT, version=version)
+    return results
 
-        filename = data['file_name']
-        zipstream = BytesIO()
-        with zipfile.ZipFile(zipstream, 'w') as responsezip:
-            responsezip.writestr(filename + '.shp', shp.getvalue())
-            responsezip.writestr(filename + '.shx', shx.getvalue())
-            responsezip.writestr(filename + '.dbf', dbf.getvalue())
-            responsezip.writestr(filename + '.prj', PRJ_3112)
-        return zipstream.getvalue()
+
+def habitat_observations_stats(sql, params, timeout):
+    """
+    Runs an observation source's statistics query, for use from a worker
+    thread.  Django connections are per-thread, so the worker's
+    connection is closed afterwards rather than being left open outside
+    of any request's cleanup.
+
+    On SQL Server the query is given a timeout (in seconds), so a query
+    that habitat_observations has given up on is cancelled rather than
+    holding its thread and connection.
+    """
+    connection = connections['transects']
+    try:
+        connection.ensure_connection()
+        is_pyodbc = connection.vendor == 'microsoft'
+        if is_pyodbc:
+            previous_timeout = connection.connection.timeout
+            connection.connection.timeout = timeout
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                columns = [col[0] for col in cursor.description]
+                return dict(zip(columns, cursor.fetchone()))
+        finally:
+            # The connection may be returned to a pool
+            if is_pyodbc:
+                connection.connection.timeout = previous_timeout
+    finally:
+        connection.close()
+
+
+class LayerFootprints:
+    """
+    In-process STRtree of the footprints of each layer in the feature
+    index (see layer_feature_footprint), so data_in_region can find the
+    layers in a region without testing every feature. A layer's
+    footprints are tested coarsest first: layers with a footprint
+    within the region must have data in it, and those with a footprint
+    disjoint from it can't, so only the layers whose finest footprint
+    partly intersects the region need their features checked in the
+    database, along with any layers without footprints.
+
+    Footprints are loaded on first use, and reloaded after the feature
+    index is rebuilt (checked at most every
+    LAYER_FOOTPRINTS_RELOAD_INTERVAL seconds).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = None
+        self._footprints = None
+        self._unfootprinted = None
+
+    def _is_current(self):
+        return self._checked is not None and time.monotonic() - self._checked < settings.LAYER_FOOTPRINTS_RELOAD_INTERVAL
+
+    def _refresh(self):
+        if self._is_current():
+            return
+        with self._lock:
+            if self._is_current():
+                return
+            version = cache.get(LAYER_FEATURE_VERSION_CACHE_KEY)
+            if self._footprints is None or version != self._version:
+                footprints = {}
+                with connections['transects'].cursor() as cursor:
+                    cursor.execute(SQL_GET_LAYER_FOOTPRINTS)
+                    for layer_id, geom in cursor.fetchall():
+                        footprints.setdefault(layer_id, []).append(wkb.loads(bytes(geom)))
+                    # Without any footprints every layer would be unfootprinted,
+                    # and data_in_region tests every feature anyway
+                    unfootprinted = []
+                    if footprints:
+                        cursor.execute(SQL_GET_LAYERS_WITHOUT_FOOTPRINTS)
+                        unfootprinted = [row[0] for row in cursor.fetchall()]
+                # The tree holds each layer's coarsest footprint, and its
+                # queries return those geometries themselves, so layers
+                # are looked up by identity:
+                self._tree = STRtree([geoms[0] for geoms in footprints.values()])
+                self._layer_ids = {id(geoms[0]): layer_id for layer_id, geoms in footprints.items()}
+                self._footprints = footprints
+                self._unfootprinted = unfootprinted
+                self._version = version
+            self._checked = time.monotonic()
+
+    def is_empty(self):
+        "Whether there are no footprints (e.g. before the feature index is first rebuilt with them)"
+        self._refresh()
+        return not self._footprints
+
+    def query(self, region):
+        """
+        Finds the layers whose footprints intersect a region.
+
+        Args:
+            region (BaseGeometry): the region to search
+
+        Returns:
+            tuple: (ids of layers with a footprint within the region, ids
+            of layers whose features need checking: those whose finest
+            footprint partly intersects it, and those without footprints)
+        """
+        self._refresh()
+        tree, layer_ids, footprints = self._tree, self._layer_ids, self._footprints
+
+        contained, partial = [], []
+        prepared_region = prep(region)
+        for candidate in tree.query(region):
+            layer_id = layer_ids[id(candidate)]
+            for footprint in footprints[layer_id]:
+                if prepared_region.contains(footprint):
+                    contained.append(layer_id)
+                    break
+                if not prepared_region.intersects(footprint):
+                    break
+            else:
+                partial.append(layer_id)
+        return contained, partial + self._unfootprinted
+
+
+layer_footprints = LayerFootprints()
+
+
+class ShapefileRenderer(BaseRenderer):
+    media_type = 'application/zip'
+    format = 'raw'
+
+    # Downloads are normally streamed by the view (see
+    # shapefile_response); this is retained for responses that already
+    # have their data in memory.
+    def render(self, data, media_type=None, renderer_context=None):
+        records = iter([data['fields'], *data['data']])
+        return b''.join(shapefile_zip_stream(data['file_name'], records))
 
 
 # request as .../transect/?line= x1 y1,x2 y2, ...,xn yn&layers=layer1,layer2..
@@ -820,81 +1525,34 @@ def transect(request):
         if required not in request.query_params:
             raise ValidationError({"message": "Required parameter '{}' is missing".format(required)})
 
-    ordered_segments = []
-    distance = 0
-    segments = defaultdict(dict)
-    start_segment = None
+    vertices = parse_line(request.query_params.get('line'))
+    layers = request.query_params.get('layers').lower().split(',')
+    return Response(transect_segments(vertices, layers))
 
-    line = request.query_params.get('line')
-    linestring = 'LINESTRING(' + line + ')'
 
-    # Lines don't really have a direction, so we can't make assumptions
-    # about how they will be returned
-    start_pt = tuple(map(D, line.split(',', 1)[0].split(' ')))
-    start_percentage = 0
+# POST .../transectbatch/ with {"lines": ["x1 y1,x2 y2,...,xn yn", ...], "layers": "layer1,layer2.."}
+# Responds with newline-delimited JSON, one {"index": i, "segments": [...]}
+# per line (in no particular order), as each is ready
+@action(detail=False, methods=['POST'])
+@api_view(['POST'])
+def transect_batch(request):
+    for required in ['lines', 'layers']:
+        if required not in request.data:
+            raise ValidationError({"message": "Required parameter '{}' is missing".format(required)})
 
-    # To ensure polygons are inserted in the order of layer
-    # ordering, we add a priority to sort by -- which means
-    # generating a union-all statement by layer:
-    layers = request.query_params.get('layers').lower().split(',')
-    layer_stmt = ('select layer_name, habitat, geom, {} as priority '
-                  'from SeamapAus_Regions_VIEW '
-                  'where lower(layer_name) = %s and geom.STIntersects(@line) = 1')
-    layers_placeholder = '\nUNION ALL\n'.join( layer_stmt.format(i) for i,_ in enumerate(layers) )
+    lines = request.data['lines']
+    if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+        raise ValidationError({"message": "'lines' must be a list of lines"})
+    if len(lines) > settings.TRANSECT_BATCH_MAX_LINES:
+        raise ValidationError({"message": f"No more than {settings.TRANSECT_BATCH_MAX_LINES} lines can be requested at once"})
+    lines = [parse_line(line) for line in lines]
+    layers = str(request.data['layers']).lower().split(',')
 
-    with connections['transects'].cursor() as cursor:
-        cursor.execute(SQL_GET_TRANSECT.format(layers_placeholder),
-                       [linestring] + layers)
-        while True:
-            try:
-                for row in cursor.fetchall():
-                    [startx, starty, endx, endy, length, layer_name, name] = row
-                    p1, p2 = (D(startx), D(starty)), (D(endx), D(endy))
-                    segment = p1, p2, layer_name, name, length
-                    if p1 == p2:
-                        continue
-                    distance += length
-                    segments[p1][p2] = segment
-                    segments[p2][p1] = segment
-                    if p1 == start_pt or p2 == start_pt:
-                        start_segment = segment
-                if not cursor.nextset():
-                    break
-            except ProgrammingError:
-                if not cursor.nextset():
-                    break
+    def records():
+        for index, segments in batch_transect_segments(lines, layers):
+            yield json.dumps({'index': index, 'segments': segments}) + '\n'
 
-    p1, p2, _, _, _ = start_segment
-    if p1 != start_pt:
-        p1, p2 = p2, p1
-    start_distance = 0
-    # p1 is the start point; it will always be the "known" point, and p2 is the next one to find:
-    while True:
-        _, _, layer_name, name, length = segments[p1][p2]
-        end_distance = start_distance + length
-        end_percentage = start_percentage + 100*length/float(distance)
-        ordered_segments.append({'layer_name': layer_name,
-                                 'name': name,
-                                 'start_distance': start_distance,
-                                 'end_distance': end_distance,
-                                 'start_percentage': start_percentage,
-                                 'end_percentage': end_percentage,
-                                 'startx': p1[0],
-                                 'starty': p1[1],
-                                 'endx': p2[0],
-                                 'endy': p2[1]})
-        start_percentage = end_percentage
-        start_distance = end_distance
-        del segments[p1][p2]
-        if not segments[p1]: del segments[p1]
-        del segments[p2][p1]
-        if not segments[p2]: del segments[p2]
-
-        if not segments:
-            break
-        p1, p2 = p2, list(segments[p2].keys())[0]
-
-    return Response(ordered_segments)
+    return StreamingHttpResponse(records(), content_type='application/x-ndjson')
 
 
 # .../regions?boundary=boundarylayer&habitat=habitatlayer&x=longitude&y=latitude
@@ -933,7 +1591,12 @@ def regions(request):
         if boundary_info:
             boundary_name, boundary_area = boundary_info
 
-            cursor.execute(SQL_GET_STATS.format('geom.STAsBinary() as geom,' if is_download else ''),
+            if is_download:
+                return shapefile_response(boundary_name,
+                                          query_records(SQL_GET_STATS.format('geom.STAsBinary() as geom,'),
+                                                        [boundary_area, boundary_name, boundary, habitat]))
+
+            cursor.execute(SQL_GET_STATS.format(''),
                            [boundary_area, boundary_name, boundary, habitat])
 
             # Convert plain list of tuples to list of dicts by zipping
@@ -942,13 +1605,6 @@ def regions(request):
             namedrow = namedtuple('Result', [col for col in columns])
             results = [namedrow(*row) for row in cursor.fetchall()]
 
-            if is_download:
-                return Response({'data': results,
-                                 'fields': cursor.description,
-                                 'file_name': boundary_name},
-                                content_type='application/zip',
-                                headers={'Content-Disposition': 'attachment; filename="{}.zip"'.format(boundary_name)})
-
             # HTML only; add a derived row (doing it in SQL was getting complicated and slow):
             downloadable = len(results)
             area = boundary_area / 1000000 - float( sum(row.area or 0 for row in results) )
@@ -1033,7 +1689,6 @@ def subset(request):
 
     geom_col = None
     colnames = []
-    field_metadata = []
     with connections['transects'].cursor() as cursor:
         columns = list(cursor.columns(table=table_name))
 
@@ -1052,15 +1707,8 @@ def subset(request):
         if settings.OGR2OGR_PATH:
             return ogr2ogr_subset(table_name, geom_col, colnames, parse_bounds(bounds_str))
 
-        subset_sql = SQL_GET_SUBSET.format(geom_col, ','.join([f"\"{c}\"" for c in colnames]), table_name, f"\"{geom_col}\"")
-        cursor.execute(subset_sql, parse_bounds(bounds_str))
-        data = cursor.fetchall()
-        field_metadata = cursor.description
-
-    return Response({'data': data, 'file_name': table_name, 'fields': field_metadata},
-                    content_type='application/zip',
-                    headers={'Content-Disposition':
-                             'attachment; filename="{}.zip"'.format(table_name)})
+    subset_sql = SQL_GET_SUBSET.format(geom_col, ','.join([f"\"{c}\"" for c in colnames]), table_name, f"\"{geom_col}\"")
+    return shapefile_response(table_name, query_records(subset_sql, parse_bounds(bounds_str)))
 
 @action(detail=False)
 @api_view()
@@ -1126,55 +1774,21 @@ def habitat_statistics(request):
     ecoregion            = params.get('ecoregion')
     is_download = request.accepted_renderer.format == 'raw'
 
-    habitat_stats = []
-
-    with connections['transects'].cursor() as cursor:
-        if boundary_type == 'amp':
-            cursor.execute(SQL_GET_AMP_BOUNDARY_AREA, [network, park, zone, zone_iucn, zone_id])
-        elif boundary_type == 'imcra':
-            cursor.execute(SQL_GET_IMCRA_BOUNDARY_AREA, [provincial_bioregion, mesoscale_bioregion])
-        elif boundary_type == 'meow':
-            cursor.execute(SQL_GET_MEOW_BOUNDARY_AREA, [realm, province, ecoregion])
-        else:
-            raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
-
-        boundary_area = float(cursor.fetchone()[0])
+    if boundary_type == 'amp':
+        boundary = (network, park, zone, zone_iucn, zone_id)
+    elif boundary_type == 'imcra':
+        boundary = (provincial_bioregion, mesoscale_bioregion)
+    elif boundary_type == 'meow':
+        boundary = (realm, province, ecoregion)
+    else:
+        raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
 
-        if boundary_type == 'amp':
-            cursor.execute(SQL_GET_AMP_HABITAT_STATS.format(SQL_GEOM_BINARY_COL if is_download else ''), [network, park, zone, zone_iucn, zone_id, boundary_area])
-        elif boundary_type == 'imcra':
-            cursor.execute(SQL_GET_IMCRA_HABITAT_STATS.format(SQL_GEOM_BINARY_COL if is_download else ''), [provincial_bioregion, mesoscale_bioregion, boundary_area])
-        elif boundary_type == 'meow':
-            cursor.execute(SQL_GET_MEOW_HABITAT_STATS.format(SQL_GEOM_BINARY_COL if is_download else ''), [realm, province, ecoregion, boundary_area])
-        else:
-            raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
+    habitat_stats = boundary_statistics('habitat', boundary_type, boundary, is_download)
 
-        columns = [col[0] for col in cursor.description]
-        namedrow = namedtuple('Result', columns)
-        results = [namedrow(*row) for row in cursor.fetchall()]
-
-        if is_download:
-            boundary_name = ''
-            if boundary_type == 'amp':
-                boundary_name = ' - '.join([v for v in [network, park, zone, zone_iucn, zone_id] if v])
-            elif boundary_type == 'imcra':
-                boundary_name = ' - '.join([v for v in [provincial_bioregion, mesoscale_bioregion] if v])
-            elif boundary_type == 'meow':
-                boundary_name = ' - '.join([v for v in [realm, province, ecoregion] if v])
-            else:
-                raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
-            return Response({'data': results,
-                                'fields': cursor.description,
-                                'file_name': boundary_name},
-                            content_type='application/zip',
-                            headers={'Content-Disposition': 'attachment; filename="{}.zip"'.format(boundary_name)})
-        
-        habitat_stats = [row._asdict() for row in results]
-
-        mapped_area = float(sum(v['area'] for v in habitat_stats))
-        mapped_percentage = 100 * mapped_area / boundary_area
-        habitat_stats.append({'habitat': None, 'area': mapped_area, 'mapped_percentage': None, 'total_percentage': mapped_percentage})
-        return Response(habitat_stats)
+    if is_download:
+        boundary_name = ' - '.join([v for v in boundary if v])
+        return shapefile_response(boundary_name, iter(habitat_stats))
+    return Response(habitat_stats)
 
 @action(detail=False)
 @api_view()
@@ -1198,55 +1812,21 @@ def bathymetry_statistics(request):
     ecoregion            = params.get('ecoregion')
     is_download = request.accepted_renderer.format == 'raw'
 
-    bathymetry_stats = []
-
-    with connections['transects'].cursor() as cursor:
-        if boundary_type == 'amp':
-            cursor.execute(SQL_GET_AMP_BOUNDARY_AREA, [network, park, zone, zone_iucn, zone_id])
-        elif boundary_type == 'imcra':
-            cursor.execute(SQL_GET_IMCRA_BOUNDARY_AREA, [provincial_bioregion, mesoscale_bioregion])
-        elif boundary_type == 'meow':
-            cursor.execute(SQL_GET_MEOW_BOUNDARY_AREA, [realm, province, ecoregion])
-        else:
-            raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
-
-        boundary_area = float(cursor.fetchone()[0])
-
-        if boundary_type == 'amp':
-            cursor.execute(SQL_GET_AMP_BATHYMETRY_STATS.format(SQL_GEOM_BINARY_COL if is_download else ''), [network, park, zone, zone_iucn, zone_id, boundary_area])
-        elif boundary_type == 'imcra':
-            cursor.execute(SQL_GET_IMCRA_BATHYMETRY_STATS.format(SQL_GEOM_BINARY_COL if is_download else ''), [provincial_bioregion, mesoscale_bioregion, boundary_area])
-        elif boundary_type == 'meow':
-            cursor.execute(SQL_GET_MEOW_BATHYMETRY_STATS.format(SQL_GEOM_BINARY_COL if is_download else ''), [realm, province, ecoregion, boundary_area])
-        else:
-            raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
-
-        columns = [col[0] for col in cursor.description]
-        namedrow = namedtuple('Result', columns)
-        results = [namedrow(*row) for row in cursor.fetchall()]
-
-        if is_download:
-            boundary_name = ''
-            if boundary_type == 'amp':
-                boundary_name = ' - '.join([v for v in [network, park, zone, zone_iucn, zone_id] if v])
-            elif boundary_type == 'imcra':
-                boundary_name = ' - '.join([v for v in [provincial_bioregion, mesoscale_bioregion] if v])
-            elif boundary_type == 'meow':
-                boundary_name = ' - '.join([v for v in [realm, province, ecoregion] if v])
-            else:
-                raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
-            return Response({'data': results,
-                                'fields': cursor.description,
-                                'file_name': boundary_name},
-                            content_type='application/zip',
-                            headers={'Content-Disposition': 'attachment; filename="{}.zip"'.format(boundary_name)})
+    if boundary_type == 'amp':
+        boundary = (network, park, zone, zone_iucn, zone_id)
+    elif boundary_type == 'imcra':
+        boundary = (provincial_bioregion, mesoscale_bioregion)
+    elif boundary_type == 'meow':
+        boundary = (realm, province, ecoregion)
+    else:
+        raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
 
-        bathymetry_stats = [row._asdict() for row in results]
+    bathymetry_stats = boundary_statistics('bathymetry', boundary_type, boundary, is_download)
 
-        mapped_area = float(sum(v['area'] for v in bathymetry_stats))
-        mapped_percentage = 100 * mapped_area / boundary_area
-        bathymetry_stats.append({'resolution': None, 'rank': None, 'area': mapped_area, 'mapped_percentage': None, 'total_percentage': mapped_percentage})
-        return Response(bathymetry_stats)
+    if is_download:
+        boundary_name = ' - '.join([v for v in boundary if v])
+        return shapefile_response(boundary_name, iter(bathymetry_stats))
+    return Response(bathymetry_stats)
 
 @action(detail=False)
 @api_view()
@@ -1268,56 +1848,49 @@ def habitat_observations(request):
     province             = params.get('province')
     ecoregion            = params.get('ecoregion')
 
-    global_archive = None
-    sediment = None
-    squidle = None
+    if boundary_type == 'amp':
+        boundary = (network, park, zone, zone_iucn, zone_id)
+    elif boundary_type == 'imcra':
+        boundary = (provincial_bioregion, mesoscale_bioregion)
+    elif boundary_type == 'meow':
+        boundary = (realm, province, ecoregion)
+    else:
+        raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
+
+    # Each source is queried concurrently on its own connection; sources
+    # that fail, or don't finish within their timeout, are returned as
+    # null.
+    futures = {
+        _habitat_observations_executor.submit(
+            habitat_observations_stats,
+            obs_sql[boundary_type] + stats_sql,
+            list(boundary),
+            settings.HABITAT_OBSERVATIONS_TIMEOUTS[source]
+        ): source
+        for source, (obs_sql, stats_sql) in SQL_GET_HABITAT_OBS.items()
+    }
 
-    with connections['transects'].cursor() as cursor:
-        # Global Archives stats
-        if boundary_type == 'amp':
-            cursor.execute(SQL_GET_AMP_HABITAT_OBS_GLOBALARCHIVE + SQL_GET_GLOBALARCHIVE_STATS, [network, park, zone, zone_iucn, zone_id])
-        elif boundary_type == 'imcra':
-            cursor.execute(SQL_GET_IMCRA_HABITAT_OBS_GLOBALARCHIVE + SQL_GET_GLOBALARCHIVE_STATS, [provincial_bioregion, mesoscale_bioregion])
-        elif boundary_type == 'meow':
-            cursor.execute(SQL_GET_MEOW_HABITAT_OBS_GLOBALARCHIVE + SQL_GET_GLOBALARCHIVE_STATS, [realm, province, ecoregion])
-        else:
-            raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
+    observations = dict.fromkeys(SQL_GET_HABITAT_OBS)
+    start = time.monotonic()
+    deadlines = {future: start + settings.HABITAT_OBSERVATIONS_TIMEOUTS[source] for future, source in futures.items()}
+    pending = set(futures)
+    while pending:
+        timeout = max(0, min(deadlines[future] for future in pending) - time.monotonic())
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                observations[futures[future]] = future.result()
+            except Exception as e:
+                logging.error('Error retrieving %s observations for %s boundary %s', futures[future], boundary_type, boundary, exc_info=e)
 
-        columns = [col[0] for col in cursor.description]
-        namedrow = namedtuple('Result', columns)
-        result = namedrow(*cursor.fetchone())
-        global_archive = result._asdict()
-
-        # Marine Sediments stats
-        if boundary_type == 'amp':
-            cursor.execute(SQL_GET_AMP_HABITAT_OBS_SEDIMENT + SQL_GET_SEDIMENT_STATS, [network, park, zone, zone_iucn, zone_id])
-        elif boundary_type == 'imcra':
-            cursor.execute(SQL_GET_IMCRA_HABITAT_OBS_SEDIMENT + SQL_GET_SEDIMENT_STATS, [provincial_bioregion, mesoscale_bioregion])
-        elif boundary_type == 'meow':
-            cursor.execute(SQL_GET_MEOW_HABITAT_OBS_SEDIMENT + SQL_GET_SEDIMENT_STATS, [realm, province, ecoregion])
-        else:
-            raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
+        expired = {future for future in pending if time.monotonic() >= deadlines[future]}
+        for future in expired:
+            # Cancelled if it hasn't started; otherwise its query times out
+            future.cancel()
+            logging.warning('Timed out retrieving %s observations for %s boundary %s', futures[future], boundary_type, boundary)
+        pending -= expired
 
-        columns = [col[0] for col in cursor.description]
-        namedrow = namedtuple('Result', columns)
-        result = namedrow(*cursor.fetchone())
-        sediment = result._asdict()
-
-        # SQUIDLE observations
-        if boundary_type == 'amp':
-            cursor.execute(SQL_GET_AMP_HABITAT_OBS_SQUIDLE + SQL_GET_SQUIDLE_STATS, [network, park, zone, zone_iucn, zone_id])
-        elif boundary_type == 'imcra':
-            cursor.execute(SQL_GET_IMCRA_HABITAT_OBS_SQUIDLE + SQL_GET_SQUIDLE_STATS, [provincial_bioregion, mesoscale_bioregion])
-        elif boundary_type == 'meow':
-            cursor.execute(SQL_GET_MEOW_HABITAT_OBS_SQUIDLE + SQL_GET_SQUIDLE_STATS, [realm, province, ecoregion])
-        else:
-            raise ValidationError({"message": f"'{boundary_type}' is not a valid value for 'boundary-type'"})
-        
-        columns = [col[0] for col in cursor.description]
-        namedrow = namedtuple('Result', columns)
-        result = namedrow(*cursor.fetchone())
-        squidle = result._asdict()
-        return Response({'global_archive': global_archive, 'sediment': sediment, 'squidle': squidle})
+    return Response(observations)
 
 @action(detail=False)
 @api_view()
@@ -1390,24 +1963,26 @@ def region_report_data(request):
         'version':      '2.0.0',
         'typeNames':    boundary_simplified['layer_name'],
         'outputFormat': 'application/json',
-        'cql_filter': (f"RESNAME='{park}'" if park else f"NETNAME='{network}'")
+        'cql_filter': (f"RESNAME='{park}'" if park else f"NETNAME='{network}'"),
+        'count':      1
     }
 
     try:
-        r = http_session().get(url=boundary_simplified['server_url'], params=params)
+        features = upstream.get_geojson(url=boundary_simplified['server_url'], params=params)
     except Exception as e:
         raise Exception(f"Cannot retrieve GeoJSON from geoserver ({boundary_simplified['server_url']})") from e
     try:
-        r_data = r.json()
-        boundary_type = r_data['features'][0]['geometry']['type']
+        with features:
+            geometry = next(iter(features))['geometry']
+        boundary_type = geometry['type']
         if boundary_type == 'Polygon':
-            data['boundary'] = [r_data['features'][0]['geometry']['coordinates']]
+            data['boundary'] = [geometry['coordinates']]
         elif boundary_type == 'MultiPolygon':
-            data['boundary'] = r_data['features'][0]['geometry']['coordinates']
+            data['boundary'] = geometry['coordinates']
         else:
             raise Exception(f"Unexpected boundary type: {boundary_type}")
     except Exception as e:
-        raise Exception(f"Cannot decode geoserver response into JSON:\n{r.text}") from e
+        raise Exception(f"Cannot decode geoserver response into JSON ({boundary_simplified['server_url']})") from e
 
     if park:
         data['depths'] = serializers.AmpDepthZonesSerializer(
@@ -1451,14 +2026,25 @@ def data_in_region(request):
         params['north']
     )
 
+    if layer_footprints.is_empty():
+        with connections['transects'].cursor() as cursor:
+            cursor.execute(SQL_GET_DATA_IN_REGION, [select.wkt])
+            layer_ids = [row[0] for row in cursor.fetchall()]
+        layer_ids.sort()
+        return Response(layer_ids)
+
+    layer_ids, candidate_layer_ids = layer_footprints.query(select)
     with connections['transects'].cursor() as cursor:
-        cursor.execute(SQL_GET_DATA_IN_REGION, [select.wkt])
-        layer_ids = [row[0] for row in cursor.fetchall()]
-    
+        for i in range(0, len(candidate_layer_ids), DATA_IN_REGION_CANDIDATE_CHUNK_SIZE):
+            chunk = candidate_layer_ids[i:i + DATA_IN_REGION_CANDIDATE_CHUNK_SIZE]
+            sql = SQL_GET_CANDIDATE_DATA_IN_REGION.format(', '.join(['(%s)'] * len(chunk)))
+            cursor.execute(sql, [select.wkt, *chunk])
+            layer_ids += [row[0] for row in cursor.fetchall()]
+    layer_ids.sort()
+
     return Response(layer_ids)
 
 @action(detail=False)
-@cache_page(60 * 15)
 @api_view()
 def cql_filter_values(request):
     for required in ['rich-layer-id']:
@@ -1471,7 +2057,6 @@ def cql_filter_values(request):
         rich_layer = RichLayer.objects.get(id=params['rich-layer-id'])
     except RichLayer.DoesNotExist as e:
         raise ValidationError({"message": "'{}' is not a valid rich layer".format(params['rich-layer-id'])})
-    cql_properties = rich_layer.controls.values_list('cql_property', flat=True)
     
     # We can only request CQL filter values for WMS layers
     if rich_layer.layer.layer_type not in ['wms', 'wms-non-tiled']:
@@ -1481,7 +2066,7 @@ def cql_filter_values(request):
         })
     else:
         try:
-            cql_property_values = rich_layer.layer.cql_property_values(cql_properties)
+            cql_property_values = get_cql_filter_values(rich_layer)
         except Exception:
             # In the event the server is down, or the layer is unsupported, return an empty response
             return Response({
@@ -1512,7 +2097,6 @@ def dynamic_pill_region_control_values(request):
 
 
 @action(methods=['GET'], detail=False)
-@cache_page(60 * 15)
 @api_view()
 def layer_legend(request: Request, layer_id: int):
     try:
@@ -1521,7 +2105,25 @@ def layer_legend(request: Request, layer_id: int):
         return Response("Layer not found", status=400)
     
     try:
-        legend = layer.get_legend()
+        legend = get_layer_legend(layer)
         return Response(legend)
     except ValueError:
         return Response("No legend available for this layer", status=400)
+
+
+# request as .../layerlegends?ids=1,2,3
+@action(methods=['GET'], detail=False)
+@api_view()
+def layer_legends(request: Request):
+    if 'ids' not in request.query_params:
+        raise ValidationError({"message": "Required parameter 'ids' is missing"})
+
+    try:
+        layer_ids = [int(layer_id) for layer_id in request.query_params['ids'].split(',') if layer_id]
+    except ValueError:
+        raise ValidationError({"message": f"'{request.query_params['ids']}' is not a valid value for 'ids'"})
+    if len(layer_ids) > settings.LAYER_LEGENDS_MAX_IDS:
+        raise ValidationError({"message": f"No more than {settings.LAYER_LEGENDS_MAX_IDS} layer ids may be requested at once"})
+
+    layers = list(models.Layer.objects.filter(id__in=layer_ids))
+    return Response(get_layer_legends(layers))
@@ -0,0 +1,58 @@
+# Seamap: view and interact with Australian coastal habitat data
+# Copyright (c) 2017, Institute of Marine & Antarctic Studies.  Written by Condense Pty Ltd.
+# Released under the Affero General Public Licence (AGPL) v3.  See LICENSE file for details.
+import threading
+
+from mssql.base import Database, DatabaseWrapper as MSSQLDatabaseWrapper
+
+from .pool import ConnectionPool
+
+# One pool per database alias, shared by every thread in the process:
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias):
+    "The connection pool for a database alias, or None if it hasn't been used yet"
+    return _pools.get(alias)
+
+
+def pool_stats():
+    "Metrics of every connection pool, by database alias"
+    return {alias: pool.stats() for alias, pool in list(_pools.items())}
+
+
+class DatabaseWrapper(MSSQLDatabaseWrapper):
+    """
+    mssql-django backend which checks connections out of a per-alias
+    ConnectionPool, instead of opening (and logging in) a new connection
+    each time Django connects, and returns them to the pool when Django
+    closes them.  Connections that saw an error, or are closed mid-
+    transaction, are discarded rather than returned.
+
+    Use with CONN_MAX_AGE = 0 (the default), and configure the pool with
+    the 'pool' dict in OPTIONS (keyword arguments to ConnectionPool).
+    """
+    def pool(self):
+        with _pools_lock:
+            pool = _pools.get(self.alias)
+            if pool is None:
+                pool = _pools[self.alias] = ConnectionPool(**self.settings_dict['OPTIONS'].get('pool', {}))
+        return pool
+
+    def get_new_connection(self, conn_params):
+        return self.pool().checkout(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is None:
+            return
+        discard = self.errors_occurred or self.in_atomic_block
+        if not discard:
+            # Leave the connection as a new one would be; closing it would
+            # have rolled back anything uncommitted too:
+            try:
+                self.connection.rollback()
+                self.connection.autocommit = False
+            except Database.Error:
+                discard = True
+        self.pool().checkin(self.connection, discard=discard)
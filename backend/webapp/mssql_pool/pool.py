@@ -0,0 +1,155 @@
+# Seamap: view and interact with Australian coastal habitat data
+# Copyright (c) 2017, Institute of Marine & Antarctic Studies.  Written by Condense Pty Ltd.
+# Released under the Affero General Public Licence (AGPL) v3.  See LICENSE file for details.
+from collections import deque
+import logging
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    A thread-safe, bounded pool of DB-API connections.
+
+    At most `size` connections are open at once (idle or in use); a
+    checkout when they're all in use waits up to `timeout` seconds for
+    one to be returned.  Connections older than `recycle` seconds are
+    closed rather than reused, and connections that have been idle for
+    longer than `health_check_interval` seconds are checked with a
+    trivial query before being handed out.
+
+    Args:
+        size (int): maximum number of open connections
+        timeout (float): seconds to wait for a connection before raising
+            PoolTimeout
+        recycle (float): maximum age of a connection in seconds (None to
+            never recycle)
+        health_check_interval (float): idle time in seconds after which
+            a connection is checked before reuse (None to never check)
+    """
+    def __init__(self, size=10, timeout=30, recycle=3600, health_check_interval=60):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.health_check_interval = health_check_interval
+
+        self._condition = threading.Condition()
+        self._idle = deque()  # (connection, last used)
+        self._created = {}    # id(connection) -> creation time
+        self._in_use = 0
+
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._connections_created = 0
+        self._connections_discarded = 0
+        self._health_check_failures = 0
+
+    def checkout(self, connect):
+        """
+        Checks out a connection, reusing an idle one if possible and
+        otherwise calling connect() to open a new one.
+        """
+        start = time.monotonic()
+        with self._condition:
+            while not self._idle and self._in_use >= self.size:
+                remaining = start + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"Timed out after {self.timeout}s waiting for one of {self.size} pooled connections")
+                self._condition.wait(remaining)
+
+            self._in_use += 1
+            idle = self._idle.pop() if self._idle else None
+
+            waited = time.monotonic() - start
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+
+        try:
+            if idle:
+                connection, last_used = idle
+                if self._is_reusable(connection, last_used):
+                    return connection
+                self._close(connection)
+            connection = connect()
+        except BaseException:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._created[id(connection)] = time.monotonic()
+            self._connections_created += 1
+        return connection
+
+    def checkin(self, connection, discard=False):
+        "Returns a connection to the pool, or closes it if discard is true or it's due for recycling"
+        discard = discard or self._expired(connection)
+        with self._condition:
+            self._in_use -= 1
+            if not discard:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+        if discard:
+            self._close(connection)
+
+    def close_idle(self):
+        "Closes all idle connections (eg, before forking)"
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'size':                  self.size,
+                'in_use':                self._in_use,
+                'idle':                  len(self._idle),
+                'checkouts':             self._checkouts,
+                'mean_wait_time':        self._wait_time / self._checkouts if self._checkouts else 0.0,
+                'max_wait_time':         self._max_wait_time,
+                'timeouts':              self._timeouts,
+                'connections_created':   self._connections_created,
+                'connections_discarded': self._connections_discarded,
+                'health_check_failures': self._health_check_failures,
+            }
+
+    def _expired(self, connection):
+        created = self._created.get(id(connection))
+        return self.recycle is not None and created is not None and time.monotonic() - created > self.recycle
+
+    def _is_reusable(self, connection, last_used):
+        if self._expired(connection):
+            return False
+        if self.health_check_interval is not None and time.monotonic() - last_used > self.health_check_interval:
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+            except Exception as e:
+                logging.warning('Pooled connection failed its health check', exc_info=e)
+                with self._condition:
+                    self._health_check_failures += 1
+                return False
+        return True
+
+    def _close(self, connection):
+        with self._condition:
+            self._created.pop(id(connection), None)
+            self._connections_discarded += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
@@ -93,6 +93,15 @@ WSGI_APPLICATION = 'webapp.wsgi.application'
 # https://docs.djangoproject.com/en/1.8/ref/settings/#databases
 
 # NOTE: need two defined; both default, and "transects"
+#
+# For MSSQL, use 'ENGINE': 'webapp.mssql_pool' (in place of 'mssql') to
+# pool connections, configured with a 'pool' entry in OPTIONS (with
+# CONN_MAX_AGE left as 0), eg:
+#     'OPTIONS': {
+#         'driver': 'ODBC Driver 17 for SQL Server',
+#         'pool': {'size': 10, 'timeout': 30, 'recycle': 3600, 'health_check_interval': 60},
+#     },
+# Pool metrics are available to staff at /api/metrics.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -143,6 +152,98 @@ OGR2OGR_PATH = None
 # (eg, if django is using a different driver to ogr2ogr)
 OGR2OGR_DRIVER = None
 
+# Pure-python shapefile downloads are streamed: rows are fetched from
+# the database in batches of SHAPEFILE_BATCH_SIZE, and the shapefile
+# parts are held in memory until they exceed SHAPEFILE_SPOOL_MAX_SIZE
+# bytes, after which they are spooled to a temporary file:
+SHAPEFILE_BATCH_SIZE = 500
+SHAPEFILE_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# Habitat and bathymetry statistics are cached against the version of
+# the precalculated boundary tables, so they don't need to expire:
+BOUNDARY_STATISTICS_CACHE_TIMEOUT = None
+
+# Transects are cached against the version of the habitat data
+# ('regions' in BOUNDARY_PRECALCULATION_VERSION) and of the layers (which
+# changes whenever a layer is saved in the admin), keyed on their line
+# rounded to TRANSECT_CACHE_LINE_PRECISION decimal places (of metres, in
+# EPSG:3112). The timeout covers habitat data changed without updating
+# that version:
+TRANSECT_CACHE_LINE_PRECISION = 1
+TRANSECT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+# Batch transect requests (see transect_batch) can have up to
+# TRANSECT_BATCH_MAX_LINES lines, which are intersected
+# TRANSECT_BATCH_SIZE lines per query:
+TRANSECT_BATCH_MAX_LINES = 1000
+TRANSECT_BATCH_SIZE = 100
+
+# The habitat observation sources are queried concurrently, by up to
+# HABITAT_OBSERVATIONS_WORKERS threads shared between requests; a source
+# that fails, or takes longer than its timeout (in seconds, after which
+# its query is cancelled on SQL Server), is returned as null rather than
+# holding up the rest:
+HABITAT_OBSERVATIONS_TIMEOUTS = {
+    'global_archive': 30,
+    'sediment': 30,
+    'squidle': 30,
+}
+HABITAT_OBSERVATIONS_WORKERS = 12
+
+# How often (in seconds) data_in_region checks whether the feature index
+# has been rebuilt, and so whether to reload its layer footprints:
+LAYER_FOOTPRINTS_RELOAD_INTERVAL = 60
+
+# Tolerances (in degrees) of the simplified layer footprints built with
+# the feature index; data_in_region tests them coarsest first:
+LAYER_FEATURE_FOOTPRINT_TOLERANCES = [0.1, 0.01, 0.001]
+
+# Requests to upstream map servers (see webapp.upstream) share a pooled
+# session per host, with at most UPSTREAM_MAX_CONNECTIONS_PER_HOST
+# requests to a host at once. UPSTREAM_TIMEOUT is the default (connect,
+# read) timeout in seconds, and UPSTREAM_CACHE_MAX_ENTRIES the number of
+# responses kept for conditional GETs:
+UPSTREAM_MAX_CONNECTIONS_PER_HOST = 10
+UPSTREAM_TIMEOUT = (10, 60)
+UPSTREAM_RETRIES = 3
+UPSTREAM_CACHE_MAX_ENTRIES = 1000
+
+# Pages of ArcGIS layer features (see Layer.iter_geojson_features) are
+# retrieved this many at a time:
+LAYER_GEOJSON_FETCH_WORKERS = 4
+
+# The sub-images of subdivided WMS layer previews are retrieved
+# LAYER_PREVIEW_TILE_WORKERS at a time, each with a (connect, read)
+# timeout of LAYER_PREVIEW_TILE_TIMEOUT seconds (retried, as is a 5xx
+# response, UPSTREAM_RETRIES times), and up to LAYER_PREVIEW_TILE_ATTEMPTS
+# attempts for responses that aren't an image:
+LAYER_PREVIEW_TILE_WORKERS = 4
+LAYER_PREVIEW_TILE_TIMEOUT = (10, 120)
+LAYER_PREVIEW_TILE_ATTEMPTS = 3
+
+# Layer legends are stored, and served from storage while being
+# refreshed in the background once they're older than
+# LAYER_LEGEND_MAX_AGE seconds, or LAYER_LEGEND_ERROR_RETRY seconds after
+# a failed refresh (see catalogue.legends):
+LAYER_LEGEND_MAX_AGE = 24 * 60 * 60
+LAYER_LEGEND_ERROR_RETRY = 15 * 60
+LAYER_LEGEND_REFRESH_WORKERS = 4
+
+# layer_legends retrieves the legends of layers without a stored legend
+# concurrently, with up to LAYER_LEGEND_FETCH_WORKERS threads per request,
+# for up to LAYER_LEGENDS_MAX_IDS layers:
+LAYER_LEGEND_FETCH_WORKERS = 8
+LAYER_LEGENDS_MAX_IDS = 500
+
+# The CQL filter values of rich layers are stored (see
+# catalogue.cql_values and the build_cql_filter_values command), and
+# refreshed in the background once they're older than
+# RICH_LAYER_CQL_VALUES_MAX_AGE seconds, or
+# RICH_LAYER_CQL_VALUES_ERROR_RETRY seconds after a failed refresh:
+RICH_LAYER_CQL_VALUES_MAX_AGE = 24 * 60 * 60
+RICH_LAYER_CQL_VALUES_ERROR_RETRY = 15 * 60
+RICH_LAYER_CQL_VALUES_REFRESH_WORKERS = 2
+
 
 MEDIA_ROOT = 'media/'
 MEDIA_URL = 'media/'
@@ -182,6 +283,11 @@ CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.db.DatabaseCache",
         "LOCATION": "django_cache",
+        "OPTIONS": {
+            # Enough for the statistics of every boundary combination
+            # (see the warm_boundary_statistics_cache command):
+            "MAX_ENTRIES": 20000,
+        },
     }
 }
 
@@ -0,0 +1,320 @@
+# Seamap: view and interact with Australian coastal habitat data
+# Copyright (c) 2017, Institute of Marine & Antarctic Studies.  Written by Condense Pty Ltd.
+# Released under the Affero General Public Licence (AGPL) v3.  See LICENSE file for details.
+"""
+Shared client for requests to upstream map servers (GeoServer, ArcGIS
+MapServer/FeatureServer/ImageServer, ...).
+
+Each upstream host gets one pooled requests.Session, shared by every
+thread in the process, so TCP/TLS connections are reused between
+requests rather than set up for each. Concurrent requests to a host are
+capped (UPSTREAM_MAX_CONNECTIONS_PER_HOST), and every request gets the
+same default timeouts and retries. A streamed response counts against
+its host's cap until its body has been read or it's closed, so streamed
+responses must always be closed. Metadata requests (legends, layer
+info, capabilities, ...) can opt into a conditional-GET cache, which
+revalidates a cached response with If-None-Match/If-Modified-Since
+rather than downloading it again, and concurrent identical cached
+requests are made once and share the response.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+import os
+import threading
+from urllib.parse import urlsplit
+
+from django.conf import settings
+import ijson
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+USER_AGENT = 'SeamapBackend/1.0' # Squidle geoserver requires a user agent (ISA-694, ISA-598)
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+# Conditional-GET cache: request key (see _request_key) -> response with
+# an ETag or Last-Modified
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Cached requests underway: request key -> Future of the response, for
+# concurrent identical requests to wait on
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+class _Host:
+    "Pooled session, concurrency cap and metrics of an upstream host"
+    def __init__(self):
+        size = settings.UPSTREAM_MAX_CONNECTIONS_PER_HOST
+        retry_strategy = Retry(
+            total=settings.UPSTREAM_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=[ 500, 502, 503, 504 ]
+        )
+        # pool_block, so the pool never opens (and then discards) more
+        # than pool_maxsize connections
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=True, max_retries=retry_strategy)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.semaphore = threading.BoundedSemaphore(size)
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+        self.not_modified = 0
+
+
+def _reset_after_fork():
+    # A forked process mustn't share its parent's pooled connections (or
+    # locks that another of the parent's threads may have held)
+    global _hosts_lock, _cache_lock, _in_flight_lock
+    _hosts.clear()
+    _in_flight.clear()
+    _hosts_lock, _cache_lock, _in_flight_lock = threading.Lock(), threading.Lock(), threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _host(url):
+    parts = urlsplit(url)
+    key = f'{parts.scheme}://{parts.netloc}'
+    with _hosts_lock:
+        host = _hosts.get(key)
+        if host is None:
+            host = _hosts[key] = _Host()
+    return host
+
+
+def prepared_url(url, params=None):
+    "The URL a GET of url with params would request, without making the request"
+    return requests.Request('GET', url, params=params).prepare().url
+
+
+def get(url, params=None, headers=None, timeout=None, verify=True, stream=False, cache=False):
+    """
+    GETs an upstream URL through its host's pooled session.
+
+    Args:
+        url (str): URL to request
+        params (dict): query string parameters
+        headers (dict): additional request headers
+        timeout (float or tuple): (connect, read) timeout in seconds;
+            defaults to UPSTREAM_TIMEOUT
+        verify (bool): whether to verify the server's TLS certificate
+        stream (bool): whether to defer downloading the response body
+            (the response must then be closed, e.g. with a with block)
+        cache (bool): whether to use the conditional-GET cache (only
+            for requests without side effects, and not with stream)
+
+    Returns:
+        requests.Response: the response (which, if it came from the
+        cache, is shared with other callers and must not be modified)
+    """
+    request_url = prepared_url(url, params)
+    if not cache or stream:
+        return _get(request_url, headers, timeout, verify, stream, cache=False)
+
+    key = _request_key(request_url, headers, verify)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _in_flight[key] = Future()
+    if not is_leader:
+        return future.result()
+
+    try:
+        r = _get(request_url, headers, timeout, verify, stream, cache=True)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(r)
+        return r
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+
+
+def _request_key(request_url, headers, verify):
+    "Key of a cached request: requests with different headers or verification may get different responses"
+    return (request_url, tuple(sorted((headers or {}).items())), verify)
+
+
+class GeoJSONFeatures:
+    """
+    The features of a streamed GeoJSON FeatureCollection response, parsed
+    one at a time as they're iterated over, so only the feature being
+    processed is held in memory.
+
+    The collection's other top-level members (links, error,
+    numberMatched, ...) are collected in members as they're parsed; those
+    after the features (as GeoServer puts links) are only there once the
+    features have been iterated over. The response is closed once the
+    features have been iterated over, or on close (e.g. by using this as a
+    context manager to read only the first few features).
+    """
+    def __init__(self, response):
+        self.response = response
+        self.members = {}
+
+    def __iter__(self):
+        with self.response:
+            self.response.raw.decode_content = True
+            events = ijson.parse(self.response.raw, use_float=True)
+            for prefix, event, value in events:
+                if prefix != '' or event != 'map_key':
+                    continue
+                ( key, ( _, event, value ) ) = ( value, next(events) )
+                if key == 'features' and event == 'start_array':
+                    for _, event, value in events:
+                        if event == 'end_array':
+                            break
+                        yield _json_value(events, event, value)
+                else:
+                    self.members[key] = _json_value(events, event, value)
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _json_value(events, event, value):
+    "The JSON value starting with (event, value), built from the rest of its ijson events"
+    if event not in ('start_map', 'start_array'):
+        return value
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    depth = 1
+    for _, event, value in events:
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                return builder.value
+
+
+def get_geojson(url, params=None, headers=None, timeout=None, verify=True):
+    """
+    GETs a GeoJSON FeatureCollection from an upstream URL, streamed: the
+    request is made (and its status checked) here, but the features are
+    only downloaded and parsed as the result is iterated over (see
+    GeoJSONFeatures). Streamed responses aren't cached.
+
+    Returns:
+        GeoJSONFeatures: the features of the response
+    """
+    r = get(url, params=params, headers=headers, timeout=timeout, verify=verify, stream=True)
+    try:
+        r.raise_for_status()
+    except Exception:
+        r.close()
+        raise
+    return GeoJSONFeatures(r)
+
+
+def _get(request_url, headers, timeout, verify, stream, cache):
+    host = _host(request_url)
+    key = _request_key(request_url, headers, verify)
+    headers = dict(headers or {})
+
+    cached = None
+    if cache:
+        with _cache_lock:
+            cached = _cache.get(key)
+        if cached is not None:
+            if cached.headers.get('ETag'):
+                headers['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+    host.semaphore.acquire()
+    release = _releaser(host)
+    with host.lock:
+        host.requests += 1
+        host.in_flight += 1
+    try:
+        r = host.session.get(
+            request_url,
+            headers=headers,
+            timeout=timeout or settings.UPSTREAM_TIMEOUT,
+            verify=verify,
+            stream=stream
+        )
+    except BaseException:
+        with host.lock:
+            host.errors += 1
+        release()
+        raise
+    if stream:
+        # A streamed response's body is still to be downloaded, so it
+        # counts against the host's cap until it has been read or closed
+        # (either of which releases its connection)
+        release_conn = r.raw.release_conn
+        def release_conn_and_host():
+            release_conn()
+            release()
+        r.raw.release_conn = release_conn_and_host
+    else:
+        release()
+
+    if cached is not None and r.status_code == 304:
+        with host.lock:
+            host.not_modified += 1
+        with _cache_lock:
+            if key in _cache:
+                _cache.move_to_end(key)
+        return cached
+
+    if cache:
+        with _cache_lock:
+            if r.status_code == 200 and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+                _cache[key] = r
+                _cache.move_to_end(key)
+                while len(_cache) > settings.UPSTREAM_CACHE_MAX_ENTRIES:
+                    _cache.popitem(last=False)
+            else:
+                _cache.pop(key, None)
+    return r
+
+
+def _releaser(host):
+    "Releases a request's hold on its host (semaphore and in_flight count), once however often it's called"
+    released = threading.Lock()
+    def release():
+        if released.acquire(blocking=False):
+            with host.lock:
+                host.in_flight -= 1
+            host.semaphore.release()
+    return release
+
+
+def stats():
+    "Metrics of each upstream host, and of the conditional-GET cache"
+    with _hosts_lock:
+        hosts = list(_hosts.items())
+    host_stats = {}
+    for key, host in hosts:
+        with host.lock:
+            host_stats[key] = {
+                'requests':     host.requests,
+                'in_flight':    host.in_flight,
+                'errors':       host.errors,
+                'not_modified': host.not_modified,
+            }
+    with _cache_lock:
+        cache_entries = len(_cache)
+    return {'hosts': host_stats, 'cache_entries': cache_entries}
@@ -29,6 +29,7 @@ router.register(r'dynamicpills', viewsets.DynamicPillViewset)
 
 urlpatterns = [
     path('tinymce/', include('tinymce.urls')),
+    re_path(r'^api/habitat/transectbatch', habitat_viewsets.transect_batch),
     re_path(r'^api/habitat/transect', habitat_viewsets.transect),
     re_path(r'^api/habitat/regions', habitat_viewsets.regions, name='habitat-regions'),
     re_path(r'^api/habitat/subset', habitat_viewsets.subset),
@@ -43,7 +44,9 @@ urlpatterns = [
     re_path(r'^api/habitat/cqlfiltervalues', habitat_viewsets.cql_filter_values),
     re_path(r'^api/habitat/dynamicpillregioncontrolvalues', habitat_viewsets.dynamic_pill_region_control_values),
     re_path(r'^api/layerlegend/(?P<layer_id>[^/.]+)', habitat_viewsets.layer_legend, name='layer_legend'),
+    re_path(r'^api/layerlegends', habitat_viewsets.layer_legends, name='layer_legends'),
     re_path(r'^api/siteconfiguration', webapp.viewsets.site_configuration, name='site_configuration'),
+    re_path(r'^api/metrics', webapp.viewsets.metrics, name='metrics'),
     re_path(r'^api/savestates', views.SaveStateView.as_view()),
     re_path(r'^api/squidleannotationsdata', views.SquidleAnnotationsDataView.as_view()),
     re_path(r'^api/', include(router.urls)),
@@ -1,9 +1,12 @@
 # Seamap: view and interact with Australian coastal habitat data
 # Copyright (c) 2017, Institute of Marine & Antarctic Studies.  Written by Condense Pty Ltd.
 # Released under the Affero General Public Licence (AGPL) v3.  See LICENSE file for details.
-from . import models
+from . import models, upstream
+from .mssql_pool.base import pool_stats
+from habitat.viewsets import transect_cache_stats
 from django.views.decorators.cache import cache_page
-from rest_framework.decorators import action, api_view
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.request import Request
 
@@ -17,3 +20,11 @@ def site_configuration(request: Request):
         for site_configuration
         in models.SiteConfiguration.objects.all()}
     )
+
+
+@action(methods=['GET'], detail=False)
+@api_view()
+@permission_classes((IsAdminUser,))
+def metrics(request: Request):
+    "Runtime metrics for sizing and tuning, eg checkout waits of the database connection pools"
+    return Response({'database_pools': pool_stats(), 'upstream': upstream.stats(), 'transect_cache': transect_cache_stats()})
@@ -36,5 +36,10 @@ BEGIN
     ) sub2
     GROUP BY boundary_layer_id, habitat_layer_id, habitat, region, boundary_area;
 
+    -- Invalidate cached transects
+    UPDATE BOUNDARY_PRECALCULATION_VERSION
+    SET version = version + 1, updated = GETDATE()
+    WHERE boundary_type = 'regions';
+
 END
 GO
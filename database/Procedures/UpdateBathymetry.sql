@@ -191,4 +191,11 @@ BEGIN
       WHERE [bathymetry].[RANK] >= @rank;
     COMMIT;
   END;
+
+  -- Invalidate cached boundary statistics
+  UPDATE [dbo].[BOUNDARY_PRECALCULATION_VERSION]
+  SET
+    [version] = [version] + 1,
+    [updated] = GETDATE()
+  WHERE [boundary_type] IN ('amp', 'imcra', 'meow');
 END;
@@ -49,4 +49,11 @@ BEGIN
   FROM [dbo].[VW_BOUNDARY_MEOW] AS [boundary]
   CROSS APPLY [dbo].habitat_intersections([boundary].[geom]) AS [habitat]
   WHERE [habitat].[CATEGORY] = @habitat;
+
+  -- Invalidate cached boundary statistics and transects
+  UPDATE [dbo].[BOUNDARY_PRECALCULATION_VERSION]
+  SET
+    [version] = [version] + 1,
+    [updated] = GETDATE()
+  WHERE [boundary_type] IN ('amp', 'imcra', 'meow', 'regions');
 END;
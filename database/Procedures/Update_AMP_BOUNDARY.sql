@@ -1,8 +1,8 @@
 -- When an AMP boundary has been updated, use this stored procedure to update the
 -- hardcoded values in the BOUNDARY_AMP_HABITAT, BOUNDARY_AMP_BATHYMETRY,
--- BOUNDARY_AMP_HABITAT_OBS_GLOBALARCHIVE, BOUNDARY_AMP_HABITAT_OBS_SEDIMENT, and
--- BOUNDARY_AMP_HABITAT_OBS_SQUIDLE tables (can also be used to add a new boundary
--- to the tables).
+-- BOUNDARY_AMP_HABITAT_OBS_GLOBALARCHIVE, BOUNDARY_AMP_HABITAT_OBS_SEDIMENT,
+-- BOUNDARY_AMP_HABITAT_OBS_SQUIDLE, and BOUNDARY_AMP_AREA tables (can also be used
+-- to add a new boundary to the tables).
 
 CREATE PROCEDURE [dbo].[Update_AMP_BOUNDARY]
   @netname  NVARCHAR(254),
@@ -143,4 +143,14 @@ BEGIN
     ([boundary].[Zone_Category] = @zonename OR @zonename IS NULL) AND
     ([boundary].[IUCN_Category] = @zoneiucn OR @zoneiucn IS NULL) AND
     ([boundary].[Zone_ID] = @zone_id OR @zone_id IS NULL);
+
+  -- Update BOUNDARY_AMP_AREA
+  EXEC [dbo].[Update_AMP_BOUNDARY_AREA] @netname, @resname, @zonename, @zoneiucn, @zone_id;
+
+  -- Invalidate cached boundary statistics
+  UPDATE [dbo].[BOUNDARY_PRECALCULATION_VERSION]
+  SET
+    [version] = [version] + 1,
+    [updated] = GETDATE()
+  WHERE [boundary_type] = 'amp';
 END;
@@ -0,0 +1,116 @@
+-- Recalculates the rows of BOUNDARY_AMP_AREA affected by a change to the AMP
+-- boundaries matching the parameters (NULL parameters match any value; all NULL
+-- recalculates the whole table). Called by Update_AMP_BOUNDARY.
+
+CREATE PROCEDURE [dbo].[Update_AMP_BOUNDARY_AREA]
+  @netname   NVARCHAR(254),
+  @resname   NVARCHAR(254),
+  @zonename  NVARCHAR(254),
+  @zoneiucn  NVARCHAR(5),
+  @zone_id   NVARCHAR(10)
+AS
+BEGIN
+  -- Every level whose boundaries overlap the updated boundaries is affected
+  DELETE FROM [dbo].[BOUNDARY_AMP_AREA]
+  WHERE
+    ([Network] IS NULL OR [Network] = @netname OR @netname IS NULL) AND
+    ([Park] IS NULL OR [Park] = @resname OR @resname IS NULL) AND
+    ([Zone_Category] IS NULL OR [Zone_Category] = @zonename OR @zonename IS NULL) AND
+    ([IUCN_Category] IS NULL OR [IUCN_Category] = @zoneiucn OR @zoneiucn IS NULL) AND
+    ([Zone_ID] IS NULL OR [Zone_ID] = @zone_id OR @zone_id IS NULL);
+
+  INSERT INTO [dbo].[BOUNDARY_AMP_AREA] ([Network], [Park], [Zone_Category], [IUCN_Category], [Zone_ID], [area])
+  SELECT
+    NULL,
+    NULL,
+    NULL,
+    NULL,
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_AMP]
+  UNION ALL
+  SELECT
+    [Network],
+    NULL,
+    NULL,
+    NULL,
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_AMP]
+  WHERE
+    [Network] IS NOT NULL AND
+    ([Network] = @netname OR @netname IS NULL)
+  GROUP BY [Network]
+  UNION ALL
+  SELECT
+    [Network],
+    [Park],
+    NULL,
+    NULL,
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_AMP]
+  WHERE
+    [Network] IS NOT NULL AND
+    [Park] IS NOT NULL AND
+    ([Network] = @netname OR @netname IS NULL) AND
+    ([Park] = @resname OR @resname IS NULL)
+  GROUP BY [Network], [Park]
+  UNION ALL
+  SELECT
+    [Network],
+    [Park],
+    [Zone_Category],
+    NULL,
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_AMP]
+  WHERE
+    [Network] IS NOT NULL AND
+    [Park] IS NOT NULL AND
+    [Zone_Category] IS NOT NULL AND
+    ([Network] = @netname OR @netname IS NULL) AND
+    ([Park] = @resname OR @resname IS NULL) AND
+    ([Zone_Category] = @zonename OR @zonename IS NULL)
+  GROUP BY [Network], [Park], [Zone_Category]
+  UNION ALL
+  SELECT
+    [Network],
+    [Park],
+    [Zone_Category],
+    [IUCN_Category],
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_AMP]
+  WHERE
+    [Network] IS NOT NULL AND
+    [Park] IS NOT NULL AND
+    [Zone_Category] IS NOT NULL AND
+    [IUCN_Category] IS NOT NULL AND
+    ([Network] = @netname OR @netname IS NULL) AND
+    ([Park] = @resname OR @resname IS NULL) AND
+    ([Zone_Category] = @zonename OR @zonename IS NULL) AND
+    ([IUCN_Category] = @zoneiucn OR @zoneiucn IS NULL)
+  GROUP BY [Network], [Park], [Zone_Category], [IUCN_Category]
+  UNION ALL
+  SELECT
+    [Network],
+    [Park],
+    [Zone_Category],
+    [IUCN_Category],
+    [Zone_ID],
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_AMP]
+  WHERE
+    [Network] IS NOT NULL AND
+    [Park] IS NOT NULL AND
+    [Zone_Category] IS NOT NULL AND
+    [IUCN_Category] IS NOT NULL AND
+    [Zone_ID] IS NOT NULL AND
+    ([Network] = @netname OR @netname IS NULL) AND
+    ([Park] = @resname OR @resname IS NULL) AND
+    ([Zone_Category] = @zonename OR @zonename IS NULL) AND
+    ([IUCN_Category] = @zoneiucn OR @zoneiucn IS NULL) AND
+    ([Zone_ID] = @zone_id OR @zone_id IS NULL)
+  GROUP BY [Network], [Park], [Zone_Category], [IUCN_Category], [Zone_ID];
+END;
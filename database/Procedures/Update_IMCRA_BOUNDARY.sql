@@ -1,8 +1,8 @@
 -- When an IMCRA boundary has been updated, use this stored procedure to update the
 -- hardcoded values in the BOUNDARY_IMCRA_HABITAT, BOUNDARY_IMCRA_BATHYMETRY,
 -- BOUNDARY_IMCRA_HABITAT_OBS_GLOBALARCHIVE, BOUNDARY_IMCRA_HABITAT_OBS_SEDIMENT,
--- and BOUNDARY_IMCRA_HABITAT_OBS_SQUIDLE tables (can also be used to add a new
--- boundary to the tables).
+-- BOUNDARY_IMCRA_HABITAT_OBS_SQUIDLE, and BOUNDARY_IMCRA_AREA tables (can also be
+-- used to add a new boundary to the tables).
 
 CREATE PROCEDURE Update_IMCRA_BOUNDARY
   @provincial_bioregion  NVARCHAR(255),
@@ -98,4 +98,14 @@ BEGIN
   WHERE
     ([boundary].[Provincial_Bioregion] = @provincial_bioregion OR @provincial_bioregion IS NULL) AND
     ([boundary].[Mesoscale_Bioregion] = @mesoscale_bioregion OR @mesoscale_bioregion IS NULL);
+
+  -- Update BOUNDARY_IMCRA_AREA
+  EXEC Update_IMCRA_BOUNDARY_AREA @provincial_bioregion, @mesoscale_bioregion;
+
+  -- Invalidate cached boundary statistics
+  UPDATE [dbo].[BOUNDARY_PRECALCULATION_VERSION]
+  SET
+    [version] = [version] + 1,
+    [updated] = GETDATE()
+  WHERE [boundary_type] = 'imcra';
 END;
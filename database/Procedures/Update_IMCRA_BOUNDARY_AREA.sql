@@ -0,0 +1,44 @@
+-- Recalculates the rows of BOUNDARY_IMCRA_AREA affected by a change to the IMCRA
+-- boundaries matching the parameters (NULL parameters match any value; all NULL
+-- recalculates the whole table). Called by Update_IMCRA_BOUNDARY.
+
+CREATE PROCEDURE Update_IMCRA_BOUNDARY_AREA
+  @provincial_bioregion  NVARCHAR(255),
+  @mesoscale_bioregion   NVARCHAR(255)
+AS
+BEGIN
+  -- Every level whose boundaries overlap the updated boundaries is affected
+  DELETE FROM [dbo].[BOUNDARY_IMCRA_AREA]
+  WHERE
+    ([Provincial_Bioregion] IS NULL OR [Provincial_Bioregion] = @provincial_bioregion OR @provincial_bioregion IS NULL) AND
+    ([Mesoscale_Bioregion] IS NULL OR [Mesoscale_Bioregion] = @mesoscale_bioregion OR @mesoscale_bioregion IS NULL);
+
+  INSERT INTO [dbo].[BOUNDARY_IMCRA_AREA] ([Provincial_Bioregion], [Mesoscale_Bioregion], [area])
+  SELECT
+    NULL,
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_IMCRA]
+  UNION ALL
+  SELECT
+    [Provincial_Bioregion],
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_IMCRA]
+  WHERE
+    [Provincial_Bioregion] IS NOT NULL AND
+    ([Provincial_Bioregion] = @provincial_bioregion OR @provincial_bioregion IS NULL)
+  GROUP BY [Provincial_Bioregion]
+  UNION ALL
+  SELECT
+    [Provincial_Bioregion],
+    [Mesoscale_Bioregion],
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_IMCRA]
+  WHERE
+    [Provincial_Bioregion] IS NOT NULL AND
+    [Mesoscale_Bioregion] IS NOT NULL AND
+    ([Provincial_Bioregion] = @provincial_bioregion OR @provincial_bioregion IS NULL) AND
+    ([Mesoscale_Bioregion] = @mesoscale_bioregion OR @mesoscale_bioregion IS NULL)
+  GROUP BY [Provincial_Bioregion], [Mesoscale_Bioregion];
+END;
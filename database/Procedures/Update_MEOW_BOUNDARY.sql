@@ -1,8 +1,8 @@
 -- When a MEOW boundary has been updated, use this stored procedure to update the
 -- hardcoded values in the BOUNDARY_MEOW_HABITAT, BOUNDARY_MEOW_BATHYMETRY,
 -- BOUNDARY_MEOW_HABITAT_OBS_GLOBALARCHIVE, BOUNDARY_MEOW_HABITAT_OBS_SEDIMENT,
--- BOUNDARY_MEOW_HABITAT_OBS_SQUIDLE tables (can also be used to add a new boundary
--- to the tables).
+-- BOUNDARY_MEOW_HABITAT_OBS_SQUIDLE, and BOUNDARY_MEOW_AREA tables (can also be
+-- used to add a new boundary to the tables).
 
 CREATE PROCEDURE Update_MEOW_BOUNDARY
   @realm     NVARCHAR(255),
@@ -114,4 +114,14 @@ BEGIN
     ([boundary].[Realm] = @realm OR @realm IS NULL) AND
     ([boundary].[Province] = @province OR @province IS NULL) AND
     ([boundary].[Ecoregion] = @ecoregion OR @ecoregion IS NULL);
+
+  -- Update BOUNDARY_MEOW_AREA
+  EXEC Update_MEOW_BOUNDARY_AREA @realm, @province, @ecoregion;
+
+  -- Invalidate cached boundary statistics
+  UPDATE [dbo].[BOUNDARY_PRECALCULATION_VERSION]
+  SET
+    [version] = [version] + 1,
+    [updated] = GETDATE()
+  WHERE [boundary_type] = 'meow';
 END;
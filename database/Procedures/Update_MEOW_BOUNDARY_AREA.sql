@@ -0,0 +1,64 @@
+-- Recalculates the rows of BOUNDARY_MEOW_AREA affected by a change to the MEOW
+-- boundaries matching the parameters (NULL parameters match any value; all NULL
+-- recalculates the whole table). Called by Update_MEOW_BOUNDARY.
+
+CREATE PROCEDURE Update_MEOW_BOUNDARY_AREA
+  @realm      NVARCHAR(255),
+  @province   NVARCHAR(255),
+  @ecoregion  NVARCHAR(255)
+AS
+BEGIN
+  -- Every level whose boundaries overlap the updated boundaries is affected
+  DELETE FROM [dbo].[BOUNDARY_MEOW_AREA]
+  WHERE
+    ([Realm] IS NULL OR [Realm] = @realm OR @realm IS NULL) AND
+    ([Province] IS NULL OR [Province] = @province OR @province IS NULL) AND
+    ([Ecoregion] IS NULL OR [Ecoregion] = @ecoregion OR @ecoregion IS NULL);
+
+  INSERT INTO [dbo].[BOUNDARY_MEOW_AREA] ([Realm], [Province], [Ecoregion], [area])
+  SELECT
+    NULL,
+    NULL,
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_MEOW]
+  UNION ALL
+  SELECT
+    [Realm],
+    NULL,
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_MEOW]
+  WHERE
+    [Realm] IS NOT NULL AND
+    ([Realm] = @realm OR @realm IS NULL)
+  GROUP BY [Realm]
+  UNION ALL
+  SELECT
+    [Realm],
+    [Province],
+    NULL,
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_MEOW]
+  WHERE
+    [Realm] IS NOT NULL AND
+    [Province] IS NOT NULL AND
+    ([Realm] = @realm OR @realm IS NULL) AND
+    ([Province] = @province OR @province IS NULL)
+  GROUP BY [Realm], [Province]
+  UNION ALL
+  SELECT
+    [Realm],
+    [Province],
+    [Ecoregion],
+    GEOMETRY::UnionAggregate([geom]).STArea() / 1000000
+  FROM [dbo].[VW_BOUNDARY_MEOW]
+  WHERE
+    [Realm] IS NOT NULL AND
+    [Province] IS NOT NULL AND
+    [Ecoregion] IS NOT NULL AND
+    ([Realm] = @realm OR @realm IS NULL) AND
+    ([Province] = @province OR @province IS NULL) AND
+    ([Ecoregion] = @ecoregion OR @ecoregion IS NULL)
+  GROUP BY [Realm], [Province], [Ecoregion];
+END;
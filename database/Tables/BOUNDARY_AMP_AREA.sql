@@ -0,0 +1,16 @@
+-- Pre-calculated areas (in square kilometres) of the AMP boundaries at each level
+-- of the boundary hierarchy (network, park, zone category, IUCN category, zone
+-- ID). A NULL column matches any value, as with the parameters of
+-- AMP_BOUNDARY_geom, so [area] is AMP_BOUNDARY_geom(...).STArea() / 1000000 for
+-- the row's values. Maintained by Update_AMP_BOUNDARY_AREA.
+
+CREATE TABLE [dbo].[BOUNDARY_AMP_AREA] (
+  [Network]       NVARCHAR(254) NULL,
+  [Park]          NVARCHAR(254) NULL,
+  [Zone_Category] NVARCHAR(254) NULL,
+  [IUCN_Category] NVARCHAR(5)   NULL,
+  [Zone_ID]       NVARCHAR(10)  NULL,
+  [area]          FLOAT         NOT NULL
+);
+
+EXEC [dbo].[Update_AMP_BOUNDARY_AREA] NULL, NULL, NULL, NULL, NULL;
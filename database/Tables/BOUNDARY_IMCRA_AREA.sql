@@ -0,0 +1,13 @@
+-- Pre-calculated areas (in square kilometres) of the IMCRA boundaries at each
+-- level of the boundary hierarchy (provincial bioregion, mesoscale bioregion). A
+-- NULL column matches any value, as with the parameters of IMCRA_BOUNDARY_geom,
+-- so [area] is IMCRA_BOUNDARY_geom(...).STArea() / 1000000 for the row's values.
+-- Maintained by Update_IMCRA_BOUNDARY_AREA.
+
+CREATE TABLE [dbo].[BOUNDARY_IMCRA_AREA] (
+  [Provincial_Bioregion] NVARCHAR(255) NULL,
+  [Mesoscale_Bioregion]  NVARCHAR(255) NULL,
+  [area]                 FLOAT         NOT NULL
+);
+
+EXEC Update_IMCRA_BOUNDARY_AREA NULL, NULL;
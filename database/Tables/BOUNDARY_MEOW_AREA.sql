@@ -0,0 +1,14 @@
+-- Pre-calculated areas (in square kilometres) of the MEOW boundaries at each
+-- level of the boundary hierarchy (realm, province, ecoregion). A NULL column
+-- matches any value, as with the parameters of MEOW_BOUNDARY_geom, so [area] is
+-- MEOW_BOUNDARY_geom(...).STArea() / 1000000 for the row's values. Maintained by
+-- Update_MEOW_BOUNDARY_AREA.
+
+CREATE TABLE [dbo].[BOUNDARY_MEOW_AREA] (
+  [Realm]     NVARCHAR(255) NULL,
+  [Province]  NVARCHAR(255) NULL,
+  [Ecoregion] NVARCHAR(255) NULL,
+  [area]      FLOAT         NOT NULL
+);
+
+EXEC Update_MEOW_BOUNDARY_AREA NULL, NULL, NULL;
@@ -0,0 +1,17 @@
+-- Version of the pre-calculated BOUNDARY_* tables for each boundary type. The
+-- Update_* procedures increment the version whenever they refresh a boundary
+-- type's tables; the backend caches boundary statistics against this version, so
+-- cached statistics are invalidated by any refresh.
+--
+-- The 'regions' row is the version of the habitat data in
+-- SeamapAus_Regions_VIEW, which cached transects are checked against; it's
+-- incremented by UpdateHabitat and SeamapAus_Add_Layer.
+
+CREATE TABLE [dbo].[BOUNDARY_PRECALCULATION_VERSION] (
+  [boundary_type] NVARCHAR(10) NOT NULL PRIMARY KEY,
+  [version]       INT          NOT NULL DEFAULT 1,
+  [updated]       DATETIME     NOT NULL DEFAULT GETDATE()
+);
+
+INSERT INTO [dbo].[BOUNDARY_PRECALCULATION_VERSION] ([boundary_type])
+VALUES ('amp'), ('imcra'), ('meow'), ('regions');
@@ -0,0 +1,14 @@
+-- Fingerprints of the upstream features of each layer in [layer_feature], used by
+-- incremental feature index builds to skip layers that haven't changed. The
+-- [geometry_hash] is the sum (mod 2^256) of the SHA-256 hashes of each feature's
+-- geometry, so it doesn't depend on the order features are served in. [etag] and
+-- [last_modified] are the server's change markers for the layer, where it has
+-- them (for ArcGIS layers, [last_modified] is the editingInfo lastEditDate).
+CREATE TABLE [dbo].[layer_feature_fingerprint] (
+  [layer_id]      INT           NOT NULL PRIMARY KEY FOREIGN KEY REFERENCES [dbo].[catalogue_layer]([id]),
+  [feature_count] INT           NOT NULL,
+  [geometry_hash] CHAR(64)      NOT NULL,
+  [etag]          NVARCHAR(255) NULL,
+  [last_modified] NVARCHAR(255) NULL,
+  [timestamp]     DATETIME      NOT NULL DEFAULT GETDATE()
+);
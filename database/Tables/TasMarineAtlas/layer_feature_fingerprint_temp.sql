@@ -0,0 +1,11 @@
+-- Is a temporary storage for the fingerprints of the layers retrieved by a feature
+-- index build, prior to being copied into [layer_feature_fingerprint]. [changed]
+-- marks the layers whose features differ from those in [layer_feature].
+CREATE TABLE [dbo].[layer_feature_fingerprint_temp] (
+  [layer_id]      INT           NOT NULL PRIMARY KEY FOREIGN KEY REFERENCES [dbo].[catalogue_layer]([id]),
+  [feature_count] INT           NOT NULL,
+  [geometry_hash] CHAR(64)      NOT NULL,
+  [etag]          NVARCHAR(255) NULL,
+  [last_modified] NVARCHAR(255) NULL,
+  [changed]       BIT           NOT NULL
+);
@@ -0,0 +1,13 @@
+-- Simplified footprints of the features of each layer in [layer_feature], at a few
+-- tolerances (in degrees; see LAYER_FEATURE_FOOTPRINT_TOLERANCES), used to find the
+-- layers with data in a region without testing every feature. Each feature is
+-- simplified with Reduce([tolerance]) and then buffered by [tolerance], so a
+-- footprint always covers the layer's features: a region containing the footprint
+-- contains all of them, and a region disjoint from it contains none. Populated by
+-- build_feature_index_end.
+CREATE TABLE [dbo].[layer_feature_footprint] (
+  [layer_id]  INT      NOT NULL FOREIGN KEY REFERENCES [dbo].[catalogue_layer]([id]),
+  [tolerance] FLOAT    NOT NULL,
+  [geom]      GEOMETRY NOT NULL,
+  PRIMARY KEY ([layer_id], [tolerance])
+);
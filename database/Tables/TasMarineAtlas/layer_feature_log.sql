@@ -1,7 +1,17 @@
+-- Logs the outcome of indexing each layer's features. Rows written by
+-- build_feature_index also checkpoint the layer's progress: [build_id] identifies
+-- the index build, [result_offset] is the number of upstream features indexed so
+-- far (and [geometry_hash] their running fingerprint hash), and [finished] is set
+-- once the layer has been completely indexed, so that an interrupted build can be
+-- resumed.
 CREATE TABLE [dbo].[layer_feature_log] (
-  [id]        INT           NOT NULL PRIMARY KEY IDENTITY,
-  [layer_id]  INT           NOT NULL FOREIGN KEY REFERENCES [dbo].[catalogue_layer]([id]),
-  [timestamp] DATETIME      NOT NULL DEFAULT GETDATE(),
-  [traceback] NVARCHAR(MAX) NULL,
-  [error]     NVARCHAR(MAX) NULL
+  [id]            INT              NOT NULL PRIMARY KEY IDENTITY,
+  [layer_id]      INT              NOT NULL FOREIGN KEY REFERENCES [dbo].[catalogue_layer]([id]),
+  [timestamp]     DATETIME         NOT NULL DEFAULT GETDATE(),
+  [traceback]     NVARCHAR(MAX)    NULL,
+  [error]         NVARCHAR(MAX)    NULL,
+  [build_id]      UNIQUEIDENTIFIER NULL,
+  [result_offset] INT              NULL,
+  [geometry_hash] CHAR(64)         NULL,
+  [finished]      BIT              NOT NULL DEFAULT 1
 );